@@ -0,0 +1,53 @@
+import os
+import time
+import threading
+
+
+class BandwidthConfig:
+    # Download budget shared by every fetch worker; 0 disables the cap
+    MAX_BYTES_PER_SEC = int(os.getenv("DOWNLOAD_MAX_BYTES_PER_SEC", "0"))
+    BURST_SECONDS = float(os.getenv("DOWNLOAD_BURST_SECONDS", "2"))
+
+
+class BandwidthLimiter:
+    """Byte token bucket shared across threads.
+
+    Fetch threads report bytes as they arrive; a thread that overdraws the
+    bucket sleeps until its debt is paid back, which throttles the
+    download it is running. Debt is shared, so the total rate holds no
+    matter how many downloads run at once.
+    """
+
+    def __init__(self, rate: int = BandwidthConfig.MAX_BYTES_PER_SEC,
+                 burst_seconds: float = BandwidthConfig.BURST_SECONDS):
+        self.rate = rate
+        self.burst = rate * burst_seconds
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        # Summed over threads, so it can exceed wall-clock time
+        self.throttled_seconds = 0.0
+
+    def consume(self, amount: int):
+        if amount <= 0:
+            return
+        with self._lock:
+            self.bytes += amount
+            if self.rate <= 0:
+                return
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.throttled_seconds += wait
+        if wait:
+            time.sleep(wait)
+
+    def stats(self) -> dict:
+        return {
+            "max_bytes_per_sec": self.rate,
+            "bytes": self.bytes,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+        }
@@ -0,0 +1,67 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+BatchFetch = Callable[[list[str], str], Awaitable[list[Optional[dict]]]]
+
+
+class BatchConfig:
+    # How long a lookup may wait for others to join its batch
+    WINDOW_MS = float(os.getenv("SPOTIFY_BATCH_WINDOW_MS", "5"))
+
+
+def chunked(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class BatchLoader:
+    """Collects single-ID lookups made close together into bulk requests.
+
+    Lookups are grouped per access token. A batch is sent as soon as it
+    reaches ``max_size`` IDs or after ``BatchConfig.WINDOW_MS``, whichever
+    comes first. Concurrent lookups for the same ID share one result.
+    """
+
+    def __init__(self, fetch: BatchFetch, max_size: int):
+        self.fetch = fetch
+        self.max_size = max_size
+        self._pending: dict[str, dict[str, asyncio.Future]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+
+    async def load(self, item_id: str, token: str) -> Optional[dict]:
+        loop = asyncio.get_running_loop()
+        pending = self._pending.setdefault(token, {})
+        future = pending.get(item_id)
+        if future is None:
+            future = pending[item_id] = loop.create_future()
+            if len(pending) >= self.max_size:
+                self._dispatch(token)
+            elif token not in self._timers:
+                self._timers[token] = loop.call_later(BatchConfig.WINDOW_MS / 1000, self._dispatch, token)
+        # A cancelled caller must not cancel the lookup for everyone else
+        return await asyncio.shield(future)
+
+    def _dispatch(self, token: str):
+        timer = self._timers.pop(token, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(token, None)
+        if batch:
+            asyncio.ensure_future(self._run(batch, token))
+
+    async def _run(self, batch: dict[str, asyncio.Future], token: str):
+        ids = list(batch)
+        try:
+            results = await self.fetch(ids, token)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for item_id, result in zip(ids, results):
+            future = batch[item_id]
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,165 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+from codec import acompress_all, dumps
+from singleflight import SingleFlight
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class CacheConfig:
+    MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "2048"))
+    MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    # How long past its TTL an entry may still be served while it refreshes
+    STALE_SECONDS = float(os.getenv("CACHE_STALE_SECONDS", "600"))
+    TTLS = {
+        "me": float(os.getenv("CACHE_TTL_ME", "300")),
+        "playlists": float(os.getenv("CACHE_TTL_PLAYLISTS", "60")),
+        "playlist": float(os.getenv("CACHE_TTL_PLAYLIST", "120")),
+        "liked": float(os.getenv("CACHE_TTL_LIKED", "60")),
+        "search": float(os.getenv("CACHE_TTL_SEARCH", "600")),
+    }
+
+
+@dataclass
+class CacheEntry:
+    body: bytes
+    etag: str
+    upstream_etag: Optional[str]
+    stored_at: float
+    ttl: float
+    # Precompressed copies of ``body``, by content coding
+    encoded: dict[str, bytes] = field(default_factory=dict)
+
+    def size(self) -> int:
+        return len(self.body) + sum(len(body) for body in self.encoded.values())
+
+    def etag_for(self, encoding: Optional[str]) -> str:
+        # Each content coding is a distinct representation with its own validator
+        return self.etag if encoding is None else f'{self.etag[:-1]}-{encoding}"'
+
+    def age(self) -> float:
+        return time.monotonic() - self.stored_at
+
+    def is_fresh(self) -> bool:
+        return self.age() < self.ttl
+
+
+# Called with the current entry (or None); returns (data, upstream etag),
+# or None when upstream answered 304 and the current entry is still valid
+Fetch = Callable[[Optional[CacheEntry]], Awaitable[Optional[tuple[Any, Optional[str]]]]]
+
+
+class ResponseCache:
+    """Bounded in-memory LRU of serialized upstream responses.
+
+    Entries are keyed by (scope, key), where scope identifies the user so
+    that cached data never leaks between accounts. Expired entries are
+    still served for ``STALE_SECONDS`` while a single background refresh
+    brings them up to date. Bodies are compressed once when stored, not on
+    every request that serves them.
+    """
+
+    def __init__(self):
+        self._entries: OrderedDict[tuple[str, str], CacheEntry] = OrderedDict()
+        self._bytes = 0
+        self._refreshing: dict[tuple[str, str], asyncio.Task] = {}
+        self._misses = SingleFlight()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def _drop(self, cache_key: tuple[str, str]):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self._bytes -= entry.size()
+
+    def _store(self, cache_key: tuple[str, str], entry: CacheEntry):
+        self._drop(cache_key)
+        self._entries[cache_key] = entry
+        self._bytes += entry.size()
+        while self._entries and (len(self._entries) > CacheConfig.MAX_ENTRIES or self._bytes > CacheConfig.MAX_BYTES):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size()
+
+    async def _refresh(self, cache_key: tuple[str, str], route: str, fetch: Fetch) -> Optional[CacheEntry]:
+        current = self._entries.get(cache_key)
+        result = await fetch(current)
+        if result is None and current is None:
+            # "Not modified" with nothing cached to keep; there is no data to serve
+            self._drop(cache_key)
+            logger.warning(f"Refresh of {cache_key[1]} returned no data and nothing was cached")
+            return None
+        if result is None:
+            entry = CacheEntry(current.body, current.etag, current.upstream_etag,
+                               time.monotonic(), current.ttl, current.encoded)
+        else:
+            data, upstream_etag = result
+            with span("json.encode"):
+                body = dumps(data)
+            with span("compress", bytes=len(body)):
+                encoded = await acompress_all(body)
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            entry = CacheEntry(body, etag, upstream_etag, time.monotonic(), CacheConfig.TTLS.get(route, 60), encoded)
+        self._store(cache_key, entry)
+        return entry
+
+    def _refresh_in_background(self, cache_key: tuple[str, str], route: str, fetch: Fetch):
+        if cache_key in self._refreshing:
+            return
+
+        async def refresh():
+            try:
+                await self._refresh(cache_key, route, fetch)
+            except Exception as e:
+                logger.warning(f"Background refresh of {cache_key[1]} failed: {e}")
+            finally:
+                self._refreshing.pop(cache_key, None)
+
+        self._refreshing[cache_key] = asyncio.ensure_future(refresh())
+
+    async def _get(self, cache_key: tuple[str, str], route: str, fetch: Fetch) -> tuple[Optional[CacheEntry], str]:
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            self._entries.move_to_end(cache_key)
+            if entry.is_fresh():
+                self.hits += 1
+                return entry, "hit"
+            if entry.age() < entry.ttl + CacheConfig.STALE_SECONDS:
+                self.stale_hits += 1
+                self._refresh_in_background(cache_key, route, fetch)
+                return entry, "stale"
+        self.misses += 1
+        # Concurrent misses for one key wait on a single upstream fetch
+        return await self._misses.do(cache_key, lambda: self._refresh(cache_key, route, fetch)), "miss"
+
+    async def get(self, scope: str, key: str, route: str, fetch: Fetch) -> Optional[CacheEntry]:
+        """The entry for ``key``, fetching it on a miss; None if the fetch produced no data."""
+        with span("cache.response", key=key) as current:
+            entry, result = await self._get((scope, key), route, fetch)
+            if current is not None:
+                current.set(result=result)
+            return entry
+
+    def invalidate(self, scope: str, key: Optional[str] = None):
+        for cache_key in list(self._entries):
+            if cache_key[0] == scope and (key is None or cache_key[1] == key):
+                self._drop(cache_key)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+        }
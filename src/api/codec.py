@@ -0,0 +1,100 @@
+import os
+import json
+import gzip
+import asyncio
+from typing import Any, Iterable, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CodecConfig:
+    # Bodies smaller than this are not worth a compressed copy
+    MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+    GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+    # Quality 11 is several times slower for a few percent; 5 is close to gzip's speed
+    BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "5"))
+    # Larger bodies are compressed in a worker thread so the event loop keeps serving
+    THREAD_MIN_SIZE = int(os.getenv("COMPRESS_THREAD_MIN_SIZE", str(128 * 1024)))
+
+
+# Content codings we can produce, most preferred first
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def dumps(data: Any) -> bytes:
+    """Compact JSON as UTF-8 bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=CodecConfig.BROTLI_QUALITY)
+    if encoding == "gzip":
+        # mtime=0 keeps the output, and so ETags, stable across restarts
+        return gzip.compress(body, compresslevel=CodecConfig.GZIP_LEVEL, mtime=0)
+    raise ValueError(f"Unsupported content coding {encoding}")
+
+
+def compress_all(body: bytes) -> dict[str, bytes]:
+    """Every supported coding of ``body``; empty when it is too small to bother."""
+    if len(body) < CodecConfig.MIN_SIZE:
+        return {}
+    return {encoding: compress(body, encoding) for encoding in ENCODINGS}
+
+
+async def acompress(body: bytes, encoding: str) -> bytes:
+    if len(body) < CodecConfig.THREAD_MIN_SIZE:
+        return compress(body, encoding)
+    return await asyncio.to_thread(compress, body, encoding)
+
+
+async def acompress_all(body: bytes) -> dict[str, bytes]:
+    if len(body) < CodecConfig.THREAD_MIN_SIZE:
+        return compress_all(body)
+    return await asyncio.to_thread(compress_all, body)
+
+
+def negotiate(accept_encoding: Optional[str], available: Iterable[str] = ENCODINGS) -> Optional[str]:
+    """Pick the content coding for an ``Accept-Encoding`` header, or None for identity.
+
+    The highest q-value wins; ties go to our own preference order.
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        if encoding not in available:
+            continue
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
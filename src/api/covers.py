@@ -0,0 +1,250 @@
+import os
+import time
+import sqlite3
+import asyncio
+import hashlib
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from io import BytesIO
+from typing import Awaitable, Callable, Optional
+
+from metrics import REGISTRY
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+COVER_LOOKUPS = REGISTRY.counter("cover_cache_lookups_total", "Album cover lookups by result", ("result",))
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+
+class CoverConfig:
+    DIR = os.getenv("COVERS_DIR", os.path.join(DATA_DIR, "covers"))
+    MAX_BYTES = int(os.getenv("COVERS_MAX_BYTES", str(512 * 1024 * 1024)))
+    # Spotify publishes album art at these sizes; we serve the same set
+    SIZES = (64, 300, 640)
+    DEFAULT_SIZE = 300
+    JPEG_QUALITY = int(os.getenv("COVERS_JPEG_QUALITY", "85"))
+    # Album image lists remembered from API responses, so browsers can load
+    # covers without sending an Authorization header
+    KNOWN_ALBUMS = int(os.getenv("COVERS_KNOWN_ALBUMS", "50000"))
+
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def nearest_size(size: Optional[int]) -> int:
+    if not size:
+        return CoverConfig.DEFAULT_SIZE
+    return min(CoverConfig.SIZES, key=lambda candidate: abs(candidate - size))
+
+
+def nearest_image(images: list[dict], size: int) -> Optional[dict]:
+    """Pick the published image closest to ``size`` pixels wide."""
+    if not images:
+        return None
+    return min(images, key=lambda image: abs((image.get("width") or CoverConfig.SIZES[-1]) - size))
+
+
+# Leading bytes of the image formats Spotify and its CDNs serve
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def image_type(data: bytes) -> str:
+    """Media type of an image, from its leading bytes."""
+    for signature, media_type in _SIGNATURES:
+        if data.startswith(signature):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def _resize(data: bytes, sizes: tuple) -> dict[int, bytes]:
+    variants = {}
+    with Image.open(BytesIO(data)) as original:
+        original = original.convert("RGB")
+        for size in sizes:
+            if original.width <= size:
+                variants[size] = data
+                continue
+            out = BytesIO()
+            original.resize((size, size), Image.LANCZOS).save(
+                out, format="JPEG", quality=CoverConfig.JPEG_QUALITY, optimize=True)
+            variants[size] = out.getvalue()
+    return variants
+
+
+class CoverCache:
+    """Content-addressed album art cache with LRU eviction.
+
+    Each album's art is fetched once; every size variant is stored under its
+    SHA-256 so identical images are kept only once on disk. An index maps
+    (album id, size) to a hash and tracks last access for eviction.
+    """
+
+    def __init__(self, fetch: Callable[[str], Awaitable[bytes]], directory: str = CoverConfig.DIR):
+        self.fetch = fetch
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS covers ("
+            "album_id TEXT NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL, "
+            "bytes INTEGER NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (album_id, size))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_covers_accessed ON covers(accessed_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_covers_hash ON covers(hash)")
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._known: OrderedDict[str, list[dict]] = OrderedDict()
+
+    def remember(self, items: list[dict]):
+        """Record album image lists from playlist or track items."""
+        for item in items:
+            track = (item or {}).get("track", item) or {}
+            album = track.get("album") or {}
+            if album.get("id") and album.get("images"):
+                self._known[album["id"]] = album["images"]
+                self._known.move_to_end(album["id"])
+        while len(self._known) > CoverConfig.KNOWN_ALBUMS:
+            self._known.popitem(last=False)
+
+    def known_images(self, album_id: str) -> Optional[list[dict]]:
+        return self._known.get(album_id)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], f"{digest}.jpg")
+
+    def media_type(self, digest: str) -> str:
+        """Media type of a stored image; resized variants are JPEG, originals kept as-is may not be."""
+        with open(self.path_for(digest), "rb") as f:
+            return image_type(f.read(16))
+
+    def _lookup(self, album_id: str, size: int) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT hash FROM covers WHERE album_id = ? AND size = ?", (album_id, size)
+            ).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(self.path_for(row[0])):
+                self._conn.execute("DELETE FROM covers WHERE album_id = ? AND size = ?", (album_id, size))
+                return None
+            self._conn.execute(
+                "UPDATE covers SET accessed_at = ? WHERE album_id = ? AND size = ?",
+                (time.time(), album_id, size),
+            )
+            return row[0]
+
+    def _write(self, album_id: str, variants: dict[int, bytes]):
+        now = time.time()
+        rows = []
+        for size, data in variants.items():
+            digest = hashlib.sha256(data).hexdigest()
+            path = self.path_for(digest)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Concurrent populates may write the same digest; each writes its own temp file
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp, path)
+                except BaseException:
+                    os.remove(tmp)
+                    raise
+            rows.append((album_id, size, digest, len(data), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO covers (album_id, size, hash, bytes, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            total = self._conn.execute(
+                "SELECT COALESCE(SUM(bytes), 0) FROM (SELECT hash, MAX(bytes) AS bytes FROM covers GROUP BY hash)"
+            ).fetchone()[0]
+            if total <= CoverConfig.MAX_BYTES:
+                return
+            rows = self._conn.execute(
+                "SELECT album_id, size, hash, bytes FROM covers ORDER BY accessed_at"
+            ).fetchall()
+            for album_id, size, digest, length in rows:
+                if total <= CoverConfig.MAX_BYTES:
+                    break
+                self._conn.execute("DELETE FROM covers WHERE album_id = ? AND size = ?", (album_id, size))
+                still_used = self._conn.execute("SELECT 1 FROM covers WHERE hash = ? LIMIT 1", (digest,)).fetchone()
+                if not still_used:
+                    try:
+                        os.remove(self.path_for(digest))
+                    except FileNotFoundError:
+                        pass
+                    total -= length
+        logger.info("Evicted album art down to %d bytes", total)
+
+    async def _populate(self, album_id: str, images: list[dict], size: int):
+        if Image is not None:
+            # Fetch the largest image once and derive every size from it
+            largest = max(images, key=lambda image: image.get("width") or 0)
+            data = await self.fetch(largest["url"])
+            try:
+                variants = await asyncio.to_thread(_resize, data, CoverConfig.SIZES)
+            except OSError as e:
+                # Undecodable or truncated upstream image (PIL.UnidentifiedImageError is an OSError)
+                logger.warning(f"Cannot resize art for album {album_id}, keeping the original: {e}")
+                variants = {variant: data for variant in CoverConfig.SIZES}
+        else:
+            data = await self.fetch(nearest_image(images, size)["url"])
+            variants = {size: data}
+        await asyncio.to_thread(self._write, album_id, variants)
+
+    async def get(self, album_id: str, images: Callable[[], Awaitable[list[dict]]],
+                  size: Optional[int] = None) -> Optional[str]:
+        """Return the content hash of an album cover, fetching it on a miss.
+
+        ``images`` is only awaited on a miss and should return the album's
+        published image list.
+        """
+        with span("cache.cover", album_id=album_id):
+            return await self._get(album_id, images, size)
+
+    async def _get(self, album_id: str, images: Callable[[], Awaitable[list[dict]]],
+                   size: Optional[int]) -> Optional[str]:
+        size = nearest_size(size)
+        digest = await asyncio.to_thread(self._lookup, album_id, size)
+        if digest:
+            COVER_LOOKUPS.inc("hit")
+            return digest
+        COVER_LOOKUPS.inc("miss")
+
+        # With Pillow one fetch produces every size, so share it per album
+        key = album_id if Image is not None else f"{album_id}:{size}"
+        task = self._inflight.get(key)
+        if task is None:
+            async def populate():
+                album_images = await images()
+                if album_images:
+                    await self._populate(album_id, album_images, size)
+            task = self._inflight[key] = asyncio.ensure_future(populate())
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        await asyncio.shield(task)
+        return await asyncio.to_thread(self._lookup, album_id, size)
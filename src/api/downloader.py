@@ -0,0 +1,704 @@
+import os
+import re
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import shutil
+import fcntl
+import itertools
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from enum import Enum
+from typing import Optional
+
+import yt_dlp
+from mutagen.mp3 import MP3
+
+from bandwidth import BandwidthLimiter
+from jobs import DownloadQueue, QueueConfig
+from matches import MatchCache, MatchConfig, best_match
+from metrics import REGISTRY, MetricsConfig
+from progress import ProgressBus
+from tagging import Tagger
+from tracing import bind, tracer
+
+logger = logging.getLogger(__name__)
+
+STAGE_DURATION = REGISTRY.histogram("download_stage_duration_seconds", "Time spent in each pipeline stage",
+                                    ("stage", "outcome"), buckets=MetricsConfig.STAGE_BUCKETS)
+TRACKS_FINISHED = REGISTRY.counter("download_tracks_finished_total",
+                                   "Tracks leaving the pipeline; pending means queued for a retry", ("status",))
+
+
+class Config:
+    MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+    # Every track is downloaded once into the content store, keyed by Spotify id,
+    # and linked into each playlist folder: hardlink, reflink, symlink or copy
+    STORE_DIR = os.getenv("TRACK_STORE_DIR", os.path.join(MEDIA_DIR, ".tracks"))
+    LINK_MODE = os.getenv("TRACK_LINK_MODE", "hardlink")
+    PLAYLIST_WRITE_INTERVAL = float(os.getenv("PLAYLIST_WRITE_INTERVAL", "2"))
+    # Stop claiming new tracks below MIN_FREE_BYTES on the media volume and
+    # resume once RESUME_FREE_BYTES are available again
+    MIN_FREE_BYTES = int(os.getenv("DOWNLOAD_MIN_FREE_BYTES", str(2 * 1024 ** 3)))
+    RESUME_FREE_BYTES = int(os.getenv("DOWNLOAD_RESUME_FREE_BYTES", str(3 * 1024 ** 3)))
+    DISK_CHECK_INTERVAL = float(os.getenv("DOWNLOAD_DISK_CHECK_INTERVAL", "30"))
+    # Job priorities: interactive single-track requests jump ahead of bulk playlists
+    BULK_PRIORITY = 0
+    INTERACTIVE_PRIORITY = 10
+    # Pool sizes per pipeline stage: searches and fetches wait on the network,
+    # transcoding is CPU-bound and tagging is small local writes
+    SEARCH_CONCURRENCY = int(os.getenv("DOWNLOAD_SEARCH_CONCURRENCY", "16"))
+    FETCH_WORKERS = int(os.getenv("DOWNLOAD_FETCH_WORKERS", os.getenv("MAX_CONCURRENT_DOWNLOADS", "6")))
+    TRANSCODE_WORKERS = int(os.getenv("DOWNLOAD_TRANSCODE_WORKERS", str(os.cpu_count() or 2)))
+    TAG_WORKERS = int(os.getenv("DOWNLOAD_TAG_WORKERS", "2"))
+    # Items waiting in front of each stage before upstream stages block
+    STAGE_QUEUE_SIZE = int(os.getenv("DOWNLOAD_STAGE_QUEUE_SIZE", "8"))
+    # yt-dlp search key; the offline mock server provides "mockytsearch"
+    SEARCH_KEY = os.getenv("YOUTUBE_SEARCH_KEY", "ytsearch")
+    MP3_QUALITY = os.getenv("MP3_QUALITY", "5")  # LAME VBR quality, 0 (best) to 9
+    DOWNLOAD_RETRY_ATTEMPTS = int(os.getenv("DOWNLOAD_RETRY_ATTEMPTS", "3"))
+    DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "300"))  # 5 minutes
+    # Seconds one attempt may spend in each stage
+    STAGE_TIMEOUTS = {
+        "search": float(os.getenv("DOWNLOAD_SEARCH_TIMEOUT", "60")),
+        "fetch": float(DOWNLOAD_TIMEOUT),
+        "transcode": float(os.getenv("DOWNLOAD_TRANSCODE_TIMEOUT", "300")),
+        "tag": float(os.getenv("DOWNLOAD_TAG_TIMEOUT", "60")),
+    }
+    SOCKET_TIMEOUT = float(os.getenv("DOWNLOAD_SOCKET_TIMEOUT", "30"))
+    # Fetch in ranged chunks; interrupted fetches resume from the .part file
+    FETCH_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(10 * 1024 ** 2)))
+    # Transcoded files must be within this many seconds of the Spotify duration
+    DURATION_TOLERANCE = float(os.getenv("DOWNLOAD_DURATION_TOLERANCE", "25"))
+    MIN_KBPS = int(os.getenv("DOWNLOAD_MIN_KBPS", "32"))
+
+
+class DownloadStatus(Enum):
+    PENDING = "pending"
+    SEARCHING = "searching"
+    DOWNLOADING = "downloading"
+    TRANSCODING = "transcoding"
+    TAGGING = "tagging"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+
+class NoMatchError(Exception):
+    """No acceptable YouTube candidate; retrying will not help."""
+
+
+class IntegrityError(Exception):
+    """A transcoded file does not look like the whole track."""
+
+
+def _base_query(name: str) -> str:
+    # Spotify suffixes like "- Remastered 2011" only hurt the search
+    return re.split(r" - ", name)[0]
+
+
+def safe_filename(name: str) -> str:
+    return re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", name).strip(" .") or "untitled"
+
+
+async def transcode(source: str, target: str, duration_ms: Optional[int], quality: str = Config.MP3_QUALITY):
+    """Convert a downloaded audio stream to mp3 at ``target`` and check it is complete.
+
+    ffmpeg is killed if the caller is cancelled, e.g. by the stage timeout.
+    ``target`` is removed again if the result is truncated or implausibly small.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", source,
+            "-vn", "-codec:a", "libmp3lame", "-q:a", quality, "-f", "mp3", target,
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            message = stderr.decode(errors="replace").strip()[-500:]
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}: {message}")
+        await asyncio.to_thread(verify, target, duration_ms)
+    except BaseException:
+        if os.path.exists(target):
+            os.remove(target)
+        raise
+
+
+def verify(path: str, duration_ms: Optional[int]):
+    length = MP3(path).info.length
+    size = os.path.getsize(path)
+    if duration_ms and abs(length - duration_ms / 1000) > Config.DURATION_TOLERANCE:
+        raise IntegrityError(f"Output is {length:.0f}s long, expected {duration_ms / 1000:.0f}s")
+    if size < length * Config.MIN_KBPS * 1000 / 8:
+        raise IntegrityError(f"Output is only {size} bytes for {length:.0f}s of audio")
+
+
+FICLONE = 0x40049409  # linux/fs.h
+
+
+def _reflink(source: str, target: str):
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_into(source: str, target: str, mode: str = Config.LINK_MODE):
+    """Place ``source`` at ``target`` without duplicating it where the filesystem allows."""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    staging = target + ".link"
+    if os.path.lexists(staging):
+        os.remove(staging)
+    try:
+        if mode == "symlink":
+            os.symlink(os.path.relpath(source, os.path.dirname(target)), staging)
+        elif mode == "hardlink":
+            os.link(source, staging)
+        elif mode == "reflink":
+            _reflink(source, staging)
+        else:
+            shutil.copy2(source, staging)
+    except OSError as e:
+        # Cross-device links or filesystems without reflink support
+        if mode == "copy":
+            raise
+        logger.warning(f"Cannot {mode} {target} ({e}); copying instead")
+        if os.path.lexists(staging):
+            os.remove(staging)
+        shutil.copy2(source, staging)
+    os.replace(staging, target)
+
+
+def write_m3u(path: str, entries: list[tuple[Optional[int], str, str]]):
+    """Write an extended M3U of (duration_ms, title, relative path) entries."""
+    lines = ["#EXTM3U"]
+    for duration_ms, title, location in entries:
+        seconds = round(duration_ms / 1000) if duration_ms else -1
+        lines += [f"#EXTINF:{seconds},{title}", location]
+    staging = path + ".tmp"
+    with open(staging, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(staging, path)
+
+
+@dataclass
+class TrackTask:
+    track_id: str
+    name: str
+    artists: list[str]
+    album: str
+    duration_ms: Optional[int] = None
+    job_id: str = ""
+    folder: str = ""
+    priority: int = 0
+    # Whose Spotify session background lookups for the job use
+    user_id: Optional[str] = None
+    status: DownloadStatus = DownloadStatus.PENDING
+    progress: float = 0.0
+    url: Optional[str] = None
+    path: Optional[str] = None
+    source: Optional[str] = None
+    error: Optional[str] = None
+    attempts: int = 0
+
+    @classmethod
+    def from_track(cls, track: dict) -> "TrackTask":
+        return cls(
+            track_id=track.get("id") or track.get("uri"),
+            name=track.get("name") or "",
+            artists=[artist.get("name") for artist in track.get("artists") or [] if artist.get("name")],
+            album=(track.get("album") or {}).get("name") or "",
+            duration_ms=track.get("duration_ms"),
+        )
+
+    @classmethod
+    def from_claim(cls, claim: dict) -> "TrackTask":
+        fields = {key: claim.get(key) for key in ("track_id", "name", "artists", "album", "duration_ms",
+                                                   "job_id", "folder", "user_id", "url", "path")}
+        return cls(**fields, priority=claim.get("priority") or 0, attempts=claim.get("attempts") or 0)
+
+    @property
+    def artist(self) -> str:
+        return self.artists[0] if self.artists else ""
+
+    def spotify_track(self) -> dict:
+        """Minimal Spotify-shaped track, for tagging tracks the library store does not know."""
+        return {
+            "id": self.track_id,
+            "name": self.name,
+            "artists": [{"name": artist} for artist in self.artists],
+            "album": {"name": self.album},
+        }
+
+    def metadata(self) -> dict:
+        return {
+            "track_id": self.track_id,
+            "name": self.name,
+            "artists": self.artists,
+            "album": self.album,
+            "duration_ms": self.duration_ms,
+        }
+
+    def to_dict(self):
+        return {
+            **asdict(self),
+            "status": self.status.value,
+        }
+
+
+class StageQueue(asyncio.PriorityQueue):
+    """Bounded stage inbox that hands out tracks of higher priority jobs first."""
+
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        self._order = itertools.count()
+
+    async def put(self, task: TrackTask):
+        await super().put((-task.priority, next(self._order), task))
+
+    async def get(self) -> TrackTask:
+        return (await super().get())[2]
+
+
+class DownloadManager:
+    """Job-based YouTube download engine.
+
+    Submitting a playlist or track records a job in the durable queue and
+    returns immediately. Claimed tracks flow through a staged pipeline --
+    search, fetch, transcode, tag -- where each stage has its own pool sized
+    for its kind of work and bounded queues between stages apply
+    backpressure, so network and CPU stay busy at the same time. Work
+    interrupted by a restart is resumed on startup.
+    """
+
+    def __init__(self, queue: DownloadQueue, matches: MatchCache, bus: ProgressBus, tagger: Tagger,
+                 media_dir: str = Config.MEDIA_DIR, store_dir: str = Config.STORE_DIR):
+        self.queue = queue
+        self.matches = matches
+        self.bus = bus
+        self.tagger = tagger
+        self.bandwidth = BandwidthLimiter()
+        # Set while the media volume is below the free-space low-water mark
+        self.paused_reason: Optional[str] = None
+        self.media_dir = media_dir
+        self.store_dir = store_dir
+        self.search_pool = ThreadPoolExecutor(max_workers=Config.SEARCH_CONCURRENCY, thread_name_prefix="search")
+        self.fetch_pool = ThreadPoolExecutor(max_workers=Config.FETCH_WORKERS, thread_name_prefix="fetch")
+        # ffmpeg runs as a child process; this bounds how many run at once
+        self.transcode_slots = asyncio.Semaphore(Config.TRANSCODE_WORKERS)
+        self.tag_pool = ThreadPoolExecutor(max_workers=Config.TAG_WORKERS, thread_name_prefix="tag")
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        # Tracks currently in the pipeline, for live progress in job status
+        self.active: dict[tuple[str, str], TrackTask] = {}
+        self.stages = (
+            ("search", self._search, Config.SEARCH_CONCURRENCY),
+            ("fetch", self._fetch, Config.FETCH_WORKERS),
+            ("transcode", self._transcode, Config.TRANSCODE_WORKERS),
+            ("tag", self._tag, Config.TAG_WORKERS),
+        )
+        self.inboxes: dict[str, StageQueue] = {}
+        # One pipeline run per Spotify track; other jobs wanting it wait for that run
+        self._in_flight: dict[str, tuple[TrackTask, asyncio.Future]] = {}
+        self._followers: set[asyncio.Task] = set()
+        self._dirty_playlists: set[str] = set()
+        self._wakeup = asyncio.Event()
+        self._workers: list[asyncio.Task] = []
+
+    async def start(self):
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("ffmpeg not found on PATH; it is needed to transcode downloads")
+        os.makedirs(self.store_dir, exist_ok=True)
+        await asyncio.to_thread(self.queue.recover)
+        self.inboxes = {name: StageQueue(maxsize=Config.STAGE_QUEUE_SIZE) for name, _, _ in self.stages}
+        self._workers = [asyncio.create_task(self._claimer()), asyncio.create_task(self._playlist_writer())]
+        for index, (name, handler, workers) in enumerate(self.stages):
+            outbox = self.inboxes[self.stages[index + 1][0]] if index + 1 < len(self.stages) else None
+            self._workers += [
+                asyncio.create_task(self._stage_worker(name, handler, self.inboxes[name], outbox)) for _ in range(workers)
+            ]
+
+    async def stop(self):
+        workers = self._workers + list(self._followers)
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._workers = []
+        await asyncio.to_thread(self._write_playlists, self._dirty_playlists)
+        for pool in (self.search_pool, self.fetch_pool, self.tag_pool):
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self.active),
+            "paused": self.paused_reason,
+            "bandwidth": self.bandwidth.stats(),
+            "stages": {
+                name: {"queued": self.inboxes[name].qsize() if name in self.inboxes else 0, "workers": workers}
+                for name, _, workers in self.stages
+            },
+        }
+
+    async def submit(self, name: str, tracks: list[dict], playlist_id: Optional[str] = None,
+                     priority: int = Config.BULK_PRIORITY, user_id: Optional[str] = None) -> dict:
+        tasks = [TrackTask.from_track(track) for track in tracks if track and track.get("name")]
+        tasks = [task for task in tasks if task.track_id]
+        await self.tagger.remember(tracks)
+        job_id, scheduled = await self.queue.aenqueue(
+            name, safe_filename(name), [task.metadata() for task in tasks], playlist_id, priority, user_id)
+        self._wakeup.set()
+        logger.info(f"Queued {scheduled} new tracks for job {job_id} ({name})")
+        job = await self.job(job_id, include_tracks=False)
+        return {**job, "scheduled": scheduled}
+
+    async def job(self, job_id: str, include_tracks: bool = True, user_id: Optional[str] = None) -> Optional[dict]:
+        job = await asyncio.to_thread(self.queue.job, job_id, user_id)
+        if job is None or not include_tracks:
+            return job
+        tracks = await asyncio.to_thread(self.queue.job_tracks, job_id)
+        for track in tracks:
+            active = self.active.get((job_id, track["track_id"]))
+            track["progress"] = active.progress if active else (100.0 if track["status"] == "completed" else 0.0)
+        return {**job, "tracks": tracks}
+
+    async def snapshot(self, job_id: str) -> Optional[dict]:
+        """Compact job state for progress subscribers: counts plus only the tracks still moving or failed."""
+        job = await asyncio.to_thread(self.queue.job, job_id)
+        if job is None:
+            return None
+        tracks = await asyncio.to_thread(self.queue.job_tracks, job_id)
+        job["tracks"] = []
+        for track in tracks:
+            if track["status"] in ("completed", "skipped"):
+                continue
+            active = self.active.get((job_id, track["track_id"]))
+            entry = {"track_id": track["track_id"], "status": track["status"],
+                     "progress": active.progress if active else 0.0}
+            if track["error"]:
+                entry["error"] = track["error"]
+            job["tracks"].append(entry)
+        return job
+
+    async def jobs(self, user_id: Optional[str] = None) -> list[dict]:
+        return await asyncio.to_thread(self.queue.jobs, user_id)
+
+    async def on_playlist_diff(self, playlist: dict, diff: dict, items: list[dict]):
+        """Sync listener: keep the jobs of playlists downloaded before in step with them.
+
+        Added tracks are queued, the job's tracks follow the playlist's new
+        order, and removed tracks leave the playlist folder and its M3U.
+        """
+        if not (diff["added"] or diff["removed"] or diff["moved"]):
+            return
+        job_id = await asyncio.to_thread(self.queue.playlist_job, playlist["id"])
+        if job_id is None:
+            return
+        job = await asyncio.to_thread(self.queue.job, job_id)
+        if diff["added"]:
+            tracks = [entry["item"].get("track") for entry in diff["added"]]
+            await self.submit(playlist.get("name") or playlist["id"], tracks, playlist["id"], job["priority"],
+                              job["user_id"])
+        order = [TrackTask.from_track(item["track"]).track_id for item in items if item and item.get("track")]
+        dropped = await asyncio.to_thread(self.queue.reorder, job_id, [track_id for track_id in order if track_id])
+        if dropped:
+            await asyncio.to_thread(self._unlink, job_id, dropped)
+            logger.info(f"Removed {len(dropped)} tracks from job {job_id} ({job['name']})")
+        self._dirty_playlists.add(job_id)
+
+    def _unlink(self, job_id: str, dropped: list[dict]):
+        """Remove the playlist folder links of tracks that left a job; the stored copies stay for other jobs."""
+        job = self.queue.job(job_id)
+        for track in dropped:
+            if not track.get("filename"):
+                continue
+            path = os.path.join(self.media_dir, job["folder"], track["filename"])
+            if os.path.lexists(path):
+                os.remove(path)
+
+    def store_path(self, task: TrackTask) -> str:
+        return os.path.join(self.store_dir, f"{safe_filename(task.track_id)}.mp3")
+
+    @staticmethod
+    def source_template(task: TrackTask) -> str:
+        """Where the raw download goes; never the store path, even when the source is already mp3."""
+        return os.path.splitext(task.path)[0] + ".src.%(ext)s"
+
+    @staticmethod
+    def track_filename(track: dict, unique: bool = False) -> str:
+        """``Artist - Title.mp3``; ``unique`` adds the track id, for tracks whose name is taken in the job."""
+        artists = track.get("artists") or []
+        name = track.get("name") or ""
+        stem = f"{artists[0]} - {name}" if artists else name
+        if unique:
+            stem = f"{stem} [{track['track_id']}]"
+        return safe_filename(stem) + ".mp3"
+
+    def track_path(self, task: TrackTask) -> Optional[str]:
+        """Where the track appears inside its job's playlist folder, or None if it has left the job."""
+        metadata = task.metadata()
+        filename = self.queue.assign_filename(task.job_id, task.track_id, self.track_filename(metadata),
+                                              self.track_filename(metadata, unique=True))
+        return os.path.join(self.media_dir, task.folder, filename) if filename else None
+
+    def _write_playlists(self, job_ids: set[str]):
+        for job_id in list(job_ids):
+            job_ids.discard(job_id)
+            job = self.queue.job(job_id)
+            if job is None:
+                continue
+            folder = os.path.join(self.media_dir, job["folder"])
+            entries = [
+                (track.get("duration_ms"), f"{', '.join(track.get('artists') or [])} - {track.get('name')}",
+                 track["filename"] or self.track_filename(track))
+                for track in self.queue.job_tracks(job_id) if track["status"] in ("completed", "skipped")
+            ]
+            os.makedirs(folder, exist_ok=True)
+            write_m3u(os.path.join(folder, f"{job['folder']}.m3u8"), entries)
+
+    async def _playlist_writer(self):
+        """Rewrite M3U files of jobs that gained tracks, at most every PLAYLIST_WRITE_INTERVAL."""
+        while True:
+            await asyncio.sleep(Config.PLAYLIST_WRITE_INTERVAL)
+            if self._dirty_playlists:
+                try:
+                    await asyncio.to_thread(self._write_playlists, self._dirty_playlists)
+                except Exception as e:
+                    logger.error(f"Writing playlist files failed: {e}")
+
+    async def _set_status(self, task: TrackTask, status: DownloadStatus):
+        task.status = status
+        self.bus.publish(task.job_id, task.track_id, status=status.value, progress=task.progress, error=task.error)
+        await self.queue.aupdate(task.job_id, task.track_id, self.owner, status.value, attempts=task.attempts,
+                                 url=task.url, path=task.path, error=task.error)
+
+    async def _finish(self, task: TrackTask, status: DownloadStatus):
+        await self._set_status(task, status)
+        TRACKS_FINISHED.inc(status.value)
+        self.active.pop((task.job_id, task.track_id), None)
+        leader = self._in_flight.get(task.track_id)
+        if leader is not None and leader[0] is task:
+            del self._in_flight[task.track_id]
+            leader[1].set_result(status)
+
+    async def _publish(self, task: TrackTask, status: DownloadStatus):
+        """Link a stored track into its playlist folder and mark it done."""
+        try:
+            target = await asyncio.to_thread(self.track_path, task)
+            if target is not None:
+                await asyncio.to_thread(link_into, task.path, target)
+        except OSError as e:
+            await self._retry_or_fail(task, e)
+            return
+        task.progress, task.error = 100.0, None
+        await self._finish(task, status)
+        self._dirty_playlists.add(task.job_id)
+
+    async def _follow(self, task: TrackTask, leader: asyncio.Future):
+        # The leader may outlive a lease; keep this track's row from being claimed again meanwhile
+        while not (await asyncio.wait({leader}, timeout=QueueConfig.LEASE_SECONDS / 3))[0]:
+            await self.queue.arenew(task.job_id, task.track_id, self.owner)
+        if leader.result() in (DownloadStatus.COMPLETED, DownloadStatus.SKIPPED):
+            task.attempts += 1
+            await self._publish(task, DownloadStatus.SKIPPED)
+        else:
+            # The failed attempt was the leader's; this track goes back to the queue with its own count
+            await self._retry_or_fail(task, Exception("Shared download of this track failed"))
+
+    def _check_disk(self) -> Optional[str]:
+        """Return why the queue should be paused for disk space, or None."""
+        free = shutil.disk_usage(self.store_dir).free
+        threshold = Config.MIN_FREE_BYTES
+        if self.paused_reason:
+            threshold = max(Config.RESUME_FREE_BYTES, Config.MIN_FREE_BYTES)
+        if free >= threshold:
+            return None
+        return f"{free // 1024 ** 2} MiB free on {self.media_dir}, need {threshold // 1024 ** 2} MiB"
+
+    async def _claimer(self):
+        """Feed the pipeline from the durable queue.
+
+        Blocks while the search stage is full, and stops claiming while the
+        media volume is low on space.
+        """
+        inbox = self.inboxes[self.stages[0][0]]
+        while True:
+            reason = await asyncio.to_thread(self._check_disk)
+            if reason != self.paused_reason:
+                if reason:
+                    logger.warning(f"Pausing downloads: {reason}")
+                elif self.paused_reason:
+                    logger.info("Resuming downloads, disk space recovered")
+                self.paused_reason = reason
+            if reason:
+                await asyncio.sleep(Config.DISK_CHECK_INTERVAL)
+                continue
+
+            self._wakeup.clear()
+            claim = await self.queue.aclaim(self.owner)
+            if claim is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = TrackTask.from_claim(claim)
+            task.path = self.store_path(task)
+            self.active[(task.job_id, task.track_id)] = task
+            # Checked before the store: a run in flight may still be writing there
+            leader = self._in_flight.get(task.track_id)
+            if leader is not None:
+                follower = asyncio.create_task(self._follow(task, leader[1]))
+                self._followers.add(follower)
+                follower.add_done_callback(self._followers.discard)
+                continue
+            task.attempts += 1
+            if os.path.exists(task.path):
+                await self._publish(task, DownloadStatus.SKIPPED)
+                continue
+            self._in_flight[task.track_id] = (task, asyncio.get_running_loop().create_future())
+            await inbox.put(task)
+
+    async def _stage_worker(self, name: str, handler, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue]):
+        timeout = Config.STAGE_TIMEOUTS[name]
+        while True:
+            task = await inbox.get()
+            started = time.perf_counter()
+            try:
+                with tracer.job_span(task.job_id, f"download.{name}", track_id=task.track_id, attempt=task.attempts):
+                    await asyncio.wait_for(handler(task), timeout)
+            except asyncio.TimeoutError:
+                STAGE_DURATION.observe(time.perf_counter() - started, name, "timeout")
+                await self._retry_or_fail(task, TimeoutError(f"{name} took longer than {timeout:g}s"))
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                STAGE_DURATION.observe(time.perf_counter() - started, name, "error")
+                await self._retry_or_fail(task, e)
+                continue
+            STAGE_DURATION.observe(time.perf_counter() - started, name, "ok")
+            if outbox is not None:
+                await outbox.put(task)
+            else:
+                await self._publish(task, DownloadStatus.COMPLETED)
+
+    async def _retry_or_fail(self, task: TrackTask, error: Exception):
+        logger.error(f"Download attempt {task.attempts} failed for {task.name} while {task.status.value}: {error}")
+        task.error = str(error)
+        if task.attempts < Config.DOWNLOAD_RETRY_ATTEMPTS and not isinstance(error, NoMatchError):
+            # Back to the durable queue; a known YouTube url skips the search next time
+            await self._finish(task, DownloadStatus.PENDING)
+            self._wakeup.set()
+        else:
+            await self._finish(task, DownloadStatus.FAILED)
+
+    async def _search(self, task: TrackTask):
+        if task.url:
+            return
+        match, known_missing = await self.matches.alookup(task.track_id)
+        if match is not None:
+            task.url = match.url
+            return
+        if known_missing:
+            raise NoMatchError("No match found on YouTube (cached)")
+
+        await self._set_status(task, DownloadStatus.SEARCHING)
+        ydl_opts = {
+            'default_search': Config.SEARCH_KEY,
+            'quiet': True,
+            'extract_flat': True,
+            'socket_timeout': Config.SOCKET_TIMEOUT,
+        }
+
+        def search():
+            query = f"{Config.SEARCH_KEY}{MatchConfig.CANDIDATES}:{task.artist} {_base_query(task.name)}"
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(query, download=False)
+            return info.get('entries') or []
+
+        entries = await asyncio.get_running_loop().run_in_executor(self.search_pool, bind("yt_dlp.search", search))
+        match = best_match(task.name, task.artists, task.duration_ms, entries)
+        await self.matches.aremember(task.track_id, match)
+        if match is None:
+            raise NoMatchError(f"No acceptable match among {len(entries)} YouTube results")
+        logger.debug(f"Matched {task.artist} - {task.name} to {match.title!r} ({match.channel}, score {match.score})")
+        task.url = match.url
+
+    async def _fetch(self, task: TrackTask):
+        await self._set_status(task, DownloadStatus.DOWNLOADING)
+        os.makedirs(os.path.dirname(task.path), exist_ok=True)
+        cancelled = threading.Event()
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            # yt-dlp writes <id>.src.<ext>.part and continues it on the next attempt
+            'outtmpl': self.source_template(task),
+            'continuedl': True,
+            'http_chunk_size': Config.FETCH_CHUNK_SIZE,
+            'socket_timeout': Config.SOCKET_TIMEOUT,
+            'quiet': True,
+            'progress_hooks': [self._create_progress_hook(task, cancelled)],
+        }
+
+        def download():
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(task.url, download=True)
+                return ydl.prepare_filename(info)
+
+        fetched = asyncio.get_running_loop().run_in_executor(self.fetch_pool, bind("yt_dlp.download", download))
+        try:
+            task.source = await asyncio.shield(fetched)
+        except asyncio.CancelledError:
+            # Stage timeout: stop the thread at its next chunk, keeping the .part file. The retry
+            # continues that file, so it may only be queued once this thread has let go of it.
+            cancelled.set()
+            with contextlib.suppress(Exception):
+                await fetched
+            raise
+
+    async def _transcode(self, task: TrackTask):
+        await self._set_status(task, DownloadStatus.TRANSCODING)
+        staged = task.path + ".tmp"
+        try:
+            async with self.transcode_slots:
+                await transcode(task.source, staged, task.duration_ms)
+        except IntegrityError:
+            # The download itself is suspect; fetch it again on the next attempt
+            os.remove(task.source)
+            raise
+        os.remove(task.source)
+        task.source = staged
+
+    async def _tag(self, task: TrackTask):
+        await self._set_status(task, DownloadStatus.TAGGING)
+        await self.tagger.tag_track(task.source, task.track_id, task.spotify_track(), self.tag_pool, task.user_id)
+        # Only complete, verified and tagged files ever appear in the store
+        os.replace(task.source, task.path)
+
+    def _create_progress_hook(self, task: TrackTask, cancelled: threading.Event):
+        received = None
+
+        def progress_hook(d):
+            nonlocal received
+            if cancelled.is_set():
+                raise yt_dlp.utils.DownloadCancelled("Fetch timed out")
+            if d['status'] == 'downloading':
+                downloaded = d.get('downloaded_bytes', 0)
+                # Bytes resumed from a .part file were paid for on an earlier attempt
+                if received is None:
+                    received = downloaded
+                # Runs on the fetch thread between chunks, so sleeping here throttles the download
+                self.bandwidth.consume(downloaded - received)
+                received = max(received, downloaded)
+                total = d.get('total_bytes', 0) or d.get('total_bytes_estimate', 0)
+                if total > 0:
+                    task.progress = round((downloaded / total) * 100, 1)
+                    self.bus.publish(task.job_id, task.track_id, progress=task.progress)
+
+        return progress_hook
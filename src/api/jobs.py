@@ -0,0 +1,382 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+import logging
+from typing import Iterable, Optional
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+
+class QueueConfig:
+    DB = os.getenv("DOWNLOAD_QUEUE_DB", os.path.join(DATA_DIR, "downloads.db"))
+    # A claimed track goes back to the queue if its lease is not renewed in time
+    LEASE_SECONDS = float(os.getenv("DOWNLOAD_LEASE_SECONDS", "600"))
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    playlist_id TEXT UNIQUE,
+    priority INTEGER NOT NULL DEFAULT 0,
+    user_id TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_tracks (
+    job_id TEXT NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    track_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    url TEXT,
+    path TEXT,
+    error TEXT,
+    -- Name of the track's link in the job folder, once it has one
+    filename TEXT,
+    lease_owner TEXT,
+    lease_expires REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, track_id)
+);
+CREATE INDEX IF NOT EXISTS idx_job_tracks_claim ON job_tracks(status, lease_expires);
+-- Users who submitted a job; only they see it and its progress
+CREATE TABLE IF NOT EXISTS job_users (
+    job_id TEXT NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (job_id, user_id)
+);
+"""
+
+# Jobs visible to a user
+MEMBER = "EXISTS (SELECT 1 FROM job_users u WHERE u.job_id = jobs.id AND u.user_id = ?)"
+
+# Statuses a worker can (re)claim; in-progress ones only once their lease lapses
+CLAIMABLE = ("pending",)
+IN_PROGRESS = ("searching", "downloading", "transcoding", "tagging")
+FINISHED = ("completed", "failed", "skipped")
+
+
+def _placeholders(values: tuple) -> str:
+    return ", ".join("?" for _ in values)
+
+
+class DownloadQueue:
+    """Durable download queue stored in SQLite.
+
+    Each job's tracks are rows whose status moves through the pipeline.
+    Workers claim a track under a time-limited lease, so work held by a
+    worker that died (or a process that restarted) is picked up again.
+    Enqueueing is idempotent per (job, track).
+    """
+
+    def __init__(self, path: str = QueueConfig.DB):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SCHEMA)
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "priority" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "user_id" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN user_id TEXT")
+        self._conn.execute(
+            "INSERT OR IGNORE INTO job_users (job_id, user_id) SELECT id, user_id FROM jobs WHERE user_id IS NOT NULL"
+        )
+        if "filename" not in {row["name"] for row in self._conn.execute("PRAGMA table_info(job_tracks)")}:
+            self._conn.execute("ALTER TABLE job_tracks ADD COLUMN filename TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_order ON jobs(priority DESC, created_at)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _transaction(self, fn):
+        # Named after the method that wrote, e.g. "DownloadQueue.update"
+        operation = fn.__qualname__.split(".<locals>")[0]
+        with span("sqlite.transaction", **{"db.name": "downloads", "db.operation": operation}), self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def _query(self, sql: str, params: Iterable = ()) -> list[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, tuple(params)).fetchall()
+
+    def enqueue(self, name: str, folder: str, tracks: list[dict], playlist_id: Optional[str] = None,
+                priority: int = 0, user_id: Optional[str] = None) -> tuple[str, int]:
+        """Add tracks to a job and return (job id, number of tracks scheduled).
+
+        A playlist always maps to the same job. Tracks already in the job keep
+        their state, except failed ones, which are retried. Tracks of higher
+        priority jobs are claimed first. ``user_id`` is whose Spotify session
+        the job may use; the latest user to submit a job takes it over.
+        """
+        def write(conn: sqlite3.Connection):
+            now = time.time()
+            row = None
+            if playlist_id:
+                row = conn.execute("SELECT id FROM jobs WHERE playlist_id = ?", (playlist_id,)).fetchone()
+            if row:
+                job_id = row["id"]
+                conn.execute(
+                    "UPDATE jobs SET name = ?, priority = ?, user_id = COALESCE(?, user_id), updated_at = ? "
+                    "WHERE id = ?",
+                    (name, priority, user_id, now, job_id),
+                )
+            else:
+                job_id = uuid.uuid4().hex[:12]
+                conn.execute(
+                    "INSERT INTO jobs (id, name, folder, playlist_id, priority, user_id, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, name, folder, playlist_id, priority, user_id, now, now),
+                )
+            if user_id:
+                conn.execute("INSERT OR IGNORE INTO job_users (job_id, user_id) VALUES (?, ?)", (job_id, user_id))
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO job_tracks (job_id, track_id, position, data, status, updated_at) "
+                "VALUES (?, ?, ?, ?, 'pending', ?)",
+                [(job_id, track["track_id"], position, json.dumps(track), now) for position, track in enumerate(tracks)],
+            )
+            conn.execute(
+                "UPDATE job_tracks SET status = 'pending', attempts = 0, error = NULL, updated_at = ? "
+                "WHERE job_id = ? AND status = 'failed'",
+                (now, job_id),
+            )
+            return job_id, conn.total_changes - before
+
+        return self._transaction(write)
+
+    def reorder(self, job_id: str, track_ids: list[str]) -> list[dict]:
+        """Order a job's tracks like ``track_ids`` and drop the ones not in it.
+
+        Returns the dropped tracks so their files can be removed as well.
+        """
+        order = {}
+        for track_id in track_ids:
+            order.setdefault(track_id, len(order))
+
+        def write(conn: sqlite3.Connection):
+            rows = conn.execute(
+                "SELECT track_id, data, filename FROM job_tracks WHERE job_id = ?", (job_id,)
+            ).fetchall()
+            dropped = [row for row in rows if row["track_id"] not in order]
+            conn.executemany(
+                "DELETE FROM job_tracks WHERE job_id = ? AND track_id = ?",
+                [(job_id, row["track_id"]) for row in dropped],
+            )
+            conn.executemany(
+                "UPDATE job_tracks SET position = ? WHERE job_id = ? AND track_id = ?",
+                [(order[row["track_id"]], job_id, row["track_id"]) for row in rows if row["track_id"] in order],
+            )
+            return [{**json.loads(row["data"]), "track_id": row["track_id"], "filename": row["filename"]}
+                    for row in dropped]
+
+        return self._transaction(write)
+
+    def claim(self, owner: str) -> Optional[dict]:
+        """Lease the next runnable track to ``owner``."""
+        def take(conn: sqlite3.Connection):
+            now = time.time()
+            row = conn.execute(
+                "SELECT t.job_id, t.track_id, t.data, t.status, t.attempts, t.url, t.path, j.folder, j.priority, "
+                "j.user_id "
+                "FROM job_tracks t JOIN jobs j ON j.id = t.job_id "
+                f"WHERE t.status IN ({_placeholders(CLAIMABLE + IN_PROGRESS)}) "
+                "AND t.lease_expires < ? ORDER BY j.priority DESC, j.created_at, t.position LIMIT 1",
+                (*CLAIMABLE, *IN_PROGRESS, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE job_tracks SET lease_owner = ?, lease_expires = ?, updated_at = ? "
+                "WHERE job_id = ? AND track_id = ?",
+                (owner, now + QueueConfig.LEASE_SECONDS, now, row["job_id"], row["track_id"]),
+            )
+            return {
+                **json.loads(row["data"]),
+                "job_id": row["job_id"], "folder": row["folder"], "priority": row["priority"],
+                "user_id": row["user_id"], "attempts": row["attempts"],
+                "url": row["url"], "path": row["path"],
+            }
+
+        return self._transaction(take)
+
+    def update(self, job_id: str, track_id: str, owner: str, status: str, attempts: int = 0,
+               url: Optional[str] = None, path: Optional[str] = None, error: Optional[str] = None):
+        """Record a state transition; renews the lease, or releases it on a final state."""
+        now = time.time()
+        lease_expires = 0 if status in FINISHED or status == "pending" else now + QueueConfig.LEASE_SECONDS
+        lease_owner = None if lease_expires == 0 else owner
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE job_tracks SET status = ?, attempts = ?, url = ?, path = ?, error = ?, "
+            "lease_owner = ?, lease_expires = ?, updated_at = ? "
+            "WHERE job_id = ? AND track_id = ? AND (lease_owner IS NULL OR lease_owner = ?)",
+            (status, attempts, url, path, error, lease_owner, lease_expires, now, job_id, track_id, owner),
+        ))
+
+    def renew(self, job_id: str, track_id: str, owner: str):
+        """Extend ``owner``'s lease on a track without changing its state."""
+        now = time.time()
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE job_tracks SET lease_expires = ?, updated_at = ? "
+            "WHERE job_id = ? AND track_id = ? AND lease_owner = ?",
+            (now + QueueConfig.LEASE_SECONDS, now, job_id, track_id, owner),
+        ))
+
+    def assign_filename(self, job_id: str, track_id: str, filename: str, fallback: str) -> Optional[str]:
+        """Reserve the name of a track's link in its job folder and return it.
+
+        A track keeps the name it was given first. ``fallback`` is used when
+        another track of the job already holds ``filename``. Returns None if
+        the track has left the job meanwhile.
+        """
+        def write(conn: sqlite3.Connection):
+            row = conn.execute(
+                "SELECT filename FROM job_tracks WHERE job_id = ? AND track_id = ?", (job_id, track_id)
+            ).fetchone()
+            if row is None or row["filename"]:
+                return row and row["filename"]
+            taken = conn.execute(
+                "SELECT 1 FROM job_tracks WHERE job_id = ? AND filename = ? AND track_id != ?",
+                (job_id, filename, track_id),
+            ).fetchone()
+            chosen = fallback if taken else filename
+            conn.execute(
+                "UPDATE job_tracks SET filename = ? WHERE job_id = ? AND track_id = ?", (chosen, job_id, track_id)
+            )
+            return chosen
+
+        return self._transaction(write)
+
+    def recover(self) -> int:
+        """Return tracks whose lease lapsed, e.g. in a process that died, to the queue.
+
+        Tracks still leased are left alone: another process sharing the
+        queue may be working on them.
+        """
+        def reset(conn: sqlite3.Connection):
+            cursor = conn.execute(
+                "UPDATE job_tracks SET status = 'pending', lease_owner = NULL, lease_expires = 0 "
+                f"WHERE status IN ({_placeholders(IN_PROGRESS)}) AND lease_expires < ?",
+                (*IN_PROGRESS, time.time()),
+            )
+            return cursor.rowcount
+
+        recovered = self._transaction(reset)
+        if recovered:
+            logger.info(f"Recovered {recovered} interrupted downloads")
+        return recovered
+
+    def pending(self) -> int:
+        return self._query(
+            f"SELECT COUNT(*) AS n FROM job_tracks WHERE status NOT IN ({_placeholders(FINISHED)})", FINISHED
+        )[0]["n"]
+
+    def playlist_job(self, playlist_id: str) -> Optional[str]:
+        rows = self._query("SELECT id FROM jobs WHERE playlist_id = ?", (playlist_id,))
+        return rows[0]["id"] if rows else None
+
+    def _job_row(self, row: sqlite3.Row) -> dict:
+        counts = {status: 0 for status in CLAIMABLE + IN_PROGRESS + FINISHED}
+        for count in self._query(
+            "SELECT status, COUNT(*) AS n FROM job_tracks WHERE job_id = ? GROUP BY status", (row["id"],)
+        ):
+            counts[count["status"]] = count["n"]
+        total = sum(counts.values())
+        finished = sum(counts[status] for status in FINISHED)
+        return {
+            "id": row["id"],
+            "name": row["name"],
+            "folder": row["folder"],
+            "playlist_id": row["playlist_id"],
+            "user_id": row["user_id"],
+            "priority": row["priority"],
+            "created_at": row["created_at"],
+            "progress": (finished / total) * 100 if total else 100,
+            "counts": counts,
+        }
+
+    def job(self, job_id: str, user_id: Optional[str] = None) -> Optional[dict]:
+        """A job by id; with ``user_id``, only if that user submitted it."""
+        if user_id is None:
+            rows = self._query("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        else:
+            rows = self._query(f"SELECT * FROM jobs WHERE id = ? AND {MEMBER}", (job_id, user_id))
+        return self._job_row(rows[0]) if rows else None
+
+    def jobs(self, user_id: Optional[str] = None) -> list[dict]:
+        if user_id is None:
+            rows = self._query("SELECT * FROM jobs ORDER BY created_at DESC")
+        else:
+            rows = self._query(f"SELECT * FROM jobs WHERE {MEMBER} ORDER BY created_at DESC", (user_id,))
+        return [self._job_row(row) for row in rows]
+
+    def visible_jobs(self, user_id: str, job_ids: Iterable[str]) -> set[str]:
+        """Which of ``job_ids`` ``user_id`` submitted."""
+        job_ids = tuple(job_ids)
+        if not job_ids:
+            return set()
+        rows = self._query(
+            f"SELECT job_id FROM job_users WHERE user_id = ? AND job_id IN ({_placeholders(job_ids)})",
+            (user_id, *job_ids),
+        )
+        return {row["job_id"] for row in rows}
+
+    def user_track_ids(self, user_id: str) -> list[str]:
+        """Tracks in any of ``user_id``'s jobs."""
+        rows = self._query(
+            "SELECT DISTINCT t.track_id FROM job_tracks t JOIN job_users u ON u.job_id = t.job_id "
+            "WHERE u.user_id = ?",
+            (user_id,),
+        )
+        return [row["track_id"] for row in rows]
+
+    def job_tracks(self, job_id: str) -> list[dict]:
+        rows = self._query(
+            "SELECT track_id, data, status, attempts, url, path, error, filename FROM job_tracks "
+            "WHERE job_id = ? ORDER BY position",
+            (job_id,),
+        )
+        return [
+            {**json.loads(row["data"]), "track_id": row["track_id"], "status": row["status"],
+             "attempts": row["attempts"], "url": row["url"], "path": row["path"], "error": row["error"],
+             "filename": row["filename"]}
+            for row in rows
+        ]
+
+    # Async wrappers
+
+    async def aenqueue(self, name: str, folder: str, tracks: list[dict],
+                       playlist_id: Optional[str] = None, priority: int = 0,
+                       user_id: Optional[str] = None) -> tuple[str, int]:
+        return await asyncio.to_thread(self.enqueue, name, folder, tracks, playlist_id, priority, user_id)
+
+    async def aclaim(self, owner: str) -> Optional[dict]:
+        return await asyncio.to_thread(self.claim, owner)
+
+    async def aupdate(self, *args, **kwargs):
+        await asyncio.to_thread(self.update, *args, **kwargs)
+
+    async def arenew(self, job_id: str, track_id: str, owner: str):
+        await asyncio.to_thread(self.renew, job_id, track_id, owner)
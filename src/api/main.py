@@ -1,19 +1,133 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager
 from typing import Optional
-import requests
+import asyncio
+import httpx
 import uvicorn
 import os
 import dotenv
 
 dotenv.load_dotenv()
 
+from cache import ResponseCache
+from codec import CodecConfig, acompress, dumps, loads, negotiate
+from covers import CoverCache
+from downloader import Config as DownloadConfig, DownloadManager
+from jobs import DownloadQueue
+from matches import MatchCache
+from metrics import REGISTRY, MetricsConfig, MetricsMiddleware
+from progress import ProgressBus, SSESubscriber, Subscriber
+from tagging import Tagger
+from scheduler import RequestScheduler
+from spotify import SpotifyClient
+from store import LibraryStore
+from sync import LIKED_SONGS_ID, LibrarySync, liked_songs_id
+from tracing import TraceConfig, TracingMiddleware, tracer
+from views import LIKED, PLAYLIST, PLAYLISTS, SEARCH, shaper
+from vault import TokenVault
+
 # Configuration
 client_id = os.getenv("SPOTIFY_CLIENT_ID")
 client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
 redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI", "http://localhost/callback")
+# Tracebacks in error responses and verbose server logs; never in production
+debug = os.getenv("DEBUG", "false").lower() in ("1", "true", "yes")
+
+spotify = SpotifyClient(client_id)
+
+async def refresh_access_token(refresh_token: str) -> Optional[dict]:
+    try:
+        return await spotify.post_token(
+            data={
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+            },
+            auth=(client_id, client_secret),
+        )
+    except httpx.HTTPError:
+        return None
 
-app = FastAPI()
+vault = TokenVault(refresh_access_token)
+
+async def lookup_track(track_id: str, user_id: str) -> Optional[dict]:
+    # Used by background jobs, long after the request that queued them
+    token = await vault.token_for_user(user_id)
+    return await spotify.track(track_id, token) if token else None
+
+store = LibraryStore()
+library = LibrarySync(spotify, store, vault.token_for_user)
+covers = CoverCache(spotify.fetch_bytes)
+cache = ResponseCache()
+download_queue = DownloadQueue()
+matches = MatchCache()
+progress = ProgressBus()
+tagger = Tagger(store, covers, lookup_track)
+downloads = DownloadManager(download_queue, matches, progress, tagger)
+library.listeners.append(downloads.on_playlist_diff)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await spotify.start()
+    tracer.start()
+    progress.start()
+    await downloads.start()
+    try:
+        yield
+    finally:
+        await downloads.stop()
+        await progress.stop()
+        await tracer.stop()
+        await spotify.aclose()
+        store.close()
+        covers.close()
+        vault.close()
+        download_queue.close()
+        matches.close()
+
+app = FastAPI(lifespan=lifespan, debug=debug)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+
+# Read from the components' own counters at scrape time, so they cost nothing per request
+REGISTRY.counter_callback("cache_lookups_total", "Cache lookups by cache and result", lambda: {
+    ("response", "hit"): cache.hits, ("response", "stale"): cache.stale_hits, ("response", "miss"): cache.misses,
+    ("match", "hit"): matches.hits, ("match", "negative_hit"): matches.negative_hits, ("match", "miss"): matches.misses,
+}, ("cache", "result"))
+REGISTRY.gauge_callback("response_cache_entries", "Entries in the response cache", lambda: cache.stats()["entries"])
+REGISTRY.gauge_callback("response_cache_bytes", "Bytes held by the response cache", lambda: cache.stats()["bytes"])
+REGISTRY.counter_callback("upstream_flights_total", "Upstream fetches, led or joined by identical callers", lambda: {
+    "led": spotify.flights.calls - spotify.flights.shared, "shared": spotify.flights.shared,
+}, ("role",))
+REGISTRY.gauge_callback("spotify_queued_requests", "Requests waiting for a rate limit token",
+                        lambda: spotify.scheduler.stats()["queued"])
+REGISTRY.gauge_callback("download_in_flight_tracks", "Tracks claimed by the download pipeline",
+                        lambda: len(downloads.active))
+REGISTRY.gauge_callback("download_stage_queue_depth", "Tracks waiting in front of each pipeline stage",
+                        lambda: {name: inbox.qsize() for name, inbox in downloads.inboxes.items()}, ("stage",))
+REGISTRY.gauge_callback("download_paused", "1 while downloads are paused, e.g. for low disk space",
+                        lambda: int(downloads.paused_reason is not None))
+REGISTRY.counter_callback("download_bytes_total", "Bytes downloaded by fetch workers",
+                          lambda: downloads.bandwidth.bytes)
+REGISTRY.counter_callback("download_throttled_seconds_total", "Time fetch threads slept for the bandwidth cap",
+                          lambda: downloads.bandwidth.throttled_seconds)
+REGISTRY.gauge_callback("progress_clients", "Connected download progress clients", lambda: len(progress.clients))
+
+def upstream_error(e: httpx.HTTPError, message: str) -> HTTPException:
+    if isinstance(e, httpx.HTTPStatusError):
+        status = e.response.status_code
+        if status == 429:
+            retry_after = e.response.headers.get("Retry-After", "1")
+            return HTTPException(status_code=429, detail=f"{message}: rate limited by Spotify",
+                                 headers={"Retry-After": retry_after})
+        if status == 401:
+            return HTTPException(status_code=401, detail=f"{message}: {str(e)}")
+        if status >= 500:
+            return HTTPException(status_code=502, detail=f"{message}: {str(e)}")
+    elif isinstance(e, httpx.TransportError):
+        return HTTPException(status_code=502, detail=f"{message}: {str(e)}")
+    return HTTPException(status_code=400, detail=f"{message}: {str(e)}")
 
 def get_spotify_auth_url():
     scope = [
@@ -34,12 +148,11 @@ def get_spotify_auth_url():
         "user-follow-read",
         "user-follow-modify",
     ]
-    return f"https://accounts.spotify.com/authorize?response_type=code&client_id={client_id}&redirect_uri={redirect_uri}&scope={' '.join(scope)}"
+    return f"{spotify.accounts_url}/authorize?response_type=code&client_id={client_id}&redirect_uri={redirect_uri}&scope={' '.join(scope)}"
 
-def get_token_from_code(auth_code: str) -> dict:
+async def get_token_from_code(auth_code: str) -> dict:
     try:
-        response = requests.post(
-            "https://accounts.spotify.com/api/token",
+        return await spotify.post_token(
             data={
                 "grant_type": "authorization_code",
                 "code": auth_code,
@@ -47,30 +160,113 @@ def get_token_from_code(auth_code: str) -> dict:
             },
             auth=(client_id, client_secret),
         )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=400, detail=f"Token acquisition failed: {str(e)}")
 
-def refresh_access_token(refresh_token: str) -> Optional[dict]:
+async def spotify_token(request: HTTPConnection) -> str:
+    """Resolve the request's Authorization header to a Spotify access token.
+
+    Session ids issued by /callback are swapped for the session's current
+    access token; anything else is passed through as a raw Spotify token.
+    """
+    token = request.headers.get("Authorization")
+    if not token:
+        raise HTTPException(status_code=401, detail="Authorization token missing")
+    credential = token.partition(" ")[2]
+    if vault.is_session_id(credential):
+        access_token = await vault.access_token(credential)
+        if not access_token:
+            raise HTTPException(status_code=401, detail="Session expired, please log in again")
+        return access_token
+    return token
+
+def cache_scope(request: HTTPConnection) -> str:
+    # Keyed on what the client sent, which stays stable across token refreshes
+    return RequestScheduler.token_key(request.headers.get("Authorization", ""))
+
+def profile_fetch(token: str):
+    async def fetch(entry):
+        return await spotify.get_conditional("/me", token, etag=entry.upstream_etag if entry else None)
+    return fetch
+
+async def current_user(request: HTTPConnection, token: str = Depends(spotify_token)) -> str:
+    """The Spotify user ID behind the request: from the session, or else the cached /me profile."""
+    credential = request.headers.get("Authorization", "").partition(" ")[2]
+    if vault.is_session_id(credential):
+        user_id = await vault.user_id(credential)
+        if user_id:
+            return user_id
     try:
-        response = requests.post(
-            "https://accounts.spotify.com/api/token",
-            data={
-                "grant_type": "refresh_token",
-                "refresh_token": refresh_token,
-            },
-            auth=(client_id, client_secret),
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException:
-        return None
+        entry = await cache.get(cache_scope(request), "me", "me", profile_fetch(token))
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to fetch user profile")
+    if entry is None:
+        raise HTTPException(status_code=502, detail="Spotify returned no user profile")
+    return loads(entry.body)["id"]
+
+def library_playlist_id(playlist_id: str, user_id: str) -> str:
+    return liked_songs_id(user_id) if playlist_id == LIKED_SONGS_ID else playlist_id
+
+def view_shaper(view: str, fields: Optional[str]):
+    try:
+        return shaper(view, fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid fields: {e}")
+
+async def cached_response(request: Request, route: str, key: str, fetch, view: Optional[str] = None,
+                          fields: Optional[str] = None) -> Response:
+    # Each projection is cached on its own, so it is only computed and encoded on refresh
+    shape = view_shaper(view, fields) if view else None
+
+    async def shaped(entry):
+        result = await fetch(entry)
+        return None if result is None else (shape(result[0]), result[1])
+
+    if shape is not None:
+        entry = await cache.get(cache_scope(request), f"{key}:{fields or 'compact'}", route, shaped)
+    else:
+        entry = await cache.get(cache_scope(request), key, route, fetch)
+    if entry is None:
+        raise HTTPException(status_code=502, detail="Spotify returned no data")
+    encoding = negotiate(request.headers.get("Accept-Encoding"), entry.encoded)
+    headers = {"ETag": entry.etag_for(encoding), "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=entry.encoded[encoding] if encoding else entry.body, media_type="application/json",
+                    headers=headers)
+
+async def json_response(request: Request, data) -> Response:
+    """Encode and compress a response that is not cached."""
+    body = dumps(data)
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = negotiate(request.headers.get("Accept-Encoding")) if len(body) >= CodecConfig.MIN_SIZE else None
+    if encoding:
+        body = await acompress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/ping")
 async def ping():
     return {"ping": "pong"}
 
+@app.get("/metrics")
+async def metrics():
+    return Response(REGISTRY.render(), media_type=MetricsConfig.CONTENT_TYPE)
+
+@app.get("/scheduler")
+async def scheduler_stats():
+    return spotify.scheduler.stats()
+
+@app.get("/cache")
+async def cache_stats():
+    return {
+        **cache.stats(),
+        "upstream_calls": spotify.flights.calls,
+        "upstream_shared": spotify.flights.shared,
+    }
+
 @app.get("/")
 async def auth():
     auth_url = get_spotify_auth_url()
@@ -79,120 +275,338 @@ async def auth():
 @app.get("/callback")
 async def callback(code: str):
     try:
-        token_data = get_token_from_code(code)
-        return {"token": token_data}
+        token_data = await get_token_from_code(code)
+        profile = await spotify.get("/me", f"Bearer {token_data['access_token']}")
+        session_id = await vault.create(token_data, profile["id"])
+        # The refresh token never leaves the server; the client only gets the session id
+        return {"token": {
+            "access_token": session_id,
+            "token_type": "Bearer",
+            "expires_in": token_data.get("expires_in"),
+            "scope": token_data.get("scope"),
+        }}
     except HTTPException as e:
         raise e
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to fetch user profile")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/logout")
+async def logout(request: Request):
+    credential = request.headers.get("Authorization", "").partition(" ")[2]
+    if vault.is_session_id(credential):
+        await vault.revoke(credential)
+        cache.invalidate(cache_scope(request))
+    return {"message": "Logged out"}
+
 @app.get("/playlists")
-async def get_playlists(request: Request):
-    token = request.headers.get("Authorization")
-    if not token:
-        raise HTTPException(status_code=401, detail="Authorization token missing")
+async def get_playlists(request: Request, fields: Optional[str] = None, token: str = Depends(spotify_token)):
+    async def fetch(entry):
+        # Not revalidated: an ETag only covers one page, and a change on a later page leaves the first one's as is
+        items = [playlist async for playlist in spotify.all_playlists(token)]
+        return {"items": items, "total": len(items)}, None
+
     try:
-        response = requests.get(
-            "https://api.spotify.com/v1/me/playlists",
-            headers={"Authorization": token},
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        raise HTTPException(status_code=400, detail=f"Failed to fetch playlists: {str(e)}")
+        return await cached_response(request, "playlists", "playlists", fetch, PLAYLISTS, fields)
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to fetch playlists")
 
 @app.get("/playlist/{playlist_id}")
-async def get_playlist(request: Request, playlist_id: str):
-    token = request.headers.get("Authorization")
-    if not token:
-        raise HTTPException(status_code=401, detail="Authorization token missing")
+async def get_playlist(request: Request, playlist_id: str, fields: Optional[str] = None,
+                       token: str = Depends(spotify_token)):
+    async def fetch(entry):
+        result = await spotify.full_playlist_conditional(playlist_id, token,
+                                                         entry.upstream_etag if entry else None)
+        if result is not None:
+            covers.remember(result[0]["tracks"]["items"])
+        return result
+
     try:
-        response = requests.get(
-            f"https://api.spotify.com/v1/playlists/{playlist_id}",
-            headers={"Authorization": token},
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        raise HTTPException(status_code=400, detail=f"Failed to fetch playlist: {str(e)}")
+        return await cached_response(request, "playlist", f"playlist:{playlist_id}", fetch, PLAYLIST, fields)
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to fetch playlist")
 
 
 @app.get("/me")
-async def get_user_profile(request: Request):
-    token = request.headers.get("Authorization")
-    if not token:
-        raise HTTPException(status_code=401, detail="Authorization token missing")
+async def get_user_profile(request: Request, token: str = Depends(spotify_token)):
     try:
-        response = requests.get(
-            "https://api.spotify.com/v1/me",
-            headers={"Authorization": token},
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        raise HTTPException(status_code=400, detail=f"Failed to fetch user profile: {str(e)}")
+        return await cached_response(request, "me", "me", profile_fetch(token))
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to fetch user profile")
 
+@app.get("/liked")
+async def get_liked_tracks(request: Request, fields: Optional[str] = None, token: str = Depends(spotify_token)):
+    async def fetch(entry):
+        items = [item async for item in spotify.saved_tracks(token)]
+        return {"items": items, "total": len(items)}, None
 
-@app.get("/download/playlist/{playlist_id}")
-async def download_playlist(request: Request, playlist_id: str):
-    token = request.headers.get("Authorization")
-    if not token:
-        raise HTTPException(status_code=401, detail="Authorization token missing")
     try:
-        response = requests.get(
-            f"https://api.spotify.com/v1/playlists/{playlist_id}",
-            headers={"Authorization": token},
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        raise HTTPException(status_code=400, detail=f"Failed to fetch playlist: {str(e)}")
+        return await cached_response(request, "liked", "liked", fetch, LIKED, fields)
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to fetch liked tracks")
 
-    playlist_tracks = response.json().get("tracks", {}).get("items", [])
-    for track in playlist_tracks:
-        track_name = track.get("track", {}).get("name")
-        track_artist = track.get("track", {}).get("artists", [{}])[0].get("name")
-        print(f"Downloading {track_name} by {track_artist}")
 
-    return {"playlist": playlist_tracks}
+@app.post("/sync")
+async def sync_library(request: Request, token: str = Depends(spotify_token),
+                       user_id: str = Depends(current_user)):
+    try:
+        summary = await library.sync(token, user_id)
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to sync library")
+    if summary["changed"] or summary["deleted"]:
+        cache.invalidate(cache_scope(request))
+    return summary
+
+
+@app.get("/library/playlists")
+async def get_library_playlists(request: Request, fields: Optional[str] = None,
+                                user_id: str = Depends(current_user)):
+    shape = view_shaper(PLAYLISTS, fields)
+    items = await store.aplaylists(user_id)
+    playlists = {"items": items, "total": len(items)}
+    return await json_response(request, shape(playlists) if shape else playlists)
+
+
+@app.get("/library/playlist/{playlist_id}")
+async def get_library_playlist(request: Request, playlist_id: str, fields: Optional[str] = None,
+                               user_id: str = Depends(current_user)):
+    shape = view_shaper(PLAYLIST, fields)
+    playlist_id = library_playlist_id(playlist_id, user_id)
+    playlist = await store.aplaylist(playlist_id, user_id)
+    if playlist is None:
+        raise HTTPException(status_code=404, detail=f"Playlist {playlist_id} has not been synced")
+    items = await store.aplaylist_items(playlist_id)
+    playlist["tracks"] = {"items": items, "total": len(items)}
+    return await json_response(request, shape(playlist) if shape else playlist)
+
+
+@app.get("/covers/{album_id}")
+async def get_cover(request: Request, album_id: str, size: Optional[int] = None):
+    async def album_images():
+        images = covers.known_images(album_id) or await store.aalbum_images(album_id)
+        if images:
+            return images
+        if not request.headers.get("Authorization"):
+            return []
+        album = await spotify.get(f"/albums/{album_id}", await spotify_token(request))
+        return album.get("images") or []
 
-@app.get("/download/track/{track_id}")
-async def download_track(request: Request, track_id: str):
-    token = request.headers.get("Authorization")
-    if not token:
-        raise HTTPException(status_code=401, detail="Authorization token missing")
     try:
-        response = requests.get(
-            f"https://api.spotify.com/v1/tracks/{track_id}",
-            headers={"Authorization": token},
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        raise HTTPException(status_code=400, detail=f"Failed to fetch track: {str(e)}")
+        digest = await covers.get(album_id, album_images, size)
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to fetch album art")
+    if not digest:
+        raise HTTPException(status_code=404, detail=f"No album art for {album_id}")
+
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=604800"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+    media_type = await asyncio.to_thread(covers.media_type, digest)
+    return FileResponse(covers.path_for(digest), media_type=media_type, headers=headers)
+
+
+@app.post("/download/playlist/{playlist_id}", status_code=202)
+async def download_playlist(request: Request, playlist_id: str, priority: int = DownloadConfig.BULK_PRIORITY,
+                            token: str = Depends(spotify_token), user_id: str = Depends(current_user)):
+    # Prefer the synced copy; fall back to Spotify for playlists not synced yet
+    playlist_id = library_playlist_id(playlist_id, user_id)
+    playlist = await store.aplaylist(playlist_id, user_id)
+    if playlist is not None:
+        items = await store.aplaylist_items(playlist_id)
+    else:
+        try:
+            playlist = await spotify.full_playlist(playlist_id, token)
+        except httpx.HTTPError as e:
+            raise upstream_error(e, "Failed to fetch playlist")
+        items = playlist["tracks"]["items"]
+
+    # Callers may order their playlists, but never ahead of interactive downloads
+    priority = min(priority, DownloadConfig.INTERACTIVE_PRIORITY - 1)
+    return await downloads.submit(playlist.get("name") or playlist_id, [item.get("track") for item in items],
+                                  playlist_id, priority, user_id)
+
+@app.post("/download/track/{track_id}", status_code=202)
+async def download_track(request: Request, track_id: str, token: str = Depends(spotify_token),
+                         user_id: str = Depends(current_user)):
+    try:
+        track = await spotify.track(track_id, token)
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to fetch track")
+    if track is None:
+        raise HTTPException(status_code=404, detail=f"Track {track_id} not found")
+
+    return await downloads.submit("Singles", [track], priority=DownloadConfig.INTERACTIVE_PRIORITY,
+                                  user_id=user_id)
+
+@app.get("/download/jobs")
+async def get_download_jobs(request: Request, user_id: str = Depends(current_user)):
+    return await json_response(request, {"jobs": await downloads.jobs(user_id), "pipeline": downloads.stats(),
+                                         "matches": matches.stats(), "progress": progress.stats()})
+
+@app.get("/download/jobs/{job_id}")
+async def get_download_job(request: Request, job_id: str, user_id: str = Depends(current_user)):
+    job = await downloads.job(job_id, user_id=user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Download job {job_id} not found")
+    return await json_response(request, job)
 
-    track_name = response.json().get("name")
-    track_artist = response.json().get("artists", [{}])[0].get("name")
-    print(f"Downloading {track_name} by {track_artist}")
+async def progress_job(job_id: Optional[str], playlist_id: Optional[str], user_id: str) -> Optional[str]:
+    """The job a progress client follows, if any; other users' jobs look like missing ones."""
+    if playlist_id and not job_id:
+        job_id = await asyncio.to_thread(download_queue.playlist_job, library_playlist_id(playlist_id, user_id))
+        if job_id is None:
+            raise HTTPException(status_code=404, detail=f"Playlist {playlist_id} has no download job")
+    if job_id is not None and await asyncio.to_thread(download_queue.job, job_id, user_id) is None:
+        raise HTTPException(status_code=404, detail=f"Download job {job_id} not found")
+    return job_id
 
-    return {"track": response.json()}
+@app.post("/download/retag", status_code=202)
+async def retag_downloads(ids: Optional[str] = None, user_id: str = Depends(current_user)):
+    """Re-apply stored metadata and cover art to the caller's downloaded files, e.g. after a sync changed them."""
+    owned = await asyncio.to_thread(download_queue.user_track_ids, user_id)
+    if ids:
+        owned = set(owned)
+        track_ids = [track_id for track_id in ids.split(",") if track_id in owned]
+    else:
+        track_ids = owned
+    if not tagger.start_retag(downloads.store_dir, track_ids):
+        raise HTTPException(status_code=409, detail="A re-tag is already running")
+    return {"started": True, "files": len(track_ids)}
+
+@app.get("/download/retag", dependencies=[Depends(current_user)])
+async def retag_status():
+    return tagger.retag_status
+
+@app.websocket("/ws/downloads")
+async def download_progress(websocket: WebSocket, job_id: Optional[str] = None,
+                            playlist_id: Optional[str] = None, since: Optional[int] = None):
+    await websocket.accept()
+    try:
+        user_id = await current_user(websocket, await spotify_token(websocket))
+        job_id = await progress_job(job_id, playlist_id, user_id)
+    except HTTPException as e:
+        await websocket.close(code=4000 + e.status_code, reason=e.detail)
+        return
+
+    async def visible(job_ids: set[str]) -> set[str]:
+        return await asyncio.to_thread(download_queue.visible_jobs, user_id, job_ids)
+
+    # Without a job, the client follows all of its user's jobs
+    subscriber = Subscriber.for_websocket(websocket, visible if job_id is None else None)
+    try:
+        if not await progress.subscribe(subscriber, job_id, since, lambda: downloads.snapshot(job_id)):
+            await websocket.close(code=4404, reason=f"Download job {job_id} not found")
+            return
+        # Frames are pushed by the progress bus; reading just notices the close
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        progress.unsubscribe(subscriber, job_id)
+
+@app.get("/download/events")
+async def download_events(request: Request, job_id: Optional[str] = None, playlist_id: Optional[str] = None,
+                          since: Optional[int] = None, user_id: str = Depends(current_user)):
+    job_id = await progress_job(job_id, playlist_id, user_id)
+    if job_id is None:
+        raise HTTPException(status_code=400, detail="job_id or playlist_id is required")
+    last_event_id = request.headers.get("Last-Event-ID")
+    if since is None and last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+
+    subscriber = SSESubscriber()
+    if not await progress.subscribe(subscriber, job_id, since, lambda: downloads.snapshot(job_id)):
+        raise HTTPException(status_code=404, detail=f"Download job {job_id} not found")
+
+    async def stream():
+        try:
+            async for message in subscriber.stream():
+                yield message
+        finally:
+            progress.unsubscribe(subscriber, job_id)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def debug_api():
+    if not TraceConfig.DEBUG_API:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+@app.get("/debug/tracing", dependencies=[Depends(debug_api)])
+async def tracing_status():
+    return tracer.stats()
+
+@app.post("/debug/tracing/routes", dependencies=[Depends(debug_api)])
+async def trace_route(route: str, count: int = 1, profile: bool = False):
+    """Trace the next ``count`` requests to a route template such as ``/playlist/{playlist_id}``."""
+    if route not in {getattr(candidate, "path", None) for candidate in app.routes}:
+        raise HTTPException(status_code=404, detail=f"No route {route}")
+    tracer.arm(route, count, profile)
+    return tracer.stats()["armed_routes"]
+
+@app.post("/debug/tracing/jobs/{job_id}", dependencies=[Depends(debug_api)])
+async def trace_job(job_id: str, profile: bool = False, seconds: float = TraceConfig.PROFILE_MAX_SECONDS):
+    """Trace a download job's pipeline stages until stopped or ``seconds`` pass."""
+    if await downloads.job(job_id, include_tracks=False) is None:
+        raise HTTPException(status_code=404, detail=f"Download job {job_id} not found")
+    job = tracer.trace_job(job_id, profile, seconds)
+    return {"job_id": job_id, "trace_id": job.trace_id, "profile": job.profile.name if job.profile else None}
+
+@app.delete("/debug/tracing/jobs/{job_id}", dependencies=[Depends(debug_api)])
+async def untrace_job(job_id: str):
+    job = await asyncio.to_thread(tracer.untrace_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Download job {job_id} is not being traced")
+    return {"job_id": job_id, "trace_id": job.trace_id, "profile": job.profile.name if job.profile else None}
+
+@app.get("/debug/profiles", dependencies=[Depends(debug_api)])
+async def list_profiles():
+    def scan():
+        if not os.path.isdir(TraceConfig.PROFILE_DIR):
+            return []
+        return sorted(name[:-len(".folded")] for name in os.listdir(TraceConfig.PROFILE_DIR) if name.endswith(".folded"))
+    return {"profiles": await asyncio.to_thread(scan)}
+
+@app.get("/debug/profiles/{name}", dependencies=[Depends(debug_api)])
+async def get_profile(name: str):
+    """A profile in folded-stack form, ready for flamegraph.pl or speedscope."""
+    path = os.path.join(TraceConfig.PROFILE_DIR, f"{os.path.basename(name)}.folded")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=f"Profile {name} not found")
+    return FileResponse(path, media_type="text/plain", filename=f"{os.path.basename(name)}.folded")
+
+
+@app.get("/tracks")
+async def get_tracks(request: Request, ids: str, audio_features: bool = False, token: str = Depends(spotify_token)):
+    track_ids = [track_id for track_id in ids.split(",") if track_id]
+    try:
+        lookups = [spotify.tracks(track_ids, token)]
+        if audio_features:
+            lookups.append(spotify.audio_features(track_ids, token))
+        results = await asyncio.gather(*lookups)
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to fetch tracks")
+    response = {"tracks": results[0]}
+    if audio_features:
+        response["audio_features"] = results[1]
+    return await json_response(request, response)
 
 
 @app.get("/search/tracks")
-async def search_tracks(request: Request, query: str):
-    token = request.headers.get("Authorization")
-    if not token:
-        raise HTTPException(status_code=401, detail="Authorization token missing")
+async def search_tracks(request: Request, query: str, fields: Optional[str] = None,
+                        token: str = Depends(spotify_token)):
+    async def fetch(entry):
+        return await spotify.get_conditional("/search", token, params={"q": query, "type": "track"},
+                                             etag=entry.upstream_etag if entry else None)
+
     try:
-        response = requests.get(
-            "https://api.spotify.com/v1/search",
-            headers={"Authorization": token},
-            params={"q": query, "type": "track"},
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        raise HTTPException(status_code=400, detail=f"Failed to search tracks: {str(e)}")
+        return await cached_response(request, "search", f"search:{query}", fetch, SEARCH, fields)
+    except httpx.HTTPError as e:
+        raise upstream_error(e, "Failed to search tracks")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=5000, log_level="debug" if debug else "info")
\ No newline at end of file
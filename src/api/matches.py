@@ -0,0 +1,180 @@
+import os
+import re
+import time
+import sqlite3
+import asyncio
+import difflib
+import threading
+import unicodedata
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+
+class MatchConfig:
+    DB = os.getenv("MATCH_CACHE_DB", os.path.join(DATA_DIR, "matches.db"))
+    # Search results considered per track
+    CANDIDATES = int(os.getenv("MATCH_CANDIDATES", "5"))
+    # Candidates further than this from the Spotify duration are rejected
+    MAX_DURATION_DELTA = float(os.getenv("MATCH_MAX_DURATION_DELTA", "20"))
+    MIN_SCORE = float(os.getenv("MATCH_MIN_SCORE", "0.5"))
+    # A close duration alone never makes a match
+    MIN_TITLE_SCORE = float(os.getenv("MATCH_MIN_TITLE_SCORE", "0.5"))
+    # How long a track with no acceptable match is not searched again
+    NEGATIVE_TTL = float(os.getenv("MATCH_NEGATIVE_TTL", str(24 * 3600)))
+
+
+# Versions that are rarely what the Spotify track is, unless its own title says so
+UNWANTED = ("live", "cover", "remix", "karaoke", "instrumental", "acoustic", "8d", "sped up", "slowed",
+            "reverb", "nightcore", "lyrics video", "reaction")
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+
+def _base_title(name: str) -> str:
+    # "Song - Remastered 2011" / "Song (feat. X)" -> "Song"
+    return re.split(r" - |\(|\[", name)[0]
+
+
+@dataclass
+class Match:
+    url: str
+    video_id: Optional[str]
+    title: str
+    channel: str
+    duration: Optional[float]
+    score: float
+
+
+def score_candidate(name: str, artists: list[str], duration_ms: Optional[int], entry: dict) -> Optional[float]:
+    """Score a flat ytsearch entry against a Spotify track, in 0..1; None rejects it."""
+    title = normalize(entry.get("title"))
+    channel = normalize(entry.get("channel") or entry.get("uploader"))
+    wanted = normalize(_base_title(name))
+    artist = normalize(artists[0]) if artists else ""
+
+    duration_score = 0.5
+    if duration_ms and entry.get("duration"):
+        delta = abs(float(entry["duration"]) - duration_ms / 1000)
+        if delta > MatchConfig.MAX_DURATION_DELTA:
+            return None
+        duration_score = 1 - delta / MatchConfig.MAX_DURATION_DELTA
+
+    words = wanted.split()
+    coverage = sum(word in title.split() for word in words) / len(words) if words else 0.0
+    similarity = difflib.SequenceMatcher(None, f"{artist} {wanted}".strip(), title).ratio()
+    title_score = max(coverage, similarity)
+    if title_score < MatchConfig.MIN_TITLE_SCORE:
+        return None
+
+    artist_score = 1.0 if artist and (artist in title or artist in channel) else 0.0
+    channel_score = 0.0
+    if channel.endswith(" topic") or "vevo" in channel or (artist and channel.startswith(artist)):
+        channel_score = 1.0
+    elif "official audio" in title:
+        channel_score = 0.5
+
+    score = 0.4 * duration_score + 0.35 * title_score + 0.15 * artist_score + 0.1 * channel_score
+    spotify_title = normalize(name)
+    for word in UNWANTED:
+        if re.search(rf"\b{word}\b", title) and not re.search(rf"\b{word}\b", spotify_title):
+            score -= 0.3
+    return score
+
+
+def best_match(name: str, artists: list[str], duration_ms: Optional[int], entries: list[dict]) -> Optional[Match]:
+    best = None
+    for entry in entries:
+        url = entry.get("url") or entry.get("webpage_url")
+        score = score_candidate(name, artists, duration_ms, entry) if url else None
+        if score is None or score < MatchConfig.MIN_SCORE or (best and best.score >= score):
+            continue
+        best = Match(url, entry.get("id"), entry.get("title") or "", entry.get("channel") or entry.get("uploader") or "",
+                     entry.get("duration"), round(score, 4))
+    return best
+
+
+class MatchCache:
+    """Persistent Spotify track id -> chosen YouTube video mapping.
+
+    Tracks without an acceptable candidate are remembered for
+    ``NEGATIVE_TTL`` so repeated runs do not search for them again.
+    """
+
+    def __init__(self, path: str = MatchConfig.DB):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS matches ("
+            "track_id TEXT PRIMARY KEY, url TEXT NOT NULL, video_id TEXT, title TEXT, channel TEXT, "
+            "duration REAL, score REAL, matched_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS misses (track_id TEXT PRIMARY KEY, expires_at REAL NOT NULL);"
+        )
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def lookup(self, track_id: str) -> tuple[Optional[Match], bool]:
+        """Return (match, known_missing) for a track."""
+        with span("cache.match", track_id=track_id), self._lock:
+            row = self._conn.execute(
+                "SELECT url, video_id, title, channel, duration, score FROM matches WHERE track_id = ?", (track_id,)
+            ).fetchone()
+            missing = row is None and self._conn.execute(
+                "SELECT 1 FROM misses WHERE track_id = ? AND expires_at > ?", (track_id, time.time())
+            ).fetchone() is not None
+        if row is not None:
+            self.hits += 1
+            return Match(*row), False
+        if missing:
+            self.negative_hits += 1
+        else:
+            self.misses += 1
+        return None, missing
+
+    def remember(self, track_id: str, match: Optional[Match]):
+        now = time.time()
+        with span("sqlite.transaction", **{"db.name": "matches", "db.operation": "MatchCache.remember"}), self._lock:
+            if match is None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO misses (track_id, expires_at) VALUES (?, ?)",
+                    (track_id, now + MatchConfig.NEGATIVE_TTL),
+                )
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO matches (track_id, url, video_id, title, channel, duration, score, matched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (track_id, match.url, match.video_id, match.title, match.channel, match.duration, match.score, now),
+            )
+            self._conn.execute("DELETE FROM misses WHERE track_id = ?", (track_id,))
+
+    def forget(self, track_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM matches WHERE track_id = ?", (track_id,))
+            self._conn.execute("DELETE FROM misses WHERE track_id = ?", (track_id,))
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "negative_hits": self.negative_hits, "misses": self.misses}
+
+    # Async wrappers
+
+    async def alookup(self, track_id: str) -> tuple[Optional[Match], bool]:
+        return await asyncio.to_thread(self.lookup, track_id)
+
+    async def aremember(self, track_id: str, match: Optional[Match]):
+        await asyncio.to_thread(self.remember, track_id, match)
@@ -0,0 +1,229 @@
+import time
+import bisect
+import threading
+from typing import Callable, Iterable, Optional, Union
+
+
+class MetricsConfig:
+    # Upper bounds in seconds; +Inf is always added
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Sharded:
+    """Per-thread value maps, merged when scraped.
+
+    Each thread only ever writes its own dict, so recording needs no lock
+    and cannot lose updates; the lock below is taken once per thread.
+    """
+
+    def __init__(self):
+        self._shards: list[dict] = []
+        self._local = threading.local()
+        self._register = threading.Lock()
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._register:
+                self._shards.append(shard)
+            return shard
+
+    def _snapshots(self) -> Iterable[dict]:
+        with self._register:
+            shards = list(self._shards)
+        # dict.copy() runs without releasing the GIL, so it never sees a resize
+        return (shard.copy() for shard in shards)
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__()
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+
+    def inc(self, *labels, amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self) -> dict[tuple, float]:
+        merged: dict[tuple, float] = {}
+        for shard in self._snapshots():
+            for labels, value in shard.items():
+                merged[labels] = merged.get(labels, 0) + value
+        return merged
+
+    def render(self) -> Iterable[str]:
+        for labels, value in sorted(self.values().items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (),
+                 buckets: tuple = MetricsConfig.LATENCY_BUCKETS):
+        super().__init__()
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # One slot per bucket, one for +Inf, then the sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def values(self) -> dict[tuple, list]:
+        merged: dict[tuple, list] = {}
+        for shard in self._snapshots():
+            for labels, counts in shard.items():
+                total = merged.setdefault(labels, [0] * len(counts))
+                for index, count in enumerate(list(counts)):
+                    total[index] += count
+        return merged
+
+    def render(self) -> Iterable[str]:
+        for labels, counts in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(counts[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram, self.labels = histogram, labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Callback:
+    """A gauge or counter read from existing state when scraped.
+
+    ``read`` returns a number, or a ``{label values: number}`` dict when the
+    metric has labels. Nothing is recorded on the hot path at all.
+    """
+
+    def __init__(self, name: str, help: str, kind: str, read: Callable[[], Union[float, dict]],
+                 labelnames: tuple = ()):
+        self.name, self.help, self.kind, self.read, self.labelnames = name, help, kind, read, tuple(labelnames)
+
+    def render(self) -> Iterable[str]:
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Union[Counter, Histogram, Callback]] = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (),
+                  buckets: tuple = MetricsConfig.LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge_callback(self, name: str, help: str, read: Callable, labelnames: tuple = ()) -> Callback:
+        return self._add(Callback(name, help, "gauge", read, labelnames))
+
+    def counter_callback(self, name: str, help: str, read: Callable, labelnames: tuple = ()) -> Callback:
+        return self._add(Callback(name, help, "counter", read, labelnames))
+
+    def render(self) -> str:
+        """Everything in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "http_requests_total", "HTTP requests handled, by route and status", ("method", "route", "status"))
+HTTP_LATENCY = REGISTRY.histogram(
+    "http_request_duration_seconds", "Time until response headers are sent, by route", ("method", "route"))
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting HTTP requests and timing them to the response headers.
+
+    Routes are labelled with their path template (``/playlist/{playlist_id}``)
+    so label cardinality stays bounded; unmatched paths share one label.
+    Streaming responses are timed to their first byte, not their end.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status: Optional[int] = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                HTTP_LATENCY.observe(time.perf_counter() - started, scope["method"], _route(scope))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUESTS.inc(scope["method"], _route(scope), str(status or 500))
+
+
+def _route(scope) -> str:
+    # The router stores the matched route in the shared scope
+    return getattr(scope.get("route"), "path", "unmatched")
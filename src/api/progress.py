@@ -0,0 +1,241 @@
+import os
+import asyncio
+import threading
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import WebSocket
+
+from codec import dumps
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressConfig:
+    # Frames per second sent to clients; updates in between are coalesced
+    RATE_HZ = float(os.getenv("PROGRESS_RATE_HZ", "4"))
+    # A client that cannot take a frame within this many seconds is dropped
+    SEND_TIMEOUT = float(os.getenv("PROGRESS_SEND_TIMEOUT", "2"))
+    # Frames kept per job so a reconnecting client can resume from its last seq
+    REPLAY_FRAMES = int(os.getenv("PROGRESS_REPLAY_FRAMES", "256"))
+    MAX_TOPICS = int(os.getenv("PROGRESS_MAX_TOPICS", "256"))
+    SSE_BUFFER = int(os.getenv("PROGRESS_SSE_BUFFER", "64"))
+
+
+def encode(data: Any) -> str:
+    return dumps(data).decode()
+
+
+def _unbounded() -> Optional[int]:
+    return None
+
+
+@dataclass(eq=False)
+class Subscriber:
+    """One connected client; ``send`` gets (seq, encoded frame).
+
+    ``room`` is how many more frames the client can buffer without reading,
+    or None when ``send`` waits for it instead. ``visible`` narrows what a
+    client subscribed to everything sees: given job ids, it returns the ones
+    the client may follow.
+    """
+    send: Callable[[int, str], Awaitable[None]]
+    close: Callable[[], Awaitable[None]]
+    room: Callable[[], Optional[int]] = _unbounded
+    visible: Optional[Callable[[set[str]], Awaitable[set[str]]]] = None
+
+    @classmethod
+    def for_websocket(cls, websocket: WebSocket,
+                      visible: Optional[Callable[[set[str]], Awaitable[set[str]]]] = None) -> "Subscriber":
+        return cls(lambda seq, frame: websocket.send_text(frame), websocket.close, visible=visible)
+
+
+class SSESubscriber(Subscriber):
+    """Buffers frames for a Server-Sent Events response; overflowing the buffer counts as slow."""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=ProgressConfig.SSE_BUFFER)
+        super().__init__(self._put, self._close, self._room)
+
+    def _room(self) -> int:
+        return self.queue.maxsize - self.queue.qsize()
+
+    async def _put(self, seq: int, frame: str):
+        self.queue.put_nowait(f"id: {seq}\ndata: {frame}\n\n")
+
+    async def _close(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def stream(self):
+        while (message := await self.queue.get()) is not None:
+            yield message
+
+
+@dataclass
+class Topic:
+    seq: int = 0
+    frames: deque = field(default_factory=lambda: deque(maxlen=ProgressConfig.REPLAY_FRAMES))
+    subscribers: set = field(default_factory=set)
+
+
+class ProgressBus:
+    """Coalescing progress broadcaster for download state.
+
+    ``publish`` may be called from any thread (yt-dlp progress hooks run on
+    fetch threads) and only merges the update into a pending dict. A single
+    ticker drains that dict ``RATE_HZ`` times a second. Each job is a topic
+    with its own sequence numbers: its updates from one tick become one
+    numbered frame, sent concurrently to that job's subscribers only and
+    kept briefly for replay. Unscoped clients get one combined frame per
+    tick.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: dict[tuple[str, str], dict[str, Any]] = {}
+        self._topics: OrderedDict[str, Topic] = OrderedDict()
+        self.clients: set[Subscriber] = set()
+        self._ticker: Optional[asyncio.Task] = None
+        self.frames = 0
+        self.dropped_clients = 0
+
+    def publish(self, job_id: str, track_id: str, **fields):
+        with self._lock:
+            update = self._pending.setdefault((job_id, track_id), {"job_id": job_id, "track_id": track_id})
+            update.update(fields)
+
+    def _topic(self, job_id: str) -> Topic:
+        topic = self._topics.get(job_id)
+        if topic is None:
+            topic = self._topics[job_id] = Topic()
+            # Forget the least recently active topics nobody is watching
+            for stale in [key for key, value in self._topics.items() if not value.subscribers]:
+                if len(self._topics) <= ProgressConfig.MAX_TOPICS:
+                    break
+                del self._topics[stale]
+        self._topics.move_to_end(job_id)
+        return topic
+
+    async def subscribe(self, subscriber: Subscriber, job_id: Optional[str] = None, since: Optional[int] = None,
+                        snapshot: Optional[Callable[[], Awaitable[Optional[dict]]]] = None) -> bool:
+        """Register a client, for one job or (without ``job_id``) for everything.
+
+        A job subscriber resuming from ``since`` is sent the frames it missed
+        if they are still buffered and fit in the client's own buffer;
+        otherwise it gets a snapshot first. Returns False when the job does
+        not exist.
+        """
+        if job_id is None:
+            self.clients.add(subscriber)
+            return True
+
+        topic = self._topic(job_id)
+        last = since if since is not None else -1
+        fresh = since is None or not topic.frames or topic.frames[0][0] > since + 1 or since > topic.seq
+        while True:
+            if fresh:
+                last = topic.seq
+                state = await snapshot() if snapshot else None
+                if snapshot and state is None:
+                    return False
+                await subscriber.send(last, encode({"type": "snapshot", "job_id": job_id, "seq": last, "job": state}))
+            # Catch up on frames produced meanwhile; no await between the final check and joining
+            missed = [(seq, frame) for seq, frame in topic.frames if seq > last]
+            if not missed:
+                break
+            # A buffering client takes the whole replay before it reads anything;
+            # when that would not fit, a snapshot (one frame) replaces it
+            room = subscriber.room()
+            fresh = room is not None and len(missed) >= room
+            if fresh:
+                continue
+            for seq, frame in missed:
+                await subscriber.send(seq, frame)
+                last = seq
+        topic.subscribers.add(subscriber)
+        return True
+
+    def unsubscribe(self, subscriber: Subscriber, job_id: Optional[str] = None):
+        self.clients.discard(subscriber)
+        topic = self._topics.get(job_id) if job_id else None
+        if topic is not None:
+            topic.subscribers.discard(subscriber)
+
+    def start(self):
+        self._ticker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._ticker is not None:
+            self._ticker.cancel()
+            await asyncio.gather(self._ticker, return_exceptions=True)
+            self._ticker = None
+        subscribers = set(self.clients).union(*(topic.subscribers for topic in self._topics.values()))
+        await asyncio.gather(*(subscriber.close() for subscriber in subscribers), return_exceptions=True)
+        self.clients.clear()
+        self._topics.clear()
+
+    def _drain(self) -> list[dict]:
+        with self._lock:
+            updates, self._pending = list(self._pending.values()), {}
+        return updates
+
+    async def _send(self, subscriber: Subscriber, seq: int, frame: str, audience: set):
+        try:
+            await asyncio.wait_for(subscriber.send(seq, frame), timeout=ProgressConfig.SEND_TIMEOUT)
+        except Exception as e:
+            logger.info(f"Dropping progress client: {e!r}")
+            audience.discard(subscriber)
+            self.dropped_clients += 1
+            asyncio.ensure_future(subscriber.close())
+
+    async def _send_visible(self, subscriber: Subscriber, updates: list[dict], job_ids: set[str]):
+        try:
+            visible = await subscriber.visible(job_ids)
+        except Exception as e:
+            logger.error(f"Filtering progress updates failed: {e}")
+            return
+        updates = [update for update in updates if update["job_id"] in visible]
+        if updates:
+            await self._send(subscriber, 0, encode({"type": "progress", "updates": updates}), self.clients)
+
+    async def _tick(self):
+        updates = self._drain()
+        if not updates:
+            return
+        sends = []
+        by_job: dict[str, list[dict]] = {}
+        for update in updates:
+            by_job.setdefault(update["job_id"], []).append(update)
+        for job_id, job_updates in by_job.items():
+            topic = self._topic(job_id)
+            topic.seq += 1
+            frame = encode({"type": "progress", "job_id": job_id, "seq": topic.seq, "updates": job_updates})
+            topic.frames.append((topic.seq, frame))
+            sends += [self._send(subscriber, topic.seq, frame, topic.subscribers)
+                      for subscriber in list(topic.subscribers)]
+        if self.clients:
+            frame = encode({"type": "progress", "updates": updates})
+            sends += [self._send(subscriber, 0, frame, self.clients) if subscriber.visible is None
+                      else self._send_visible(subscriber, updates, set(by_job))
+                      for subscriber in list(self.clients)]
+        self.frames += 1
+        await asyncio.gather(*sends)
+
+    async def _run(self):
+        interval = 1 / ProgressConfig.RATE_HZ
+        while True:
+            await asyncio.sleep(interval)
+            await self._tick()
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self.clients),
+            "subscribers": sum(len(topic.subscribers) for topic in self._topics.values()),
+            "topics": len(self._topics),
+            "frames": self.frames,
+            "dropped_clients": self.dropped_clients,
+        }
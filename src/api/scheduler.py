@@ -0,0 +1,202 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED = REGISTRY.counter("spotify_rate_limited_total", "429 responses from Spotify")
+RETRY_AFTER = REGISTRY.histogram("spotify_retry_after_seconds", "Retry-After waits imposed by Spotify",
+                                 buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300))
+RETRIES = REGISTRY.counter("spotify_retries_total", "Upstream requests retried", ("reason",))
+QUEUE_WAIT = REGISTRY.histogram("spotify_queue_wait_seconds", "Time spent waiting for a rate limit token")
+
+
+class SchedulerConfig:
+    TOKEN_RATE = float(os.getenv("SPOTIFY_TOKEN_RATE", "10"))  # requests per second per access token
+    TOKEN_BURST = int(os.getenv("SPOTIFY_TOKEN_BURST", "20"))
+    CLIENT_RATE = float(os.getenv("SPOTIFY_CLIENT_RATE", "25"))  # requests per second per client id
+    CLIENT_BURST = int(os.getenv("SPOTIFY_CLIENT_BURST", "50"))
+    MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "5"))
+    BACKOFF_BASE = float(os.getenv("SPOTIFY_BACKOFF_BASE", "0.5"))
+    BACKOFF_MAX = float(os.getenv("SPOTIFY_BACKOFF_MAX", "30"))
+    DEFAULT_RETRY_AFTER = float(os.getenv("SPOTIFY_DEFAULT_RETRY_AFTER", "1"))
+    MAX_BUCKETS = int(os.getenv("SPOTIFY_MAX_BUCKETS", "1024"))
+
+
+class TokenBucket:
+    """Async token bucket whose waiters are served in FIFO order.
+
+    A bucket can also be paused until a point in time, which is how a
+    ``Retry-After`` from Spotify holds back only the queue that caused it.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    if now < self.paused_until:
+                        await asyncio.sleep(self.paused_until - now)
+                        continue
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+
+
+class RequestScheduler:
+    """Throttles upstream calls per access token and per client id.
+
+    429 responses pause the access token's bucket for ``Retry-After``
+    seconds and are retried; 5xx responses and transport errors are
+    retried with full-jitter exponential backoff.
+    """
+
+    def __init__(self, client_id: Optional[str] = None):
+        self.client_id = client_id or "default"
+        self._buckets: dict[str, TokenBucket] = {}
+        self._last_used: dict[str, float] = {}
+        self.requests = 0
+        self.rate_limited = 0
+        self.retry_after_wait = 0.0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @staticmethod
+    def token_key(token: str) -> str:
+        # Never keep raw access tokens as keys; they show up in stats
+        return "token:" + hashlib.sha256(token.encode()).hexdigest()[:16]
+
+    def _bucket(self, key: str, rate: float, burst: int) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= SchedulerConfig.MAX_BUCKETS:
+                self._evict_idle()
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        self._last_used[key] = time.monotonic()
+        return bucket
+
+    def _evict_idle(self):
+        for key, _ in sorted(self._last_used.items(), key=lambda kv: kv[1]):
+            if len(self._buckets) < SchedulerConfig.MAX_BUCKETS:
+                break
+            bucket = self._buckets[key]
+            if bucket.waiting == 0 and bucket.paused_until <= time.monotonic():
+                del self._buckets[key]
+                del self._last_used[key]
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(SchedulerConfig.BACKOFF_MAX, SchedulerConfig.BACKOFF_BASE * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> float:
+        try:
+            return max(0.0, float(response.headers["Retry-After"]))
+        except (KeyError, ValueError):
+            return SchedulerConfig.DEFAULT_RETRY_AFTER
+
+    async def _acquire(self, token: Optional[str]):
+        started = time.monotonic()
+        if token:
+            key = self.token_key(token)
+            await self._bucket(key, SchedulerConfig.TOKEN_RATE, SchedulerConfig.TOKEN_BURST).acquire()
+        await self._bucket(f"client:{self.client_id}", SchedulerConfig.CLIENT_RATE,
+                           SchedulerConfig.CLIENT_BURST).acquire()
+        waited = time.monotonic() - started
+        QUEUE_WAIT.observe(waited)
+        self.requests += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    async def run(self, send: Callable[[], Awaitable[httpx.Response]],
+                  token: Optional[str] = None) -> httpx.Response:
+        attempt = 0
+        while True:
+            await self._acquire(token)
+            try:
+                response = await send()
+            except httpx.TransportError as e:
+                if attempt >= SchedulerConfig.MAX_RETRIES:
+                    raise
+                delay = self._backoff(attempt)
+                reason = "transport"
+                logger.warning("Upstream transport error (%s), retrying in %.2fs", e, delay)
+            else:
+                if response.status_code == 429:
+                    self.rate_limited += 1
+                    retry_after = self._retry_after(response)
+                    self.retry_after_wait += retry_after
+                    RATE_LIMITED.inc()
+                    RETRY_AFTER.observe(retry_after)
+                    key = self.token_key(token) if token else f"client:{self.client_id}"
+                    bucket = self._buckets.get(key)
+                    if bucket is not None:
+                        bucket.pause(retry_after)
+                    if attempt >= SchedulerConfig.MAX_RETRIES:
+                        return response
+                    logger.warning("Rate limited by Spotify, pausing %s for %.1fs", key, retry_after)
+                    # The paused bucket delays the retry; no extra sleep needed
+                    delay = 0.0
+                    reason = "rate_limited"
+                elif response.status_code >= 500:
+                    if attempt >= SchedulerConfig.MAX_RETRIES:
+                        return response
+                    delay = self._backoff(attempt)
+                    reason = "server_error"
+                    logger.warning("Spotify returned %s, retrying in %.2fs", response.status_code, delay)
+                else:
+                    return response
+            attempt += 1
+            self.retries += 1
+            RETRIES.inc(reason)
+            if delay:
+                await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "queued": sum(bucket.waiting for bucket in self._buckets.values()),
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "retry_after_wait_seconds": round(self.retry_after_wait, 3),
+            "average_wait_seconds": round(self.total_wait / self.requests, 4) if self.requests else 0.0,
+            "max_wait_seconds": round(self.max_wait, 4),
+            "buckets": {
+                key: {
+                    "queued": bucket.waiting,
+                    "tokens": round(bucket.tokens, 2),
+                    "paused_for": round(max(0.0, bucket.paused_until - now), 3),
+                }
+                for key, bucket in self._buckets.items()
+            },
+        }
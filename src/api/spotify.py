@@ -0,0 +1,315 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from batching import BatchLoader, chunked
+from codec import loads
+from metrics import REGISTRY
+from scheduler import RequestScheduler
+from singleflight import SingleFlight
+from tracing import KIND_CLIENT, span
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    "upstream_requests_total", "Requests sent upstream, one per attempt", ("method", "host", "endpoint", "status"))
+UPSTREAM_LATENCY = REGISTRY.histogram(
+    "upstream_request_duration_seconds", "Upstream response time per attempt", ("method", "host", "endpoint"))
+# Spotify ids are 22 base62 characters; image hashes and the like are longer
+_ID_SEGMENT = re.compile(r"[A-Za-z0-9]{16,}")
+
+# Upstream configuration
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+
+
+class HTTPConfig:
+    MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "50"))
+    MAX_KEEPALIVE_PER_HOST = int(os.getenv("HTTP_MAX_KEEPALIVE_PER_HOST", "20"))
+    KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+    CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+    READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+    POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+    HTTP2 = os.getenv("HTTP2", "true").lower() in ("1", "true", "yes")
+
+
+class PageConfig:
+    MAX_CONCURRENT_PAGES = int(os.getenv("SPOTIFY_MAX_CONCURRENT_PAGES", "8"))
+    # Largest page sizes the Web API accepts per endpoint
+    PLAYLISTS_LIMIT = 50
+    PLAYLIST_TRACKS_LIMIT = 100
+    SAVED_TRACKS_LIMIT = 50
+    # Largest ID lists the bulk lookup endpoints accept
+    TRACKS_BATCH = 50
+    AUDIO_FEATURES_BATCH = 100
+
+
+def endpoint_label(url: str) -> tuple[str, str]:
+    """Host and path template of ``url``, with ids replaced so metric labels stay bounded."""
+    parts = urlsplit(url)
+    path = "/".join("{id}" if _ID_SEGMENT.fullmatch(segment) else segment for segment in parts.path.split("/"))
+    return parts.netloc, path
+
+
+async def _timed_send(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+    host, endpoint = endpoint_label(url)
+    started = time.perf_counter()
+    with span(f"{method} {endpoint}", KIND_CLIENT, **{"http.request.method": method, "server.address": host,
+                                                      "url.path": endpoint}) as current:
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            UPSTREAM_REQUESTS.inc(method, host, endpoint, "error")
+            raise
+        if current is not None:
+            current.set(**{"http.response.status_code": response.status_code})
+    UPSTREAM_LATENCY.observe(time.perf_counter() - started, method, host, endpoint)
+    UPSTREAM_REQUESTS.inc(method, host, endpoint, str(response.status_code))
+    return response
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class SpotifyClient:
+    """Shared async HTTP client for the Spotify Web API and accounts service.
+
+    One connection pool is kept per upstream host so that limits apply per
+    host and keep-alive connections are reused across requests.
+    """
+
+    def __init__(self, client_id: Optional[str] = None, api_url: str = SPOTIFY_API_URL,
+                 accounts_url: str = SPOTIFY_ACCOUNTS_URL):
+        self.api_url = api_url.rstrip("/")
+        self.accounts_url = accounts_url.rstrip("/")
+        self.scheduler = RequestScheduler(client_id)
+        self.flights = SingleFlight()
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._track_loader = BatchLoader(self.tracks, PageConfig.TRACKS_BATCH)
+        self._features_loader = BatchLoader(self.audio_features, PageConfig.AUDIO_FEATURES_BATCH)
+
+    def _new_client(self) -> httpx.AsyncClient:
+        http2 = HTTPConfig.HTTP2 and _http2_available()
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=HTTPConfig.MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=HTTPConfig.MAX_KEEPALIVE_PER_HOST,
+                keepalive_expiry=HTTPConfig.KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                HTTPConfig.READ_TIMEOUT,
+                connect=HTTPConfig.CONNECT_TIMEOUT,
+                pool=HTTPConfig.POOL_TIMEOUT,
+            ),
+        )
+
+    def client_for(self, url: str) -> httpx.AsyncClient:
+        host = urlsplit(url).netloc
+        client = self._clients.get(host)
+        if client is None:
+            client = self._new_client()
+            self._clients[host] = client
+        return client
+
+    async def start(self):
+        # Warm the pools for the two hosts we always talk to
+        self.client_for(self.api_url)
+        self.client_for(self.accounts_url)
+        logger.info("Spotify HTTP client started (http2=%s)", HTTPConfig.HTTP2 and _http2_available())
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def url(self, path: str) -> str:
+        if path.startswith("http"):
+            return path
+        return f"{self.api_url}/{path.lstrip('/')}"
+
+    async def request(self, method: str, url: str, token: Optional[str] = None, **kwargs) -> httpx.Response:
+        client = self.client_for(url)
+        if token:
+            kwargs.setdefault("headers", {})["Authorization"] = token
+        response = await self.scheduler.run(lambda: _timed_send(client, method, url, **kwargs), token)
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response
+
+    def _flight_key(self, kind: str, url: str, token: str, params: Optional[dict], *extra) -> tuple:
+        return (kind, self.scheduler.token_key(token), url, tuple(sorted((params or {}).items())), *extra)
+
+    async def get(self, path: str, token: str, params: Optional[dict] = None) -> dict:
+        """GET a JSON resource; identical concurrent calls share one request.
+
+        The returned object may be shared with other callers and must not be
+        mutated.
+        """
+        url = self.url(path)
+
+        async def fetch():
+            response = await self.request("GET", url, token, params=params)
+            with span("json.decode", bytes=len(response.content)):
+                return loads(response.content)
+
+        return await self.flights.do(self._flight_key("get", url, token, params), fetch)
+
+    async def get_conditional(self, path: str, token: str, params: Optional[dict] = None,
+                              etag: Optional[str] = None) -> Optional[tuple[dict, Optional[str]]]:
+        """GET with ``If-None-Match``; returns None when Spotify answers 304."""
+        url = self.url(path)
+
+        async def fetch():
+            headers = {"If-None-Match": etag} if etag else {}
+            response = await self.request("GET", url, token, params=params, headers=headers)
+            if response.status_code == 304:
+                return None
+            with span("json.decode", bytes=len(response.content)):
+                return loads(response.content), response.headers.get("ETag")
+
+        return await self.flights.do(self._flight_key("conditional", url, token, params, etag), fetch)
+
+    async def fetch_bytes(self, url: str) -> bytes:
+        """Download a public asset (e.g. album art) through the shared pool."""
+        response = await _timed_send(self.client_for(url), "GET", url)
+        response.raise_for_status()
+        return response.content
+
+    async def post_token(self, data: dict, auth: tuple) -> dict:
+        url = f"{self.accounts_url}/api/token"
+        response = await self.request("POST", url, data=data, auth=auth)
+        return response.json()
+
+    async def paginate(
+        self,
+        path: str,
+        token: str,
+        limit: int,
+        params: Optional[dict] = None,
+        offset: int = 0,
+        total: Optional[int] = None,
+        concurrency: Optional[int] = None,
+    ) -> AsyncIterator[dict]:
+        """Yield every item of an offset-paged endpoint, in order.
+
+        The first page is fetched to learn ``total`` (unless it is already
+        known), then the remaining offset windows are requested concurrently
+        with at most ``concurrency`` pages in flight.
+        """
+        params = dict(params or {})
+        concurrency = concurrency or PageConfig.MAX_CONCURRENT_PAGES
+
+        if total is None:
+            first = await self.get(path, token, {**params, "offset": offset, "limit": limit})
+            for item in first.get("items", []):
+                yield item
+            total = first.get("total", 0)
+            offset += limit
+
+        offsets = iter(range(offset, total, limit))
+        window: deque[asyncio.Task] = deque()
+
+        def fill():
+            while len(window) < concurrency:
+                page_offset = next(offsets, None)
+                if page_offset is None:
+                    return
+                page_params = {**params, "offset": page_offset, "limit": limit}
+                window.append(asyncio.create_task(self.get(path, token, page_params)))
+
+        try:
+            fill()
+            while window:
+                page = await window.popleft()
+                fill()
+                for item in page.get("items", []):
+                    yield item
+        finally:
+            for task in window:
+                task.cancel()
+
+    async def all_playlists(self, token: str) -> AsyncIterator[dict]:
+        async for playlist in self.paginate("/me/playlists", token, PageConfig.PLAYLISTS_LIMIT):
+            yield playlist
+
+    async def playlist_items(self, playlist_id: str, token: str, offset: int = 0,
+                             total: Optional[int] = None) -> AsyncIterator[dict]:
+        path = f"/playlists/{playlist_id}/tracks"
+        async for item in self.paginate(path, token, PageConfig.PLAYLIST_TRACKS_LIMIT,
+                                        offset=offset, total=total):
+            yield item
+
+    async def saved_tracks(self, token: str) -> AsyncIterator[dict]:
+        async for item in self.paginate("/me/tracks", token, PageConfig.SAVED_TRACKS_LIMIT):
+            yield item
+
+    async def _complete_playlist(self, playlist_id: str, playlist: dict, token: str) -> dict:
+        tracks = playlist.get("tracks") or {}
+        items = list(tracks.get("items", []))
+        total = tracks.get("total", len(items))
+        if total > len(items):
+            items.extend([item async for item in self.playlist_items(
+                playlist_id, token, offset=len(items), total=total)])
+        return {**playlist, "tracks": {**tracks, "items": items, "next": None, "offset": 0, "limit": len(items)}}
+
+    async def full_playlist(self, playlist_id: str, token: str) -> dict:
+        """Fetch a playlist with every track item, not just the embedded first page."""
+        async def fetch():
+            playlist = await self.get(f"/playlists/{playlist_id}", token)
+            return await self._complete_playlist(playlist_id, playlist, token)
+
+        return await self.flights.do(("playlist", self.scheduler.token_key(token), playlist_id), fetch)
+
+    async def full_playlist_conditional(self, playlist_id: str, token: str,
+                                        etag: Optional[str] = None) -> Optional[tuple[dict, Optional[str]]]:
+        """``full_playlist`` revalidated by the playlist object's ETag; None when it is unchanged.
+
+        The playlist object carries the ``snapshot_id``, so its ETag changes
+        whenever any track does, not only those on the embedded first page.
+        """
+        async def fetch():
+            result = await self.get_conditional(f"/playlists/{playlist_id}", token, etag=etag)
+            if result is None:
+                return None
+            playlist, upstream_etag = result
+            return await self._complete_playlist(playlist_id, playlist, token), upstream_etag
+
+        key = ("playlist", self.scheduler.token_key(token), playlist_id, etag)
+        return await self.flights.do(key, fetch)
+
+    async def _bulk(self, path: str, key: str, ids: list[str], token: str, batch_size: int) -> list[Optional[dict]]:
+        """Look up ``ids`` in as few bulk calls as possible, preserving order."""
+        unique = list(dict.fromkeys(ids))
+        pages = await asyncio.gather(*(
+            self.get(path, token, {"ids": ",".join(chunk)})
+            for chunk in chunked(unique, batch_size)
+        ))
+        found = {}
+        for chunk, page in zip(chunked(unique, batch_size), pages):
+            found.update(zip(chunk, page.get(key) or []))
+        return [found.get(item_id) for item_id in ids]
+
+    async def tracks(self, ids: list[str], token: str) -> list[Optional[dict]]:
+        return await self._bulk("/tracks", "tracks", ids, token, PageConfig.TRACKS_BATCH)
+
+    async def audio_features(self, ids: list[str], token: str) -> list[Optional[dict]]:
+        return await self._bulk("/audio-features", "audio_features", ids, token, PageConfig.AUDIO_FEATURES_BATCH)
+
+    async def track(self, track_id: str, token: str) -> Optional[dict]:
+        return await self._track_loader.load(track_id, token)
+
+    async def track_audio_features(self, track_id: str, token: str) -> Optional[dict]:
+        return await self._features_loader.load(track_id, token)
@@ -0,0 +1,361 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+import logging
+from typing import Iterable, Optional
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
+LIBRARY_DB = os.getenv("LIBRARY_DB", os.path.join(DATA_DIR, "library.db"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artists (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS albums (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    release_date TEXT,
+    image_url TEXT,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    album_id TEXT REFERENCES albums(id),
+    duration_ms INTEGER,
+    track_number INTEGER,
+    disc_number INTEGER,
+    isrc TEXT,
+    data TEXT NOT NULL,
+    features TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS track_artists (
+    track_id TEXT NOT NULL REFERENCES tracks(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    artist_id TEXT NOT NULL REFERENCES artists(id),
+    PRIMARY KEY (track_id, position)
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    snapshot_id TEXT,
+    owner TEXT,
+    image_url TEXT,
+    data TEXT,
+    synced_at REAL
+);
+CREATE TABLE IF NOT EXISTS playlist_items (
+    playlist_id TEXT NOT NULL REFERENCES playlists(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    track_id TEXT NOT NULL,
+    added_at TEXT,
+    PRIMARY KEY (playlist_id, position)
+);
+CREATE TABLE IF NOT EXISTS library (
+    user_id TEXT NOT NULL,
+    playlist_id TEXT NOT NULL REFERENCES playlists(id) ON DELETE CASCADE,
+    PRIMARY KEY (user_id, playlist_id)
+);
+CREATE INDEX IF NOT EXISTS idx_tracks_album ON tracks(album_id);
+CREATE INDEX IF NOT EXISTS idx_track_artists_artist ON track_artists(artist_id);
+CREATE INDEX IF NOT EXISTS idx_playlist_items_track ON playlist_items(track_id);
+CREATE INDEX IF NOT EXISTS idx_library_playlist ON library(playlist_id);
+"""
+
+# Per-market availability is large and never used locally
+_DROPPED_KEYS = ("available_markets",)
+
+
+def _slim(obj: dict) -> dict:
+    return {key: value for key, value in obj.items() if key not in _DROPPED_KEYS}
+
+
+def track_key(track: dict) -> Optional[str]:
+    """Stable key for a track; local files have no ID, only a URI."""
+    return track.get("id") or track.get("uri")
+
+
+def _image_url(images: Optional[list]) -> Optional[str]:
+    return images[0]["url"] if images else None
+
+
+class LibraryStore:
+    """Embedded SQLite store for synced library metadata.
+
+    Playlist contents are shared, since every follower sees the same
+    snapshot; which playlists are in whose library is kept per user.
+
+    A single connection is shared between threads and guarded by a lock;
+    async callers go through the ``a*`` wrappers, which run the query in a
+    worker thread so the event loop never blocks on disk.
+    """
+
+    def __init__(self, path: str = LIBRARY_DB):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SCHEMA)
+        # Playlists in nobody's library: rows from before libraries were per user,
+        # or left behind by a sync that stopped midway; the next sync restores them
+        self._conn.execute("DELETE FROM playlists WHERE id NOT IN (SELECT playlist_id FROM library)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _query(self, sql: str, params: Iterable = ()) -> list[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, tuple(params)).fetchall()
+
+    def _transaction(self, fn):
+        # Named after the method that wrote, e.g. "LibraryStore.replace_playlist"
+        operation = fn.__qualname__.split(".<locals>")[0]
+        with span("sqlite.transaction", **{"db.name": "library", "db.operation": operation}), self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    # Writes
+
+    @staticmethod
+    def _upsert_tracks(conn: sqlite3.Connection, tracks: list[dict]):
+        artists, albums, rows, track_artists = {}, {}, [], []
+        now = time.time()
+        for track in tracks:
+            key = track_key(track)
+            if not key:
+                continue
+            album = track.get("album") or {}
+            if album.get("id"):
+                albums[album["id"]] = (
+                    album["id"], album.get("name") or "", album.get("release_date"),
+                    _image_url(album.get("images")), json.dumps(_slim(album)),
+                )
+            for position, artist in enumerate(track.get("artists") or []):
+                artist_id = artist.get("id") or artist.get("uri") or artist.get("name")
+                if not artist_id:
+                    continue
+                artists[artist_id] = (artist_id, artist.get("name") or "", json.dumps(artist))
+                track_artists.append((key, position, artist_id))
+            data = _slim(track)
+            if album:
+                data["album"] = _slim(album)
+            rows.append((
+                key, track.get("name") or "", album.get("id"), track.get("duration_ms"),
+                track.get("track_number"), track.get("disc_number"),
+                (track.get("external_ids") or {}).get("isrc"), json.dumps(data), now,
+            ))
+
+        conn.executemany(
+            "INSERT INTO artists (id, name, data) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET name=excluded.name, data=excluded.data",
+            artists.values(),
+        )
+        conn.executemany(
+            "INSERT INTO albums (id, name, release_date, image_url, data) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET name=excluded.name, release_date=excluded.release_date, "
+            "image_url=excluded.image_url, data=excluded.data",
+            albums.values(),
+        )
+        conn.executemany(
+            "INSERT INTO tracks (id, name, album_id, duration_ms, track_number, disc_number, isrc, data, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET name=excluded.name, album_id=excluded.album_id, "
+            "duration_ms=excluded.duration_ms, track_number=excluded.track_number, "
+            "disc_number=excluded.disc_number, isrc=excluded.isrc, data=excluded.data, "
+            "updated_at=excluded.updated_at",
+            rows,
+        )
+        keys = [(row[0],) for row in rows]
+        conn.executemany("DELETE FROM track_artists WHERE track_id = ?", keys)
+        conn.executemany(
+            "INSERT OR REPLACE INTO track_artists (track_id, position, artist_id) VALUES (?, ?, ?)",
+            track_artists,
+        )
+
+    def upsert_tracks(self, tracks: list[dict]):
+        self._transaction(lambda conn: self._upsert_tracks(conn, tracks))
+
+    def set_features(self, features: dict[str, Optional[dict]]):
+        self._transaction(lambda conn: conn.executemany(
+            "UPDATE tracks SET features = ? WHERE id = ?",
+            [(json.dumps(value) if value is not None else None, key) for key, value in features.items()],
+        ))
+
+    def replace_playlist(self, header: dict, items: list[dict]):
+        """Store a playlist header and its full item list in one transaction."""
+        def write(conn: sqlite3.Connection):
+            tracks = [item["track"] for item in items if item and item.get("track")]
+            self._upsert_tracks(conn, tracks)
+            data = _slim(header)
+            data.pop("tracks", None)
+            conn.execute(
+                "INSERT INTO playlists (id, name, snapshot_id, owner, image_url, data, synced_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET name=excluded.name, snapshot_id=excluded.snapshot_id, "
+                "owner=excluded.owner, image_url=excluded.image_url, data=excluded.data, "
+                "synced_at=excluded.synced_at",
+                (
+                    header["id"], header.get("name") or "", header.get("snapshot_id"),
+                    (header.get("owner") or {}).get("id"), _image_url(header.get("images")),
+                    json.dumps(data), time.time(),
+                ),
+            )
+            conn.execute("DELETE FROM playlist_items WHERE playlist_id = ?", (header["id"],))
+            conn.executemany(
+                "INSERT INTO playlist_items (playlist_id, position, track_id, added_at) VALUES (?, ?, ?, ?)",
+                [
+                    (header["id"], position, track_key(item["track"]), item.get("added_at"))
+                    for position, item in enumerate(items)
+                    if item and item.get("track") and track_key(item["track"])
+                ],
+            )
+        self._transaction(write)
+
+    def set_library(self, user_id: str, playlist_ids: set[str]) -> list[str]:
+        """Make ``playlist_ids`` the user's library and return the IDs it no longer has.
+
+        A dropped playlist is deleted once it is in no other user's library.
+        """
+        def write(conn: sqlite3.Connection) -> list[str]:
+            current = {row[0] for row in conn.execute(
+                "SELECT playlist_id FROM library WHERE user_id = ?", (user_id,)
+            )}
+            removed = sorted(current - playlist_ids)
+            conn.executemany(
+                "DELETE FROM library WHERE user_id = ? AND playlist_id = ?",
+                [(user_id, playlist_id) for playlist_id in removed],
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO library (user_id, playlist_id) SELECT ?, id FROM playlists WHERE id = ?",
+                [(user_id, playlist_id) for playlist_id in playlist_ids - current],
+            )
+            conn.executemany(
+                "DELETE FROM playlists WHERE id = ? AND NOT EXISTS (SELECT 1 FROM library WHERE playlist_id = ?)",
+                [(playlist_id, playlist_id) for playlist_id in removed],
+            )
+            return removed
+        return self._transaction(write)
+
+    # Reads
+
+    def playlist(self, playlist_id: str, user_id: Optional[str] = None) -> Optional[dict]:
+        """A stored playlist; with ``user_id``, only if it is in that user's library."""
+        rows = self._query(
+            "SELECT p.id, p.name, p.snapshot_id, p.image_url, p.data, COUNT(i.position) AS total "
+            "FROM playlists p LEFT JOIN playlist_items i ON i.playlist_id = p.id "
+            "WHERE p.id = ? AND (? IS NULL OR EXISTS "
+            "(SELECT 1 FROM library l WHERE l.playlist_id = p.id AND l.user_id = ?)) GROUP BY p.id",
+            (playlist_id, user_id, user_id),
+        )
+        return self._playlist_row(rows[0]) if rows else None
+
+    def playlists(self, user_id: str) -> list[dict]:
+        rows = self._query(
+            "SELECT p.id, p.name, p.snapshot_id, p.image_url, p.data, COUNT(i.position) AS total "
+            "FROM library l JOIN playlists p ON p.id = l.playlist_id "
+            "LEFT JOIN playlist_items i ON i.playlist_id = p.id "
+            "WHERE l.user_id = ? GROUP BY p.id ORDER BY p.name",
+            (user_id,),
+        )
+        return [self._playlist_row(row) for row in rows]
+
+    @staticmethod
+    def _playlist_row(row: sqlite3.Row) -> dict:
+        data = json.loads(row["data"]) if row["data"] else {}
+        return {**data, "id": row["id"], "name": row["name"], "snapshot_id": row["snapshot_id"],
+                "tracks": {"total": row["total"]}}
+
+    def playlist_track_keys(self, playlist_id: str) -> list[str]:
+        rows = self._query(
+            "SELECT track_id FROM playlist_items WHERE playlist_id = ? ORDER BY position", (playlist_id,)
+        )
+        return [row["track_id"] for row in rows]
+
+    def playlist_items(self, playlist_id: str) -> list[dict]:
+        rows = self._query(
+            "SELECT i.added_at, t.data, t.features FROM playlist_items i "
+            "JOIN tracks t ON t.id = i.track_id WHERE i.playlist_id = ? ORDER BY i.position",
+            (playlist_id,),
+        )
+        return [
+            {"added_at": row["added_at"], "track": json.loads(row["data"]),
+             "features": json.loads(row["features"]) if row["features"] else None}
+            for row in rows
+        ]
+
+    def album_images(self, album_id: str) -> Optional[list[dict]]:
+        rows = self._query("SELECT data FROM albums WHERE id = ?", (album_id,))
+        if not rows or not rows[0]["data"]:
+            return None
+        return json.loads(rows[0]["data"]).get("images")
+
+    def tracks(self, track_ids: list[str]) -> dict[str, dict]:
+        found = {}
+        # SQLite caps bound parameters per statement
+        for start in range(0, len(track_ids), 500):
+            chunk = track_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in self._query(f"SELECT id, data, features FROM tracks WHERE id IN ({placeholders})", chunk):
+                track = json.loads(row["data"])
+                track["features"] = json.loads(row["features"]) if row["features"] else None
+                found[row["id"]] = track
+        return found
+
+    def tracks_missing_features(self, track_ids: list[str]) -> list[str]:
+        missing = []
+        for start in range(0, len(track_ids), 500):
+            chunk = track_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._query(
+                f"SELECT id FROM tracks WHERE features IS NULL AND id IN ({placeholders})", chunk
+            )
+            missing.extend(row["id"] for row in rows)
+        return missing
+
+    # Async wrappers
+
+    async def areplace_playlist(self, header: dict, items: list[dict]):
+        await asyncio.to_thread(self.replace_playlist, header, items)
+
+    async def aset_features(self, features: dict[str, Optional[dict]]):
+        await asyncio.to_thread(self.set_features, features)
+
+    async def aset_library(self, user_id: str, playlist_ids: set[str]) -> list[str]:
+        return await asyncio.to_thread(self.set_library, user_id, playlist_ids)
+
+    async def aplaylist(self, playlist_id: str, user_id: Optional[str] = None) -> Optional[dict]:
+        return await asyncio.to_thread(self.playlist, playlist_id, user_id)
+
+    async def aplaylists(self, user_id: str) -> list[dict]:
+        return await asyncio.to_thread(self.playlists, user_id)
+
+    async def aplaylist_items(self, playlist_id: str) -> list[dict]:
+        return await asyncio.to_thread(self.playlist_items, playlist_id)
+
+    async def aalbum_images(self, album_id: str) -> Optional[list[dict]]:
+        return await asyncio.to_thread(self.album_images, album_id)
+
+    async def aplaylist_track_keys(self, playlist_id: str) -> list[str]:
+        return await asyncio.to_thread(self.playlist_track_keys, playlist_id)
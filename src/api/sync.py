@@ -0,0 +1,181 @@
+import os
+import asyncio
+import difflib
+import logging
+from collections import Counter
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+from spotify import SpotifyClient
+from store import LibraryStore, track_key
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", "4"))
+
+# Clients may use this alias for their own liked songs
+LIKED_SONGS_ID = "liked_songs"
+
+# Called with the playlist header, its diff and the playlist's new items in order
+DiffListener = Callable[[dict, dict, list[dict]], Awaitable[None]]
+# Returns a current access token for a user id, or None if the user has no session
+TokenSource = Callable[[str], Awaitable[Optional[str]]]
+
+
+def liked_songs_id(user_id: str) -> str:
+    """Liked songs are stored as one playlist per user."""
+    return f"{LIKED_SONGS_ID}:{user_id}"
+
+
+def item_key(item: dict) -> Optional[str]:
+    return track_key((item or {}).get("track") or {})
+
+
+def diff_items(old_keys: list[str], new_items: list[dict]) -> dict:
+    """Compute the added/removed/moved changes between stored keys and new items.
+
+    Items are matched by track ID (falling back to URI for local files),
+    counting duplicates. ``moved`` holds the kept items that are not part
+    of the longest common ordering of the two lists.
+    """
+    new_items = [item for item in new_items if item_key(item)]
+    new_keys = [item_key(item) for item in new_items]
+    old_counts, new_counts = Counter(old_keys), Counter(new_keys)
+    removed_counts = old_counts - new_counts
+    added_counts = new_counts - old_counts
+
+    removed = []
+    for position, key in enumerate(old_keys):
+        if removed_counts[key] > 0:
+            removed_counts[key] -= 1
+            removed.append({"id": key, "position": position})
+
+    added = []
+    kept_new = []
+    for position, (key, item) in enumerate(zip(new_keys, new_items)):
+        if added_counts[key] > 0:
+            added_counts[key] -= 1
+            added.append({"id": key, "position": position, "item": item})
+        else:
+            kept_new.append((key, position))
+
+    removed_positions = {entry["position"] for entry in removed}
+    kept_old = [key for position, key in enumerate(old_keys) if position not in removed_positions]
+    matcher = difflib.SequenceMatcher(None, kept_old, [key for key, _ in kept_new], autojunk=False)
+    in_place = set()
+    for block in matcher.get_matching_blocks():
+        in_place.update(range(block.b, block.b + block.size))
+    moved = [
+        {"id": key, "position": position}
+        for index, (key, position) in enumerate(kept_new)
+        if index not in in_place
+    ]
+    return {"added": added, "removed": removed, "moved": moved}
+
+
+class LibrarySync:
+    """Keeps a local copy of a user's playlists and liked songs in step with Spotify.
+
+    Playlist tracks are only re-fetched when the playlist's ``snapshot_id``
+    changes; the resulting diff is applied to the stored copy and handed to
+    every registered listener (e.g. the download queue). Stored playlists
+    are shared by the users that follow them, so a playlist dropped from one
+    user's library stays for the others. With ``tokens``, the access token
+    is looked up again for every playlist, so a long sync outlives the
+    token it started with.
+    """
+
+    def __init__(self, spotify: SpotifyClient, store: LibraryStore, tokens: Optional[TokenSource] = None):
+        self.spotify = spotify
+        self.store = store
+        self.tokens = tokens
+        self.listeners: list[DiffListener] = []
+
+    async def _token(self, user_id: str, fallback: str) -> str:
+        # Users who sent a raw Spotify token have no session to refresh
+        token = await self.tokens(user_id) if self.tokens is not None else None
+        return token or fallback
+
+    async def _apply(self, header: dict, stored: Optional[dict], items: list[dict]) -> dict:
+        old_keys = await self.store.aplaylist_track_keys(header["id"]) if stored else []
+        diff = diff_items(old_keys, items)
+        await self.store.areplace_playlist(header, items)
+        for listener in self.listeners:
+            await listener(header, diff, items)
+        return diff
+
+    async def _sync_playlist(self, header: dict, token: str) -> Optional[dict]:
+        stored = await self.store.aplaylist(header["id"])
+        if stored and stored.get("snapshot_id") == header.get("snapshot_id"):
+            return None
+        total = (header.get("tracks") or {}).get("total")
+        items = [item async for item in self.spotify.playlist_items(header["id"], token)]
+        if total is not None and len(items) != total:
+            logger.info(f"Playlist {header['name']} reported {total} tracks, fetched {len(items)}")
+        return await self._apply(header, stored, items)
+
+    async def _sync_liked_songs(self, token: str, user_id: str) -> Optional[dict]:
+        # Liked songs have no snapshot_id; the newest added_at and total stand in for one
+        first = await self.spotify.get("/me/tracks", token, {"limit": 1})
+        newest = first["items"][0].get("added_at") if first.get("items") else None
+        snapshot_id = f"{first.get('total', 0)}:{newest}"
+        stored = await self.store.aplaylist(liked_songs_id(user_id))
+        if stored and stored.get("snapshot_id") == snapshot_id:
+            return None
+        items = [item async for item in self.spotify.saved_tracks(token)]
+        header = {"id": liked_songs_id(user_id), "name": "Liked Songs", "snapshot_id": snapshot_id}
+        return await self._apply(header, stored, items)
+
+    async def _save_audio_features(self, diffs: dict, token: str) -> int:
+        added = list(dict.fromkeys(
+            entry["id"] for diff in diffs.values() for entry in diff["added"]
+        ))
+        ids = await asyncio.to_thread(self.store.tracks_missing_features, added)
+        # Local files have no Spotify ID and no audio features
+        ids = [track_id for track_id in ids if not track_id.startswith("spotify:local:")]
+        if not ids:
+            return 0
+        try:
+            features = await self.spotify.audio_features(ids, token)
+        except httpx.HTTPError as e:
+            logger.warning(f"Audio features unavailable: {e}")
+            return 0
+        await self.store.aset_features(dict(zip(ids, features)))
+        return len(ids)
+
+    async def sync(self, token: str, user_id: str) -> dict:
+        """Sync the library of ``user_id``, whose access token ``token`` is."""
+        semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+        async def bounded(header: dict):
+            async with semaphore:
+                with span("sync.playlist", playlist_id=header["id"]):
+                    return header["id"], await self._sync_playlist(header, await self._token(user_id, token))
+
+        headers = [playlist async for playlist in self.spotify.all_playlists(token)]
+        results = await asyncio.gather(*(bounded(header) for header in headers if header))
+        with span("sync.liked_songs"):
+            liked = await self._sync_liked_songs(await self._token(user_id, token), user_id)
+            results.append((liked_songs_id(user_id), liked))
+
+        diffs = {playlist_id: diff for playlist_id, diff in results if diff is not None}
+
+        seen = {header["id"] for header in headers if header} | {liked_songs_id(user_id)}
+        deleted = await self.store.aset_library(user_id, seen)
+
+        with span("sync.audio_features"):
+            features_saved = await self._save_audio_features(diffs, await self._token(user_id, token))
+        logger.info(f"Sync completed: {len(diffs)} of {len(results)} playlists changed")
+        return {
+            "playlists": len(results),
+            "changed": len(diffs),
+            "unchanged": len(results) - len(diffs),
+            "deleted": deleted,
+            "features_saved": features_saved,
+            "diffs": {
+                playlist_id: {change: len(entries) for change, entries in diff.items()}
+                for playlist_id, diff in diffs.items()
+            },
+        }
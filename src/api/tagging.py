@@ -0,0 +1,170 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import Executor
+from typing import Awaitable, Callable, Optional
+
+from mutagen.id3 import ID3, APIC, TALB, TDRC, TIT2, TPE1, TPE2, TPOS, TRCK, TSRC, TXXX
+
+from covers import CoverCache, image_type
+from store import LibraryStore
+from tracing import bind
+
+logger = logging.getLogger(__name__)
+
+
+class TagConfig:
+    COVER_SIZE = int(os.getenv("TAG_COVER_SIZE", "640"))
+    # 3 is what most players and file managers read reliably
+    ID3_VERSION = int(os.getenv("TAG_ID3_VERSION", "3"))
+    RETAG_CONCURRENCY = int(os.getenv("RETAG_CONCURRENCY", str(os.cpu_count() or 4)))
+
+
+# Fetches a full Spotify track object by (track id, user id), using that user's session
+TrackLookup = Callable[[str, str], Awaitable[Optional[dict]]]
+
+
+def build_tags(track: dict, cover: Optional[bytes] = None) -> ID3:
+    """All ID3 frames for a Spotify track object, built in memory."""
+    album = track.get("album") or {}
+    artists = [artist["name"] for artist in track.get("artists") or [] if artist.get("name")]
+    album_artists = [artist["name"] for artist in album.get("artists") or [] if artist.get("name")]
+
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=track.get("name") or ""))
+    if artists:
+        tags.add(TPE1(encoding=3, text=artists))
+    if album.get("name"):
+        tags.add(TALB(encoding=3, text=album["name"]))
+    if album_artists:
+        tags.add(TPE2(encoding=3, text=album_artists))
+    if track.get("track_number"):
+        total = album.get("total_tracks")
+        tags.add(TRCK(encoding=3, text=f"{track['track_number']}/{total}" if total else str(track["track_number"])))
+    if track.get("disc_number"):
+        tags.add(TPOS(encoding=3, text=str(track["disc_number"])))
+    isrc = (track.get("external_ids") or {}).get("isrc")
+    if isrc:
+        tags.add(TSRC(encoding=3, text=isrc))
+    if album.get("release_date"):
+        tags.add(TDRC(encoding=3, text=album["release_date"]))
+    if track.get("id"):
+        tags.add(TXXX(encoding=3, desc="SPOTIFY_TRACK_ID", text=track["id"]))
+    if cover:
+        tags.add(APIC(encoding=3, mime=image_type(cover), type=3, desc="Cover", data=cover))
+    return tags
+
+
+def write_tags(path: str, tags: ID3):
+    """Replace the file's tag in one write; the audio frames are left untouched."""
+    if TagConfig.ID3_VERSION == 3:
+        # Frames are built as v2.4; this turns TDRC into TYER/TDAT and the like
+        tags.update_to_v23()
+    tags.save(path, v2_version=TagConfig.ID3_VERSION)
+
+
+class Tagger:
+    """Writes ID3 tags from the synced library store and the album art cache.
+
+    Tags are built fully in memory and written once per file. ``retag``
+    re-applies current metadata to every file in the content store.
+    Tracks the store does not know are looked up on Spotify for the user
+    who queued them, when ``lookup`` is given.
+    """
+
+    def __init__(self, store: LibraryStore, covers: CoverCache, lookup: Optional[TrackLookup] = None):
+        self.store = store
+        self.covers = covers
+        self.lookup = lookup
+        self.retag_status: dict = {"running": False}
+        self._retag_task: Optional[asyncio.Task] = None
+
+    async def remember(self, tracks: list[dict]):
+        """Keep full track objects of downloads in the store so tagging can use them."""
+        tracks = [track for track in tracks if track and track.get("id")]
+        if tracks:
+            await asyncio.to_thread(self.store.upsert_tracks, tracks)
+
+    async def _cover(self, track: dict) -> Optional[bytes]:
+        album = track.get("album") or {}
+        if not album.get("id"):
+            return None
+
+        async def album_images():
+            return album.get("images") or await self.store.aalbum_images(album["id"]) or []
+
+        try:
+            digest = await self.covers.get(album["id"], album_images, TagConfig.COVER_SIZE)
+        except Exception as e:
+            logger.warning(f"No cover for album {album['id']}: {e}")
+            return None
+        if not digest:
+            return None
+
+        def read():
+            with open(self.covers.path_for(digest), "rb") as f:
+                return f.read()
+
+        return await asyncio.to_thread(read)
+
+    async def tag(self, path: str, track: dict, executor: Optional[Executor] = None):
+        tags = build_tags(track, await self._cover(track))
+        await asyncio.get_running_loop().run_in_executor(executor, bind("id3.write", write_tags), path, tags)
+
+    async def _track(self, track_id: str, user_id: Optional[str]) -> Optional[dict]:
+        track = (await asyncio.to_thread(self.store.tracks, [track_id])).get(track_id)
+        # Local files have no Spotify ID to look up
+        if track is not None or not user_id or self.lookup is None or track_id.startswith("spotify:local:"):
+            return track
+        try:
+            track = await self.lookup(track_id, user_id)
+        except Exception as e:
+            logger.warning(f"Looking up track {track_id} failed: {e}")
+            return None
+        if track:
+            await self.remember([track])
+        return track
+
+    async def tag_track(self, path: str, track_id: str, fallback: dict, executor: Optional[Executor] = None,
+                        user_id: Optional[str] = None):
+        """Tag a file with stored metadata for ``track_id``, or ``fallback`` if it was never synced.
+
+        With ``user_id``, a track missing from the store is first fetched from Spotify.
+        """
+        track = await self._track(track_id, user_id) or fallback
+        await self.tag(path, track, executor)
+
+    async def retag(self, directory: str, track_ids: Optional[list[str]] = None):
+        """Re-tag ``<track id>.mp3`` files in ``directory`` in parallel."""
+        def files():
+            found = {name[:-4]: os.path.join(directory, name)
+                     for name in os.listdir(directory) if name.endswith(".mp3") and not name.endswith(".src.mp3")}
+            return found if track_ids is None else {key: found[key] for key in track_ids if key in found}
+
+        paths = await asyncio.to_thread(files)
+        tracks = await asyncio.to_thread(self.store.tracks, list(paths))
+        status = self.retag_status = {"running": True, "files": len(paths), "tagged": 0,
+                                      "missing_metadata": len(paths) - len(tracks), "failed": 0}
+        limit = asyncio.Semaphore(TagConfig.RETAG_CONCURRENCY)
+
+        async def one(track_id: str, track: dict):
+            async with limit:
+                try:
+                    await self.tag(paths[track_id], track)
+                    status["tagged"] += 1
+                except Exception as e:
+                    logger.error(f"Re-tagging {paths[track_id]} failed: {e}")
+                    status["failed"] += 1
+
+        try:
+            await asyncio.gather(*(one(track_id, track) for track_id, track in tracks.items()))
+        finally:
+            status["running"] = False
+        logger.info(f"Re-tagged {status['tagged']} of {status['files']} files")
+        return status
+
+    def start_retag(self, directory: str, track_ids: Optional[list[str]] = None) -> bool:
+        if self._retag_task is not None and not self._retag_task.done():
+            return False
+        self._retag_task = asyncio.create_task(self.retag(directory, track_ids))
+        return True
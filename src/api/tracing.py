@@ -0,0 +1,523 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import httpx
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+
+class TraceConfig:
+    # "none", "file" (OTLP JSON, one export request per line) or "otlp" (OTLP/HTTP JSON)
+    EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+    FILE = os.getenv("TRACE_FILE", os.path.join(DATA_DIR, "traces.jsonl"))
+    OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318").rstrip("/")
+    SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "spotify-sync-api")
+    # Share of requests traced without being asked to; traceparent and X-Trace always are
+    SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+    BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "512"))
+    FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "2"))
+    MAX_QUEUE = int(os.getenv("TRACE_MAX_QUEUE", "10000"))
+    # Enables the X-Trace/X-Profile headers and the /debug endpoints
+    DEBUG_API = os.getenv("TRACE_DEBUG_API", "false").lower() in ("1", "true", "yes")
+    PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(DATA_DIR, "profiles"))
+    PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+    PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "600"))
+
+
+# OTLP span kinds and status codes
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+STATUS_OK, STATUS_ERROR = 1, 2
+
+
+def _new_id(size: int) -> str:
+    return random.getrandbits(size * 8).to_bytes(size, "big").hex()
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list[dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+@dataclass(eq=False)
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    kind: int = KIND_INTERNAL
+    attributes: dict = field(default_factory=dict)
+    profile: Optional["ProfileSession"] = None
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int = 0
+    error: Optional[str] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def otlp_request(spans: list[Span]) -> dict:
+    """An OTLP ExportTraceServiceRequest in its JSON encoding."""
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attributes({"service.name": TraceConfig.SERVICE_NAME})},
+        "scopeSpans": [{"scope": {"name": "spotify-sync"}, "spans": [span.to_otlp() for span in spans]}],
+    }]}
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("span", default=None)
+_NOOP = nullcontext()
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def span(name: str, kind: int = KIND_INTERNAL, **attributes):
+    """Child span of the current trace; a no-op outside traced requests and jobs.
+
+    Works in coroutines and in threads started with ``asyncio.to_thread``,
+    which copies the caller's context.
+    """
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    return tracer.activate(Span(name, parent.trace_id, _new_id(8), parent.span_id, kind, attributes, parent.profile))
+
+
+def bind(name: str, fn: Callable) -> Callable:
+    """Wrap ``fn`` for ``run_in_executor`` so it runs in a span of the caller's trace."""
+    if _current.get() is None:
+        return fn
+    context = contextvars.copy_context()
+
+    def run(*args):
+        with span(name):
+            return fn(*args)
+
+    return functools.partial(context.run, run)
+
+
+class ProfileSession:
+    """Stack samples for one request or job, in folded (flamegraph.pl) form."""
+
+    def __init__(self, name: str, seconds: float):
+        self.name = name
+        self.samples: Counter = Counter()
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds
+        self.path: Optional[str] = None
+
+    def write(self, directory: str) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.name}.folded")
+        with open(path + ".tmp", "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(path + ".tmp", path)
+        self.path = path
+        return path
+
+
+def _fold(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class Profiler:
+    """Sampling profiler that attributes stacks to the spans that asked for them.
+
+    A span with a profile session registers its thread (and, on the event
+    loop, its task) while it is open. Every ``PROFILE_INTERVAL`` the sampler
+    thread records the stack of each registered thread, counting event loop
+    samples only while the registered task is the one running. The result
+    covers the request's or job's own work rather than the whole process.
+    """
+
+    def __init__(self, interval: float = TraceConfig.PROFILE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active: dict[int, Counter] = {}
+        self._sessions: set[ProfileSession] = set()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, name: str, seconds: float = TraceConfig.PROFILE_MAX_SECONDS) -> ProfileSession:
+        session = ProfileSession(name, min(seconds, TraceConfig.PROFILE_MAX_SECONDS))
+        with self._lock:
+            self._sessions.add(session)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        return session
+
+    def stop(self, session: ProfileSession) -> Optional[str]:
+        with self._lock:
+            if session not in self._sessions:
+                return session.path
+            self._sessions.discard(session)
+        path = session.write(TraceConfig.PROFILE_DIR)
+        logger.info(f"Wrote profile {path} ({sum(session.samples.values())} samples)")
+        return path
+
+    def enter(self, session: ProfileSession) -> tuple:
+        try:
+            loop = asyncio.get_running_loop()
+            task = asyncio.current_task(loop)
+        except RuntimeError:
+            loop = task = None
+        key = (threading.get_ident(), session, loop, task)
+        with self._lock:
+            self._active.setdefault(key[0], Counter())[key[1:]] += 1
+        return key
+
+    def leave(self, key: tuple):
+        with self._lock:
+            entries = self._active.get(key[0])
+            if entries is None:
+                return
+            entries[key[1:]] -= 1
+            if entries[key[1:]] <= 0:
+                del entries[key[1:]]
+            if not entries:
+                del self._active[key[0]]
+
+    def _sample(self):
+        frames = sys._current_frames()
+        # The running task per loop; only readable through asyncio's registry
+        running = getattr(asyncio.tasks, "_current_tasks", None)
+        with self._lock:
+            active = [(thread_id, list(entries)) for thread_id, entries in self._active.items()]
+        for thread_id, entries in active:
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            stack = None
+            for session, loop, task in entries:
+                if task is not None and running is not None and running.get(loop) is not task:
+                    continue
+                if stack is None:
+                    stack = _fold(frame)
+                session.samples[stack] += 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self._lock:
+                expired = [session for session in self._sessions if session.deadline <= now]
+                if not self._sessions:
+                    self._thread = None
+                    return
+            for session in expired:
+                self.stop(session)
+            self._sample()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {session.name: sum(session.samples.values()) for session in self._sessions}
+
+
+@dataclass
+class JobTrace:
+    job_id: str
+    trace_id: str
+    root_id: str
+    deadline: float
+    profile: Optional[ProfileSession] = None
+    start_ns: int = field(default_factory=time.time_ns)
+
+
+class Tracer:
+    """Creates spans for opted-in requests and jobs and exports them in the background.
+
+    Requests are traced when they carry a sampled W3C ``traceparent``, when
+    ``TRACE_SAMPLE_RATE`` picks them, or (with the debug API on) when they
+    send ``X-Trace``/``X-Profile`` or match a route armed at runtime. Jobs
+    are traced once ``trace_job`` is called for them.
+    """
+
+    def __init__(self):
+        self.profiler = Profiler()
+        self.exported = 0
+        self.dropped = 0
+        self.export_errors = 0
+        self._queue: queue.Queue = queue.Queue(TraceConfig.MAX_QUEUE)
+        self._thread: Optional[threading.Thread] = None
+        self._armed: dict[str, list] = {}
+        self._jobs: dict[str, JobTrace] = {}
+
+    # Spans
+
+    @contextmanager
+    def activate(self, span: Span):
+        token = _current.set(span)
+        entry = self.profiler.enter(span.profile) if span.profile else None
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            if entry:
+                self.profiler.leave(entry)
+            _current.reset(token)
+            span.end_ns = time.time_ns()
+            self._export(span)
+
+    def start_trace(self, name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None,
+                    kind: int = KIND_INTERNAL, profile: Optional[ProfileSession] = None, **attributes):
+        return self.activate(Span(name, trace_id or _new_id(16), _new_id(8), parent_id, kind, attributes, profile))
+
+    # Requests
+
+    def arm(self, route: str, count: int = 1, profile: bool = False):
+        """Trace (and optionally profile) the next ``count`` requests to a route template."""
+        self._armed[route] = [count, profile]
+
+    def decide(self, scope) -> Optional[tuple[Optional[str], Optional[str], bool]]:
+        """Whether to trace a request: (trace id, parent span id, profile) or None."""
+        headers = dict(scope.get("headers") or ())
+        parent = _parse_traceparent(headers.get(b"traceparent", b"").decode("latin-1"))
+        if parent is not None:
+            return parent[0], parent[1], TraceConfig.DEBUG_API and b"x-profile" in headers
+        if TraceConfig.DEBUG_API:
+            if b"x-profile" in headers or b"x-trace" in headers:
+                return None, None, b"x-profile" in headers
+            if self._armed:
+                route = _match_route(scope)
+                armed = self._armed.get(route)
+                if armed is not None:
+                    armed[0] -= 1
+                    if armed[0] <= 0:
+                        del self._armed[route]
+                    return None, None, armed[1]
+        if TraceConfig.SAMPLE_RATE and random.random() < TraceConfig.SAMPLE_RATE:
+            return None, None, False
+        return None
+
+    # Jobs
+
+    def trace_job(self, job_id: str, profile: bool = False,
+                  seconds: float = TraceConfig.PROFILE_MAX_SECONDS) -> JobTrace:
+        job = self._jobs.get(job_id)
+        if job is None:
+            session = self.profiler.start(f"job-{job_id}", seconds) if profile else None
+            job = self._jobs[job_id] = JobTrace(job_id, _new_id(16), _new_id(8), time.monotonic() + seconds, session)
+        return job
+
+    def untrace_job(self, job_id: str) -> Optional[JobTrace]:
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            return None
+        if job.profile is not None:
+            self.profiler.stop(job.profile)
+        # The job's root span is only known to be finished now
+        root = Span(f"download job {job_id}", job.trace_id, job.root_id, None, KIND_INTERNAL,
+                    {"job.id": job_id, "profile": job.profile.path if job.profile else None},
+                    start_ns=job.start_ns, end_ns=time.time_ns())
+        self._export(root)
+        return job
+
+    def job_span(self, job_id: str, name: str, **attributes):
+        """Span for one stage of one track, or a no-op when the job is not traced."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return _NOOP
+        if job.deadline <= time.monotonic():
+            self.untrace_job(job_id)
+            return _NOOP
+        return self.activate(Span(name, job.trace_id, _new_id(8), job.root_id, KIND_INTERNAL,
+                                  {"job.id": job_id, **attributes}, job.profile))
+
+    # Export
+
+    def _export(self, span: Span):
+        if TraceConfig.EXPORTER == "none":
+            return
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if TraceConfig.EXPORTER == "none" or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+        logger.info(f"Exporting traces to {TraceConfig.FILE if TraceConfig.EXPORTER == 'file' else TraceConfig.OTLP_ENDPOINT}")
+
+    async def stop(self):
+        for job_id in list(self._jobs):
+            self.untrace_job(job_id)
+        if self._thread is not None:
+            self._queue.put(None)
+            await asyncio.to_thread(self._thread.join, TraceConfig.FLUSH_INTERVAL + 5)
+            self._thread = None
+
+    def _run(self):
+        client = httpx.Client(timeout=5) if TraceConfig.EXPORTER == "otlp" else None
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=TraceConfig.FLUSH_INTERVAL)
+                except queue.Empty:
+                    continue
+                batch = []
+                while item is not None:
+                    batch.append(item)
+                    if len(batch) >= TraceConfig.BATCH_SIZE:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if batch:
+                    self._write(batch, client)
+                if item is None:
+                    return
+        finally:
+            if client is not None:
+                client.close()
+
+    def _write(self, batch: list[Span], client: Optional[httpx.Client]):
+        payload = otlp_request(batch)
+        try:
+            if client is not None:
+                client.post(f"{TraceConfig.OTLP_ENDPOINT}/v1/traces", json=payload).raise_for_status()
+            else:
+                os.makedirs(os.path.dirname(TraceConfig.FILE) or ".", exist_ok=True)
+                with open(TraceConfig.FILE, "a") as f:
+                    f.write(json.dumps(payload, separators=(",", ":")) + "\n")
+            self.exported += len(batch)
+        except (OSError, httpx.HTTPError) as e:
+            self.export_errors += 1
+            logger.warning(f"Exporting {len(batch)} spans failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "exporter": TraceConfig.EXPORTER,
+            "sample_rate": TraceConfig.SAMPLE_RATE,
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "export_errors": self.export_errors,
+            "queued": self._queue.qsize(),
+            "armed_routes": {route: {"remaining": count, "profile": profile}
+                             for route, (count, profile) in self._armed.items()},
+            "traced_jobs": {job_id: {"trace_id": job.trace_id, "profile": job.profile is not None}
+                            for job_id, job in self._jobs.items()},
+            "profiling": self.profiler.stats(),
+        }
+
+
+tracer = Tracer()
+
+
+def _parse_traceparent(value: str) -> Optional[tuple[str, str]]:
+    """(trace id, parent span id) from a sampled W3C traceparent header."""
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = int(parts[3], 16) & 1
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return (parts[1], parts[2]) if sampled else None
+
+
+def _match_route(scope) -> Optional[str]:
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match is Match.FULL:
+            return getattr(route, "path", None)
+    return None
+
+
+class TracingMiddleware:
+    """ASGI middleware opening a root span for each traced request.
+
+    The trace id is returned in ``X-Trace-Id``; profiled requests also get
+    ``X-Profile-Id``, the name of their flamegraph dump.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        decision = tracer.decide(scope)
+        if decision is None:
+            return await self.app(scope, receive, send)
+
+        trace_id, parent_id, profile = decision
+        trace_id = trace_id or _new_id(16)
+        session = tracer.profiler.start(f"request-{trace_id}") if profile else None
+        status: Optional[int] = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = [*message.get("headers", ()), (b"x-trace-id", trace_id.encode())]
+                if session is not None:
+                    headers.append((b"x-profile-id", session.name.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        method, path = scope["method"], scope["path"]
+        try:
+            with tracer.start_trace(f"{method} {path}", trace_id, parent_id, KIND_SERVER, session,
+                                    **{"http.request.method": method, "url.path": path}) as root:
+                try:
+                    await self.app(scope, receive, send_wrapper)
+                finally:
+                    route = getattr(scope.get("route"), "path", None)
+                    if route:
+                        root.name = f"{method} {route}"
+                    root.set(**{"http.route": route, "http.response.status_code": status})
+        finally:
+            if session is not None:
+                await asyncio.to_thread(tracer.profiler.stop, session)
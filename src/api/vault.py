@@ -0,0 +1,247 @@
+import os
+import time
+import sqlite3
+import hashlib
+import secrets
+import threading
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+
+class VaultConfig:
+    DB = os.getenv("TOKEN_VAULT_DB", os.path.join(DATA_DIR, "vault.db"))
+    KEY = os.getenv("TOKEN_VAULT_KEY")
+    KEY_FILE = os.getenv("TOKEN_VAULT_KEY_FILE", os.path.join(DATA_DIR, "vault.key"))
+    # Refresh access tokens this many seconds before they expire
+    REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+    # Sessions not used for this long are deleted
+    SESSION_TTL = float(os.getenv("TOKEN_SESSION_TTL", str(30 * 86400)))
+    # last_used is written at most this often per session
+    TOUCH_INTERVAL = float(os.getenv("TOKEN_TOUCH_INTERVAL", "300"))
+    # Decrypted sessions kept in memory
+    CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
+    SESSION_PREFIX = "ss_"
+
+
+RefreshFn = Callable[[str], Awaitable[Optional[dict]]]
+
+
+@dataclass
+class Session:
+    user_id: str
+    access_token: str
+    refresh_token: str
+    expires_at: float
+    scope: str = ""
+    last_used: float = 0.0
+
+    def expires_soon(self) -> bool:
+        return self.expires_at - time.time() < VaultConfig.REFRESH_MARGIN
+
+
+def _load_key() -> bytes:
+    if VaultConfig.KEY:
+        return VaultConfig.KEY.encode()
+    try:
+        with open(VaultConfig.KEY_FILE, "rb") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        key = Fernet.generate_key()
+        os.makedirs(os.path.dirname(VaultConfig.KEY_FILE) or ".", exist_ok=True)
+        fd = os.open(VaultConfig.KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+        logger.info(f"Generated token vault key at {VaultConfig.KEY_FILE}")
+        return key
+
+
+def _hash(session_id: str) -> str:
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+
+class TokenVault:
+    """Server-side Spotify sessions with encrypted refresh tokens.
+
+    Browsers only ever hold an opaque session id. Tokens are encrypted at
+    rest and session ids are stored hashed. Access tokens are refreshed
+    ahead of expiry, at most once at a time per user, so background jobs can
+    ask for a valid token by user id at any point. Sessions idle for longer
+    than ``SESSION_TTL`` are dropped.
+    """
+
+    def __init__(self, refresh: RefreshFn, path: str = VaultConfig.DB):
+        self.refresh = refresh
+        self._fernet = Fernet(_load_key())
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id_hash TEXT PRIMARY KEY, user_id TEXT NOT NULL, access_token BLOB NOT NULL, "
+            "refresh_token BLOB NOT NULL, expires_at REAL NOT NULL, scope TEXT, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id, last_used)")
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._refreshes = SingleFlight()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def is_session_id(value: str) -> bool:
+        return value.startswith(VaultConfig.SESSION_PREFIX)
+
+    def _encrypt(self, value: str) -> bytes:
+        return self._fernet.encrypt(value.encode())
+
+    def _decrypt(self, value: bytes) -> Optional[str]:
+        try:
+            return self._fernet.decrypt(value).decode()
+        except InvalidToken:
+            return None
+
+    def _remember(self, id_hash: str, session: Session):
+        # Called with the lock held
+        self._sessions[id_hash] = session
+        self._sessions.move_to_end(id_hash)
+        while len(self._sessions) > VaultConfig.CACHE_SIZE:
+            self._sessions.popitem(last=False)
+
+    def _save(self, id_hash: str, session: Session):
+        now = session.last_used = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (id_hash, user_id, access_token, refresh_token, expires_at, scope, "
+                "created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id_hash) DO UPDATE SET access_token=excluded.access_token, "
+                "refresh_token=excluded.refresh_token, expires_at=excluded.expires_at, "
+                "scope=excluded.scope, last_used=excluded.last_used",
+                (id_hash, session.user_id, self._encrypt(session.access_token),
+                 self._encrypt(session.refresh_token), session.expires_at, session.scope, now, now),
+            )
+            self._remember(id_hash, session)
+
+    def _load(self, id_hash: str) -> Optional[Session]:
+        """The session for ``id_hash``, marking it used; None if unknown or idle for too long."""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(id_hash)
+            if session is None:
+                row = self._conn.execute(
+                    "SELECT user_id, access_token, refresh_token, expires_at, scope, last_used "
+                    "FROM sessions WHERE id_hash = ?",
+                    (id_hash,),
+                ).fetchone()
+                if row is None:
+                    return None
+                access_token, refresh_token = self._decrypt(row[1]), self._decrypt(row[2])
+                if not access_token or not refresh_token:
+                    logger.warning("Discarding session that cannot be decrypted with the current vault key")
+                    return None
+                session = Session(row[0], access_token, refresh_token, row[3], row[4] or "", row[5])
+            if now - session.last_used > VaultConfig.SESSION_TTL:
+                self._sessions.pop(id_hash, None)
+                self._conn.execute("DELETE FROM sessions WHERE id_hash = ?", (id_hash,))
+                return None
+            if now - session.last_used >= VaultConfig.TOUCH_INTERVAL:
+                session.last_used = now
+                self._conn.execute("UPDATE sessions SET last_used = ? WHERE id_hash = ?", (now, id_hash))
+            self._remember(id_hash, session)
+        return session
+
+    def _purge(self) -> int:
+        cutoff = time.time() - VaultConfig.SESSION_TTL
+        with self._lock:
+            for id_hash in [key for key, session in self._sessions.items() if session.last_used < cutoff]:
+                del self._sessions[id_hash]
+            return self._conn.execute("DELETE FROM sessions WHERE last_used < ?", (cutoff,)).rowcount
+
+    async def create(self, token_data: dict, user_id: str) -> str:
+        """Store a fresh token grant and return the new opaque session id."""
+        session_id = VaultConfig.SESSION_PREFIX + secrets.token_urlsafe(32)
+        session = Session(
+            user_id=user_id,
+            access_token=token_data["access_token"],
+            refresh_token=token_data["refresh_token"],
+            expires_at=time.time() + token_data.get("expires_in", 3600),
+            scope=token_data.get("scope", ""),
+        )
+        await asyncio.to_thread(self._save, _hash(session_id), session)
+        purged = await asyncio.to_thread(self._purge)
+        if purged:
+            logger.info(f"Removed {purged} idle sessions")
+        return session_id
+
+    async def _refresh(self, id_hash: str, session: Session) -> Optional[Session]:
+        token_data = await self.refresh(session.refresh_token)
+        if not token_data:
+            logger.warning(f"Refreshing access token for {session.user_id} failed")
+            return None
+        refreshed = Session(
+            user_id=session.user_id,
+            access_token=token_data["access_token"],
+            # Spotify only sometimes rotates the refresh token
+            refresh_token=token_data.get("refresh_token") or session.refresh_token,
+            expires_at=time.time() + token_data.get("expires_in", 3600),
+            scope=token_data.get("scope", session.scope),
+        )
+        await asyncio.to_thread(self._save, id_hash, refreshed)
+        return refreshed
+
+    async def _valid(self, id_hash: str) -> Optional[Session]:
+        session = await asyncio.to_thread(self._load, id_hash)
+        if session is None:
+            return None
+        if session.expires_soon():
+            # One refresh per user at a time; a caller that joins another of the
+            # user's sessions' refresh gets that session's token, which is as good
+            session = await self._refreshes.do(("user", session.user_id), lambda: self._refresh(id_hash, session))
+        return session
+
+    async def access_token(self, session_id: str) -> Optional[str]:
+        """Return an ``Authorization`` header value for a session, refreshing if needed."""
+        session = await self._valid(_hash(session_id))
+        return f"Bearer {session.access_token}" if session else None
+
+    async def user_id(self, session_id: str) -> Optional[str]:
+        session = await asyncio.to_thread(self._load, _hash(session_id))
+        return session.user_id if session else None
+
+    async def token_for_user(self, user_id: str) -> Optional[str]:
+        """Return a valid ``Authorization`` header value for a user's most recent session."""
+        def latest():
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT id_hash FROM sessions WHERE user_id = ? ORDER BY last_used DESC LIMIT 1", (user_id,)
+                ).fetchone()
+            return row[0] if row else None
+
+        id_hash = await asyncio.to_thread(latest)
+        if id_hash is None:
+            return None
+        session = await self._valid(id_hash)
+        return f"Bearer {session.access_token}" if session else None
+
+    async def revoke(self, session_id: str):
+        id_hash = _hash(session_id)
+
+        def delete():
+            with self._lock:
+                self._sessions.pop(id_hash, None)
+                self._conn.execute("DELETE FROM sessions WHERE id_hash = ?", (id_hash,))
+
+        await asyncio.to_thread(delete)
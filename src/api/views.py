@@ -0,0 +1,124 @@
+import os
+from functools import lru_cache
+from typing import Any, Callable, Optional
+
+from tracing import span
+
+
+class ViewConfig:
+    # Compact views keep one album/playlist image, the smallest at least this wide
+    IMAGE_SIZE = int(os.getenv("VIEW_IMAGE_SIZE", "300"))
+
+
+# Compact default views, in the same syntax as the ``fields`` parameter.
+# They cover what the UI renders; ``fields=*`` returns the full object.
+TRACK = "id,name,duration_ms,artists(id,name),album(id,name,images)"
+PLAYLIST = f"id,name,description,snapshot_id,owner(id,display_name),images,tracks(total,items(added_at,track({TRACK})))"
+PLAYLISTS = "items(id,name,description,snapshot_id,owner(id,display_name),images,tracks(total)),total"
+LIKED = f"items(added_at,track({TRACK})),total"
+SEARCH = f"tracks(items({TRACK}),total)"
+
+FULL = "*"
+
+Tree = dict[str, Optional["Tree"]]
+
+
+@lru_cache(maxsize=256)
+def parse(fields: str) -> Tree:
+    """Parse a Spotify-style field selector into a tree of keys.
+
+    ``tracks(total,items(track(name,album(name))))`` selects nested keys;
+    ``tracks.total`` is shorthand for ``tracks(total)``. Lists are traversed,
+    so the selector applies to each element. Raises ValueError when malformed.
+    """
+    text = fields.replace(" ", "")
+    tree, pos = _parse(text, 0)
+    if pos != len(text):
+        raise ValueError(f"Unexpected ')' at position {pos} in fields")
+    return tree
+
+
+def _parse(text: str, pos: int) -> tuple[Tree, int]:
+    tree: Tree = {}
+    while True:
+        name, children, pos = _field(text, pos)
+        tree[name] = _merge(tree[name], children) if name in tree else children
+        if pos == len(text) or text[pos] == ")":
+            return tree, pos
+        if text[pos] != ",":
+            raise ValueError(f"Expected ',' at position {pos} in fields")
+        pos += 1
+
+
+def _field(text: str, pos: int) -> tuple[str, Optional[Tree], int]:
+    start = pos
+    while pos < len(text) and text[pos] not in ",().":
+        pos += 1
+    name = text[start:pos]
+    if not name:
+        raise ValueError(f"Expected a field name at position {pos} in fields")
+    if pos < len(text) and text[pos] == "(":
+        children, pos = _parse(text, pos + 1)
+        if pos == len(text):
+            raise ValueError("Unclosed '(' in fields")
+        return name, children, pos + 1
+    if pos < len(text) and text[pos] == ".":
+        child, grandchildren, pos = _field(text, pos + 1)
+        return name, {child: grandchildren}, pos
+    return name, None, pos
+
+
+def _merge(left: Optional[Tree], right: Optional[Tree]) -> Optional[Tree]:
+    # A bare key selects the whole value, which covers any narrower selection
+    if left is None or right is None:
+        return None
+    merged = dict(left)
+    for name, children in right.items():
+        merged[name] = _merge(merged[name], children) if name in merged else children
+    return merged
+
+
+def select(value: Any, tree: Optional[Tree], shrink_images: bool = False) -> Any:
+    """Keep only the keys in ``tree``; with ``shrink_images`` image lists are cut to one."""
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [select(element, tree, shrink_images) for element in value]
+    if isinstance(value, dict):
+        return {
+            name: small_image(value[name]) if shrink_images and name == "images"
+            else select(value[name], children, shrink_images)
+            for name, children in tree.items() if name in value
+        }
+    return value
+
+
+def small_image(images: Optional[list]) -> list:
+    """The smallest image at least ``IMAGE_SIZE`` wide, as a one-element list."""
+    if not images:
+        return []
+    sized = [image for image in images if image.get("width")]
+    if not sized:
+        return images[:1]
+    large_enough = [image for image in sized if image["width"] >= ViewConfig.IMAGE_SIZE]
+    if large_enough:
+        return [min(large_enough, key=lambda image: image["width"])]
+    return [max(sized, key=lambda image: image["width"])]
+
+
+def shaper(view: str, fields: Optional[str] = None) -> Optional[Callable[[Any], Any]]:
+    """Return the function that shapes a full upstream object for a request.
+
+    Without ``fields`` the compact ``view`` applies, with images cut down to
+    one; ``fields=*`` returns None, meaning the object is served unchanged.
+    Raises ValueError for a malformed selector, before anything is fetched.
+    """
+    if fields == FULL:
+        return None
+    tree = parse(fields or view)
+
+    def shape(data: Any) -> Any:
+        with span("view.project", fields=fields or "compact"):
+            return select(data, tree, shrink_images=not fields)
+
+    return shape
@@ -0,0 +1,367 @@
+"""Benchmarks for the API against the offline mock upstream.
+
+Starts the mock server and the API as subprocesses on free ports, with a
+throwaway data and media directory, then measures
+
+* request latency (p50/p95/p99) and throughput for /playlists,
+  /playlist/{id} and /search/tracks at a fixed number of concurrent clients,
+* full-library sync throughput for a synthetic account,
+* end-to-end download pipeline rate (needs ffmpeg).
+
+    python bench.py run -o before.json
+    python bench.py run -o after.json
+    python bench.py compare before.json after.json
+
+``compare`` exits non-zero when a metric got worse by more than the
+threshold, so it can gate a CI job. Only compare runs from the same
+machine with the same parameters; tail latencies on small machines move
+by more than the default threshold between identical runs, so use a
+larger --threshold for p95/p99 gating there.
+"""
+import os
+import sys
+import json
+import math
+import time
+import socket
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+import httpx
+
+from fixtures import WORDS
+
+MOCK_DIR = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(os.path.dirname(MOCK_DIR), "api")
+# Mirrors sync.LIKED_SONGS_ID, the prefix of each user's liked songs id; the API is
+# not importable from here without its settings
+LIKED_SONGS_ID = "liked_songs"
+
+
+class BenchConfig:
+    CLIENTS = int(os.getenv("BENCH_CLIENTS", "32"))
+    REQUESTS = int(os.getenv("BENCH_REQUESTS", "2000"))
+    WARMUP = int(os.getenv("BENCH_WARMUP", "100"))
+    # Size of the synthetic account synced before the latency runs
+    LIBRARY_TRACKS = int(os.getenv("BENCH_LIBRARY_TRACKS", "20000"))
+    PLAYLIST_TRACKS = int(os.getenv("BENCH_PLAYLIST_TRACKS", "200"))
+    DOWNLOAD_TRACKS = int(os.getenv("BENCH_DOWNLOAD_TRACKS", "50"))
+    UPSTREAM_LATENCY_MS = float(os.getenv("BENCH_UPSTREAM_LATENCY_MS", "20"))
+    STARTUP_TIMEOUT = float(os.getenv("BENCH_STARTUP_TIMEOUT", "60"))
+    DOWNLOAD_TIMEOUT = float(os.getenv("BENCH_DOWNLOAD_TIMEOUT", "900"))
+    # Relative change that counts as a regression in compare mode
+    THRESHOLD = float(os.getenv("BENCH_THRESHOLD", "0.1"))
+
+
+AUTH = {"Authorization": "Bearer bench"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode} during startup")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:g}s")
+
+
+@contextmanager
+def serve(cwd: str, port: int, env: dict, ready_path: str, log_path: str):
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app" if cwd == API_DIR else "server:app",
+             "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=cwd, env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT,
+        )
+        try:
+            wait_ready(f"http://127.0.0.1:{port}{ready_path}", process, BenchConfig.STARTUP_TIMEOUT)
+            yield f"http://127.0.0.1:{port}"
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def percentile(ordered: list[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered), max(1, math.ceil(p / 100 * len(ordered)))) - 1]
+
+
+async def load_test(client: httpx.AsyncClient, paths: list[str], clients: int, requests: int, warmup: int) -> dict:
+    """Fire ``requests`` GETs cycling through ``paths`` from ``clients`` concurrent workers."""
+    cycle = itertools.cycle(paths)
+    for _ in range(warmup):
+        await client.get(next(cycle), headers=AUTH)
+
+    remaining = itertools.count()
+    latencies: list[float] = []
+    statuses = Counter()
+
+    async def worker():
+        while next(remaining) < requests:
+            start = time.perf_counter()
+            try:
+                status = str((await client.get(next(cycle), headers=AUTH)).status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": sum(n for status, n in statuses.items() if not status.startswith(("2", "3"))),
+        "statuses": dict(statuses),
+        "rps": round(len(latencies) / elapsed, 1),
+        **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 2) for p in (50, 95, 99)},
+    }
+
+
+async def bench_sync(client: httpx.AsyncClient) -> dict:
+    started = time.perf_counter()
+    response = await client.post("/sync", headers=AUTH, timeout=None)
+    response.raise_for_status()
+    elapsed = time.perf_counter() - started
+    summary = response.json()
+    tracks = sum(diff["added"] for diff in summary["diffs"].values())
+
+    # Nothing changed upstream, so this is the snapshot-id fast path
+    started = time.perf_counter()
+    (await client.post("/sync", headers=AUTH, timeout=None)).raise_for_status()
+    return {
+        "playlists": summary["playlists"],
+        "tracks": tracks,
+        "seconds": round(elapsed, 3),
+        "tracks_per_sec": round(tracks / elapsed, 1),
+        "resync_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+async def bench_api(client: httpx.AsyncClient, playlist_ids: list[str], clients: int, requests: int,
+                    warmup: int) -> dict:
+    queries = [f"{a} {b}" for a, b in itertools.islice(itertools.product(WORDS, WORDS), 200)]
+    routes = {
+        "/playlists": ["/playlists"],
+        "/playlist/{id}": [f"/playlist/{playlist_id}" for playlist_id in playlist_ids],
+        "/search/tracks": [f"/search/tracks?query={query}" for query in queries],
+    }
+    return {route: await load_test(client, paths, clients, requests, warmup) for route, paths in routes.items()}
+
+
+async def bench_download(client: httpx.AsyncClient, playlist_ids: list[str], tracks: int) -> dict:
+    if shutil.which("ffmpeg") is None:
+        return {"skipped": "ffmpeg not found"}
+
+    started = time.perf_counter()
+    jobs = []
+    for playlist_id in playlist_ids:
+        if tracks <= 0:
+            break
+        job = (await client.post(f"/download/playlist/{playlist_id}", headers=AUTH)).json()
+        jobs.append(job["id"])
+        tracks -= job["scheduled"]
+
+    deadline = time.monotonic() + BenchConfig.DOWNLOAD_TIMEOUT
+    while True:
+        counts = [(await client.get(f"/download/jobs/{job_id}", headers=AUTH)).json()["counts"] for job_id in jobs]
+        finished = {status: sum(c[status] for c in counts) for status in ("completed", "failed", "skipped")}
+        total = sum(sum(c.values()) for c in counts)
+        if sum(finished.values()) >= total or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.25)
+
+    elapsed = time.perf_counter() - started
+    pipeline = (await client.get("/download/jobs", headers=AUTH)).json()["pipeline"]
+    return {
+        "tracks": total,
+        **finished,
+        "timed_out": sum(finished.values()) < total,
+        "seconds": round(elapsed, 3),
+        "tracks_per_sec": round(finished["completed"] / elapsed, 2),
+        "bytes_per_sec": round(pipeline["bandwidth"]["bytes"] / elapsed),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=MOCK_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    mock_port, api_port = free_port(), free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    playlists = max(1, args.library_tracks // BenchConfig.PLAYLIST_TRACKS)
+    mock_env = {
+        "MOCK_PUBLIC_URL": mock_url,
+        "MOCK_SEED": str(args.seed),
+        "MOCK_CATALOG_TRACKS": str(args.library_tracks),
+        "MOCK_PLAYLISTS": str(playlists),
+        "MOCK_PLAYLIST_TRACKS": str(BenchConfig.PLAYLIST_TRACKS),
+        "MOCK_LATENCY_MS": str(args.upstream_latency_ms),
+        "MOCK_AUDIO_DIR": os.path.join(workdir, "audio"),
+    }
+    api_env = {
+        "DATA_DIR": os.path.join(workdir, "data"),
+        "MEDIA_DIR": os.path.join(workdir, "media"),
+        "SPOTIFY_CLIENT_ID": "bench",
+        "SPOTIFY_API_URL": f"{mock_url}/v1",
+        "SPOTIFY_ACCOUNTS_URL": mock_url,
+        "MOCK_YOUTUBE_URL": mock_url,
+        "YOUTUBE_SEARCH_KEY": "mockytsearch",
+        "PYTHONPATH": os.pathsep.join(filter(None, [MOCK_DIR, os.getenv("PYTHONPATH")])),
+    }
+
+    async def measure(api_url: str) -> dict:
+        async with httpx.AsyncClient(base_url=api_url, timeout=60,
+                                     limits=httpx.Limits(max_connections=args.clients)) as client:
+            results = {"sync": await bench_sync(client)}
+            # Liked songs are stored like a playlist but Spotify has no playlist behind them
+            library = await client.get("/library/playlists", headers=AUTH)
+            library.raise_for_status()
+            playlist_ids = [playlist["id"] for playlist in library.json()["items"]
+                            if not playlist["id"].startswith(LIKED_SONGS_ID)]
+            results["api"] = await bench_api(client, playlist_ids, args.clients, args.requests, args.warmup)
+            if args.download_tracks:
+                results["download"] = await bench_download(client, playlist_ids, args.download_tracks)
+            return results
+
+    try:
+        with serve(MOCK_DIR, mock_port, mock_env, "/_mock/config", os.path.join(workdir, "mock.log")), \
+                serve(API_DIR, api_port, api_env, "/ping", os.path.join(workdir, "api.log")) as api_url:
+            results = asyncio.run(measure(api_url))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "params": {
+                "clients": args.clients, "requests": args.requests, "warmup": args.warmup, "seed": args.seed,
+                "library_tracks": args.library_tracks, "download_tracks": args.download_tracks,
+                "upstream_latency_ms": args.upstream_latency_ms,
+            },
+        },
+        "results": results,
+    }
+
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def direction(metric: str) -> int:
+    """+1 when higher is better, -1 when lower is better, 0 for plain counts."""
+    name = metric.rsplit(".", 1)[-1]
+    if name in ("rps", "tracks_per_sec", "bytes_per_sec", "completed"):
+        return 1
+    if name.endswith("_ms") or name.endswith("seconds") or name in ("errors", "failed"):
+        return -1
+    return 0
+
+
+def compare(base: dict, new: dict, threshold: float) -> tuple[list[tuple], int]:
+    before, after = flatten(base["results"]), flatten(new["results"])
+    rows, regressions = [], 0
+    for metric in sorted(before.keys() & after.keys()):
+        old, value = before[metric], after[metric]
+        change = (value - old) / old if old else (0.0 if value == old else float("inf"))
+        sign = direction(metric)
+        verdict = ""
+        if sign and change * sign < -threshold:
+            verdict = "REGRESSION"
+            regressions += 1
+        elif sign and change * sign > threshold:
+            verdict = "improved"
+        rows.append((metric, old, value, change, verdict))
+    return rows, regressions
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks and write JSON results")
+    run_parser.add_argument("-o", "--output", help="results file (default: stdout)")
+    run_parser.add_argument("--clients", type=int, default=BenchConfig.CLIENTS)
+    run_parser.add_argument("--requests", type=int, default=BenchConfig.REQUESTS, help="requests per route")
+    run_parser.add_argument("--warmup", type=int, default=BenchConfig.WARMUP)
+    run_parser.add_argument("--library-tracks", type=int, default=BenchConfig.LIBRARY_TRACKS)
+    run_parser.add_argument("--download-tracks", type=int, default=BenchConfig.DOWNLOAD_TRACKS,
+                            help="rough number of tracks to download, 0 to skip")
+    run_parser.add_argument("--upstream-latency-ms", type=float, default=BenchConfig.UPSTREAM_LATENCY_MS)
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--keep", action="store_true", help="keep the work directory and server logs")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=BenchConfig.THRESHOLD,
+                                help="relative change counted as a regression (default: %(default)s)")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        output = json.dumps(run(args), indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output + "\n")
+        else:
+            print(output)
+        return 0
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows, regressions = compare(base, new, args.threshold)
+    print(f"{base['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    width = max((len(row[0]) for row in rows), default=0)
+    for metric, old, value, change, verdict in rows:
+        print(f"{metric:<{width}}  {old:>12g}  {value:>12g}  {change:>+8.1%}  {verdict}")
+    if regressions:
+        print(f"{regressions} metric(s) regressed by more than {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import os
+import json
+import random
+import hashlib
+import string
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+class FixtureConfig:
+    SEED = int(os.getenv("MOCK_SEED", "1"))
+    CATALOG_TRACKS = int(os.getenv("MOCK_CATALOG_TRACKS", "5000"))
+    PLAYLISTS = int(os.getenv("MOCK_PLAYLISTS", "20"))
+    # Playlist sizes are drawn around this mean
+    PLAYLIST_TRACKS = int(os.getenv("MOCK_PLAYLIST_TRACKS", "200"))
+    LIKED_TRACKS = int(os.getenv("MOCK_LIKED_TRACKS", "500"))
+    FILE = os.getenv("MOCK_FIXTURES")
+    PUBLIC_URL = os.getenv("MOCK_PUBLIC_URL", "http://localhost:8900").rstrip("/")
+
+
+WORDS = ("blue", "night", "river", "golden", "echo", "summer", "fire", "paper", "glass", "ghost", "city", "heart",
+         "wild", "silver", "moon", "static", "velvet", "ocean", "neon", "dust", "lights", "home", "shadow", "dream")
+BASE62 = string.digits + string.ascii_letters
+
+
+def spotify_id(rng: random.Random) -> str:
+    return "".join(rng.choice(BASE62) for _ in range(22))
+
+
+def snapshot_id(items: list[dict]) -> str:
+    digest = hashlib.sha1("".join(item["track"]["id"] for item in items).encode()).hexdigest()
+    return digest[:32]
+
+
+@dataclass
+class Library:
+    """A fake Spotify account: catalog, playlists and liked songs."""
+    user: dict
+    artists: dict[str, dict] = field(default_factory=dict)
+    albums: dict[str, dict] = field(default_factory=dict)
+    tracks: dict[str, dict] = field(default_factory=dict)
+    features: dict[str, dict] = field(default_factory=dict)
+    playlists: dict[str, dict] = field(default_factory=dict)
+    playlist_items: dict[str, list[dict]] = field(default_factory=dict)
+    liked: list[dict] = field(default_factory=list)
+
+    def track_item(self, track_id: str, added_at: str) -> dict:
+        return {"added_at": added_at, "is_local": False, "track": self.tracks[track_id]}
+
+    def set_items(self, playlist_id: str, items: list[dict]):
+        self.playlist_items[playlist_id] = items
+        playlist = self.playlists[playlist_id]
+        playlist["snapshot_id"] = snapshot_id(items)
+        playlist["tracks"] = {"href": f"{FixtureConfig.PUBLIC_URL}/v1/playlists/{playlist_id}/tracks",
+                              "total": len(items)}
+
+    def to_dict(self) -> dict:
+        return {
+            "user": self.user, "artists": self.artists, "albums": self.albums, "tracks": self.tracks,
+            "features": self.features, "playlists": self.playlists, "playlist_items": {
+                playlist_id: [[item["track"]["id"], item["added_at"]] for item in items]
+                for playlist_id, items in self.playlist_items.items()
+            },
+            "liked": [[item["track"]["id"], item["added_at"]] for item in self.liked],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Library":
+        library = cls(data["user"], data["artists"], data["albums"], data["tracks"], data["features"],
+                      data["playlists"])
+        for playlist_id, items in data["playlist_items"].items():
+            library.set_items(playlist_id, [library.track_item(track_id, added) for track_id, added in items])
+        library.liked = [library.track_item(track_id, added) for track_id, added in data["liked"]]
+        return library
+
+
+def _added_at(rng: random.Random) -> str:
+    return f"20{rng.randint(15, 24)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00Z"
+
+
+def generate(seed: int = FixtureConfig.SEED, catalog: int = FixtureConfig.CATALOG_TRACKS,
+             playlists: int = FixtureConfig.PLAYLISTS, playlist_tracks: int = FixtureConfig.PLAYLIST_TRACKS,
+             liked: int = FixtureConfig.LIKED_TRACKS) -> Library:
+    """Build a deterministic library; the same arguments always give the same data."""
+    rng = random.Random(seed)
+    base = FixtureConfig.PUBLIC_URL
+    user_id = "mockuser"
+    library = Library({"id": user_id, "display_name": "Mock User", "email": "mock@example.com",
+                       "country": "US", "product": "premium", "type": "user", "uri": f"spotify:user:{user_id}"})
+
+    artists = []
+    for _ in range(max(1, catalog // 20)):
+        artist_id = spotify_id(rng)
+        name = " ".join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 2)))
+        artists.append(library.artists.setdefault(artist_id, {
+            "id": artist_id, "name": name, "type": "artist", "uri": f"spotify:artist:{artist_id}",
+        }))
+
+    album_tracks: list[list[str]] = []
+    for _ in range(max(1, catalog // 10)):
+        album_id = spotify_id(rng)
+        artist = rng.choice(artists)
+        library.albums[album_id] = {
+            "id": album_id, "name": " ".join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 3))),
+            "album_type": "album", "artists": [artist], "release_date": f"{rng.randint(1970, 2024)}-01-01",
+            "release_date_precision": "day", "total_tracks": 0, "uri": f"spotify:album:{album_id}",
+            "images": [{"url": f"{base}/images/{album_id}/{size}.jpg", "width": size, "height": size}
+                       for size in (640, 300, 64)],
+        }
+        album_tracks.append([])
+
+    album_ids = list(library.albums)
+    for index in range(catalog):
+        album = library.albums[album_ids[index % len(album_ids)]]
+        track_id = spotify_id(rng)
+        album["total_tracks"] += 1
+        featured = [rng.choice(artists)] if rng.random() < 0.15 else []
+        library.tracks[track_id] = {
+            "id": track_id, "name": " ".join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 4))),
+            "artists": album["artists"] + featured, "album": album, "duration_ms": rng.randint(120_000, 360_000),
+            "track_number": album["total_tracks"], "disc_number": 1, "explicit": rng.random() < 0.2,
+            "popularity": rng.randint(0, 100), "external_ids": {"isrc": f"QZ{rng.randint(0, 10 ** 10):010d}"},
+            "is_local": False, "type": "track", "uri": f"spotify:track:{track_id}",
+        }
+        library.features[track_id] = {
+            "id": track_id, "danceability": round(rng.random(), 3), "energy": round(rng.random(), 3),
+            "tempo": round(rng.uniform(60, 180), 3), "valence": round(rng.random(), 3),
+            "key": rng.randint(0, 11), "mode": rng.randint(0, 1), "loudness": round(rng.uniform(-20, 0), 3),
+            "duration_ms": library.tracks[track_id]["duration_ms"], "type": "audio_features",
+        }
+
+    track_ids = list(library.tracks)
+    for index in range(playlists):
+        playlist_id = spotify_id(rng)
+        library.playlists[playlist_id] = {
+            "id": playlist_id, "name": f"{rng.choice(WORDS).title()} Mix {index + 1}",
+            "description": "", "public": rng.random() < 0.5, "collaborative": False,
+            "owner": {"id": user_id, "display_name": "Mock User"}, "type": "playlist",
+            "uri": f"spotify:playlist:{playlist_id}",
+            "images": [{"url": f"{base}/images/{playlist_id}/300.jpg", "width": 300, "height": 300}],
+        }
+        size = max(1, int(rng.gauss(playlist_tracks, playlist_tracks / 4)))
+        chosen = rng.sample(track_ids, min(size, len(track_ids)))
+        library.set_items(playlist_id, [library.track_item(track_id, _added_at(rng)) for track_id in chosen])
+
+    liked_ids = rng.sample(track_ids, min(liked, len(track_ids)))
+    library.liked = sorted((library.track_item(track_id, _added_at(rng)) for track_id in liked_ids),
+                           key=lambda item: item["added_at"], reverse=True)
+    return library
+
+
+def load(path: Optional[str] = FixtureConfig.FILE) -> Library:
+    if path:
+        with open(path) as f:
+            return Library.from_dict(json.load(f))
+    return generate()
+
+
+if __name__ == "__main__":
+    # Freeze the generated library so a run can be reproduced with MOCK_FIXTURES
+    print(json.dumps(generate().to_dict()))
@@ -0,0 +1,339 @@
+"""Offline stand-in for the Spotify Web API, Spotify accounts and YouTube.
+
+Serves a deterministic fixture library (see fixtures.py) with Spotify's
+paging, ETags and error shapes, plus configurable latency and 429/5xx
+injection. Run it with
+
+    uvicorn server:app --port 8900
+
+and point the API at it with SPOTIFY_API_URL=http://localhost:8900/v1 and
+SPOTIFY_ACCOUNTS_URL=http://localhost:8900. For downloads, put this
+directory on PYTHONPATH (it ships a yt-dlp plugin) and set
+YOUTUBE_SEARCH_KEY=mockytsearch.
+"""
+import os
+import base64
+import random
+import asyncio
+import hashlib
+import tempfile
+import itertools
+from collections import Counter
+from typing import Optional
+from urllib.parse import parse_qs
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response
+
+from fixtures import FixtureConfig, Library, load
+
+
+class MockConfig:
+    LATENCY_MS = float(os.getenv("MOCK_LATENCY_MS", "0"))
+    JITTER_MS = float(os.getenv("MOCK_JITTER_MS", "0"))
+    # Fault injection for Spotify routes: every Nth request and/or a probability
+    RATE_LIMIT_EVERY = int(os.getenv("MOCK_429_EVERY", "0"))
+    RATE_LIMIT_P = float(os.getenv("MOCK_429_P", "0"))
+    RETRY_AFTER = int(os.getenv("MOCK_RETRY_AFTER", "1"))
+    ERROR_EVERY = int(os.getenv("MOCK_5XX_EVERY", "0"))
+    ERROR_P = float(os.getenv("MOCK_5XX_P", "0"))
+    AUDIO_DIR = os.getenv("MOCK_AUDIO_DIR", os.path.join(tempfile.gettempdir(), "mock-audio"))
+
+    @classmethod
+    def as_dict(cls) -> dict:
+        return {key.lower(): getattr(cls, key) for key in
+                ("LATENCY_MS", "JITTER_MS", "RATE_LIMIT_EVERY", "RATE_LIMIT_P", "RETRY_AFTER", "ERROR_EVERY", "ERROR_P")}
+
+
+app = FastAPI(title="Spotify/YouTube mock")
+library: Library = load()
+rng = random.Random(FixtureConfig.SEED)
+counter = itertools.count(1)
+stats = Counter()
+tokens = itertools.count(1)
+BASE = FixtureConfig.PUBLIC_URL
+
+# A silent MPEG-1 layer III frame: 128 kbps, 44.1 kHz, 1152 samples
+MP3_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+MP3_FRAME_SECONDS = 1152 / 44100
+
+
+def spotify_error(status: int, message: str, headers: Optional[dict] = None) -> JSONResponse:
+    return JSONResponse({"error": {"status": status, "message": message}}, status_code=status, headers=headers)
+
+
+@app.middleware("http")
+async def inject(request: Request, call_next):
+    path = request.url.path
+    if path.startswith("/_mock"):
+        return await call_next(request)
+    delay = MockConfig.LATENCY_MS + rng.uniform(0, MockConfig.JITTER_MS)
+    if delay:
+        await asyncio.sleep(delay / 1000)
+
+    route = "/" + "/".join(path.strip("/").split("/")[:2])
+    stats[f"requests {route}"] += 1
+    if path.startswith("/v1") or path == "/api/token":
+        n = next(counter)
+        if (MockConfig.RATE_LIMIT_EVERY and n % MockConfig.RATE_LIMIT_EVERY == 0) or rng.random() < MockConfig.RATE_LIMIT_P:
+            stats["429"] += 1
+            return spotify_error(429, "API rate limit exceeded", {"Retry-After": str(MockConfig.RETRY_AFTER)})
+        if (MockConfig.ERROR_EVERY and n % MockConfig.ERROR_EVERY == 0) or rng.random() < MockConfig.ERROR_P:
+            stats["5xx"] += 1
+            return spotify_error(rng.choice((500, 502, 503)), "Injected failure")
+        if path.startswith("/v1") and not request.headers.get("Authorization", "").startswith("Bearer "):
+            return spotify_error(401, "No token provided")
+    return await call_next(request)
+
+
+def page(items: list, request: Request, offset: int, limit: int, max_limit: int) -> dict:
+    if not 0 < limit <= max_limit:
+        raise HTTPException(status_code=400, detail=f"Invalid limit, must be 1-{max_limit}")
+    url = str(request.url.remove_query_params(["offset", "limit"]))
+    separator = "&" if "?" in url else "?"
+
+    def link(at: int) -> str:
+        return f"{url}{separator}offset={at}&limit={limit}"
+
+    return {
+        "href": link(offset),
+        "items": items[offset:offset + limit],
+        "limit": limit,
+        "next": link(offset + limit) if offset + limit < len(items) else None,
+        "offset": offset,
+        "previous": link(max(0, offset - limit)) if offset > 0 else None,
+        "total": len(items),
+    }
+
+
+def with_etag(request: Request, data: dict, tag: str):
+    etag = f'"{tag}"'
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(data, headers={"ETag": etag})
+
+
+def get_or_404(collection: dict, key: str, kind: str) -> dict:
+    if key not in collection:
+        raise HTTPException(status_code=404, detail=f"Non existing {kind} id")
+    return collection[key]
+
+
+def ids_param(ids: str, limit: int) -> list[str]:
+    values = [value for value in ids.split(",") if value]
+    if len(values) > limit:
+        raise HTTPException(status_code=400, detail="Too many ids requested")
+    return values
+
+
+# Spotify accounts
+
+@app.get("/authorize")
+async def authorize(redirect_uri: str, state: Optional[str] = None):
+    location = f"{redirect_uri}?code=mock-code" + (f"&state={state}" if state else "")
+    return RedirectResponse(location)
+
+
+@app.post("/api/token")
+async def token(request: Request):
+    # Parsed by hand: request.form() needs python-multipart, which the API does not depend on
+    form = {key: values[0] for key, values in parse_qs((await request.body()).decode()).items()}
+    if form.get("grant_type") not in ("authorization_code", "refresh_token"):
+        return JSONResponse({"error": "unsupported_grant_type"}, status_code=400)
+    data = {"access_token": f"mock-access-{next(tokens)}", "token_type": "Bearer", "expires_in": 3600,
+            "scope": "playlist-read-private user-library-read"}
+    if form.get("grant_type") == "authorization_code":
+        data["refresh_token"] = f"mock-refresh-{next(tokens)}"
+    return data
+
+
+# Spotify Web API
+
+@app.get("/v1/me")
+async def me(request: Request):
+    return with_etag(request, library.user, hashlib.sha1(library.user["id"].encode()).hexdigest())
+
+
+@app.get("/v1/me/playlists")
+async def my_playlists(request: Request, offset: int = 0, limit: int = 20):
+    return page(list(library.playlists.values()), request, offset, limit, 50)
+
+
+@app.get("/v1/me/tracks")
+async def saved_tracks(request: Request, offset: int = 0, limit: int = 20):
+    return page(library.liked, request, offset, limit, 50)
+
+
+@app.get("/v1/playlists/{playlist_id}")
+async def playlist(request: Request, playlist_id: str):
+    header = get_or_404(library.playlists, playlist_id, "playlist")
+    tracks = page(library.playlist_items[playlist_id], request, 0, 100, 100)
+    tracks["href"] = f"{BASE}/v1/playlists/{playlist_id}/tracks"
+    tracks["next"] = tracks["next"] and f"{tracks['href']}?offset=100&limit=100"
+    return with_etag(request, {**header, "tracks": tracks}, header["snapshot_id"])
+
+
+@app.get("/v1/playlists/{playlist_id}/tracks")
+async def playlist_tracks(request: Request, playlist_id: str, offset: int = 0, limit: int = 100):
+    get_or_404(library.playlists, playlist_id, "playlist")
+    return page(library.playlist_items[playlist_id], request, offset, limit, 100)
+
+
+@app.get("/v1/tracks")
+async def tracks(ids: str):
+    return {"tracks": [library.tracks.get(track_id) for track_id in ids_param(ids, 50)]}
+
+
+@app.get("/v1/tracks/{track_id}")
+async def track(track_id: str):
+    return get_or_404(library.tracks, track_id, "track")
+
+
+@app.get("/v1/audio-features")
+async def audio_features(ids: str):
+    return {"audio_features": [library.features.get(track_id) for track_id in ids_param(ids, 100)]}
+
+
+@app.get("/v1/albums/{album_id}")
+async def album(album_id: str):
+    return get_or_404(library.albums, album_id, "album")
+
+
+def search_tracks(query: str) -> list[dict]:
+    query = " ".join(query.lower().split())
+    words = query.split()
+    found = []
+    for track in library.tracks.values():
+        text = f"{track['artists'][0]['name']} {track['name']}".lower()
+        if all(word in text for word in words):
+            found.append((query not in text, len(text.split()) - len(words), text, track))
+    # An exact "artist title" phrase ranks first, then the closest word count
+    return [item[-1] for item in sorted(found, key=lambda item: item[:3])]
+
+
+@app.get("/v1/search")
+async def search(request: Request, q: str, type: str = "track", offset: int = 0, limit: int = 20):
+    if "track" not in type.split(","):
+        raise HTTPException(status_code=400, detail="Only track search is mocked")
+    return {"tracks": page(search_tracks(q), request, offset, limit, 50)}
+
+
+# A real 64x64 baseline JPEG, so image decoders (Pillow in the covers cache) accept it
+JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAA0JCgsKCA0LCgsODg0PEyAVExISEyccHhcgLikxMC4pLSwzOko+MzZGNywtQFdB"
+    "RkxOUlNSMj5aYVpQYEpRUk//2wBDAQ4ODhMREyYVFSZPNS01T09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09P"
+    "T09PT09PT09PT09PT0//wAARCABAAEADASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAA"
+    "AgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6"
+    "Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXG"
+    "x8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREA"
+    "AgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5"
+    "OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPE"
+    "xcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwDFooor2CgooooAKKKKACiiigAooooAKKKK"
+    "ACiiigAooooAKKKKACiiigAooooAKKKKACiiigAooooAKKKKACiiigD/2Q=="
+)
+
+
+@app.get("/images/{owner_id}/{size}.jpg")
+async def image(owner_id: str, size: int):
+    # A comment segment after SOI makes every image's bytes distinct and keeps the JPEG valid
+    comment = f"{owner_id}:{size}".encode()
+    segment = b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment
+    return Response(JPEG[:2] + segment + JPEG[2:], media_type="image/jpeg",
+                    headers={"Cache-Control": "public, max-age=86400"})
+
+
+# YouTube stand-in, used through the yt-dlp plugin in yt_dlp_plugins/
+
+def video(track: dict, kind: str = "") -> dict:
+    artist = track["artists"][0]["name"]
+    duration = track["duration_ms"] / 1000
+    title, channel = track["name"], f"{artist} - Topic"
+    if kind == "live":
+        title, duration, channel = f"{artist} - {track['name']} (Live)", duration + 45, "Concert Archive"
+    elif kind == "cover":
+        title, channel = f"{track['name']} (Cover)", "Bedroom Covers"
+    return {
+        "id": f"{kind or 'yt'}-{track['id']}", "title": title, "channel": channel, "duration": round(duration),
+        "url": f"{BASE}/youtube/watch/{kind or 'yt'}-{track['id']}",
+    }
+
+
+@app.get("/youtube/search")
+async def youtube_search(q: str, n: int = 5):
+    entries = []
+    for track in search_tracks(q)[:n]:
+        # The real upload plus decoys that candidate scoring should reject
+        entries += [video(track, "live"), video(track, "cover"), video(track)]
+    return {"entries": entries[:n]}
+
+
+def find_video(video_id: str) -> dict:
+    kind, _, track_id = video_id.partition("-")
+    track = get_or_404(library.tracks, track_id, "video")
+    return {**video(track, "" if kind == "yt" else kind),
+            "audio_url": f"{BASE}/youtube/audio/{video_id}.mp3"}
+
+
+@app.get("/youtube/video/{video_id}")
+async def youtube_video(video_id: str):
+    return find_video(video_id)
+
+
+@app.get("/youtube/audio/{video_id}.mp3")
+async def youtube_audio(video_id: str):
+    duration = find_video(video_id)["duration"]
+    path = os.path.join(MockConfig.AUDIO_DIR, f"{video_id}.mp3")
+    if not os.path.exists(path):
+        os.makedirs(MockConfig.AUDIO_DIR, exist_ok=True)
+        staging = f"{path}.{os.getpid()}.tmp"
+        with open(staging, "wb") as f:
+            f.write(MP3_FRAME * int(duration / MP3_FRAME_SECONDS))
+        os.replace(staging, path)
+    # FileResponse answers Range requests, so resumed downloads work
+    return FileResponse(path, media_type="audio/mpeg")
+
+
+# Control
+
+@app.get("/_mock/config")
+async def get_config():
+    return MockConfig.as_dict()
+
+
+@app.put("/_mock/config")
+async def set_config(changes: dict):
+    for key, value in changes.items():
+        if key.upper() not in MockConfig.__dict__:
+            raise HTTPException(status_code=400, detail=f"Unknown setting {key}")
+        setattr(MockConfig, key.upper(), type(getattr(MockConfig, key.upper()))(value))
+    return MockConfig.as_dict()
+
+
+@app.get("/_mock/stats")
+async def get_stats():
+    return dict(stats)
+
+
+@app.post("/_mock/mutate")
+async def mutate(playlists: int = 1, seed: Optional[int] = None):
+    """Change some playlists (add, remove and move tracks) so incremental sync has work to do."""
+    mutation = random.Random(seed)
+    changed = mutation.sample(list(library.playlists), min(playlists, len(library.playlists)))
+    track_ids = list(library.tracks)
+    for playlist_id in changed:
+        items = list(library.playlist_items[playlist_id])
+        if items:
+            items.pop(mutation.randrange(len(items)))
+        if len(items) > 1:
+            items.insert(mutation.randrange(len(items)), items.pop(mutation.randrange(len(items))))
+        items.append(library.track_item(mutation.choice(track_ids), "2025-01-01T00:00:00Z"))
+        library.set_items(playlist_id, items)
+    return {"changed": changed, "snapshots": {pid: library.playlists[pid]["snapshot_id"] for pid in changed}}
+
+
+@app.post("/_mock/reset")
+async def reset():
+    global library
+    library = load()
+    stats.clear()
+    return {"playlists": len(library.playlists), "tracks": len(library.tracks)}
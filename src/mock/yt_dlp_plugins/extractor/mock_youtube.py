@@ -0,0 +1,46 @@
+"""yt-dlp extractors for the mock server's YouTube stand-in.
+
+Loaded automatically by yt-dlp when src/mock is on PYTHONPATH. Searches
+use the ``mockytsearch`` key and videos resolve to silent mp3 files of the
+matching track's length, so the whole download pipeline runs offline.
+"""
+import os
+
+from yt_dlp.extractor.common import InfoExtractor, SearchInfoExtractor
+
+MOCK_URL = os.getenv("MOCK_YOUTUBE_URL", os.getenv("MOCK_PUBLIC_URL", "http://localhost:8900")).rstrip("/")
+
+
+class MockYouTubeIE(InfoExtractor):
+    IE_NAME = "mockyoutube"
+    _VALID_URL = r"https?://[^/]+/youtube/watch/(?P<id>[\w-]+)"
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        base = url.split("/youtube/")[0]
+        info = self._download_json(f"{base}/youtube/video/{video_id}", video_id)
+        return {
+            "id": video_id,
+            "title": info["title"],
+            "channel": info["channel"],
+            "duration": info["duration"],
+            "formats": [{
+                "format_id": "mp3",
+                "url": info["audio_url"],
+                "ext": "mp3",
+                "acodec": "mp3",
+                "vcodec": "none",
+                "abr": 128,
+            }],
+        }
+
+
+class MockYouTubeSearchIE(SearchInfoExtractor):
+    IE_NAME = "mockyoutube:search"
+    _SEARCH_KEY = "mockytsearch"
+
+    def _search_results(self, query):
+        data = self._download_json(f"{MOCK_URL}/youtube/search", query, query={"q": query, "n": 20})
+        for entry in data["entries"]:
+            yield self.url_result(entry["url"], MockYouTubeIE, entry["id"], entry["title"],
+                                  duration=entry["duration"], channel=entry["channel"])
@@ -27,7 +27,7 @@ function App() {
           />
           <Route
             path='/logout'
-            element={<Logout />}
+            element={<Logout setToken={setToken} />}
           />
         </Routes>
       </div>
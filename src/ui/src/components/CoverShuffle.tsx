@@ -30,7 +30,9 @@ const CoverShuffle: React.FC<{ playlistId: string }> = ({ playlistId }) => {
                 name: item.track.name,
                 album: item.track.album.name,
                 artists: item.track.artists.map((artist: any) => artist.name),
-                coverUrl: item.track.album.images[0]?.url,
+                coverUrl: item.track.album.id
+                    ? `http://localhost/api/covers/${item.track.album.id}?size=300`
+                    : item.track.album.images[0]?.url,
             }));
         } catch (error) {
             console.error(error);
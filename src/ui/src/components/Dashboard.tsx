@@ -3,6 +3,7 @@ import { useNavigate } from 'react-router-dom';
 import { Music, LogOut, Loader2, AlertCircle, Search } from 'lucide-react';
 import { Playlist, UserProfile } from './Types';
 import CoverShuffle from './CoverShuffle';
+import { endSession } from './Session';
 
 interface DashboardProps {
   token: string;
@@ -25,14 +26,12 @@ const Dashboard: React.FC<DashboardProps> = ({ token, setToken }) => {
     CoverShuffle({ playlistId });
   };
 
-  const fetchUserData = async (playlistId?: string, trackId?: string, query?: string) => {
+  const fetchUserData = async (query?: string) => {
     setLoading(true);
     const endpoints = [
       'http://localhost/api/me',
       'http://localhost/api/playlists',
-      query ? `http://localhost/api/search/tracks?query=${query}` : null,
-      playlistId ? `http://localhost/api/download/playlist/${playlistId}` : null,
-      trackId ? `http://localhost/api/download/track/${trackId}` : null
+      query ? `http://localhost/api/search/tracks?query=${query}` : null
     ].filter(Boolean) as string[];
 
     try {
@@ -56,21 +55,12 @@ const Dashboard: React.FC<DashboardProps> = ({ token, setToken }) => {
       const [
         profileData,
         playlistsData,
-        searchResults,
-        ...otherData
+        searchResults
       ] = data;
       
       setUserProfile(profileData);
       setPlaylists(playlistsData.items || []);
       setSearchResults(searchResults?.tracks.items || []);
-      
-      if (playlistId && otherData[0]) {
-        setPlaylists(otherData[0].items || []);
-      }
-      
-      // if (trackId && otherData[1]) {
-      //   setTracks(otherData[1].tracks || []);
-      // }
 
     } catch (error) {
       console.error('Failed to fetch user data:', error);
@@ -87,22 +77,35 @@ const Dashboard: React.FC<DashboardProps> = ({ token, setToken }) => {
     fetchUserData();
   }, [token]);
 
-  const handlePlaylistSelect = async (playlistId: string) => {
+  const handlePlaylistSelect = (playlistId: string) => {
     handleSetSelectedPlaylist(playlistId);
-    await fetchUserData(playlistId);
   };
 
-  // const handleTrackDownload = async (trackId: string) => {
-  //   await fetchUserData(undefined, trackId);
-  // };
+  const handlePlaylistDownload = async (playlistId: string) => {
+    try {
+      const response = await fetch(`http://localhost/api/download/playlist/${playlistId}`, {
+        method: 'POST',
+        headers: {
+          'Authorization': `Bearer ${token}`
+        }
+      });
+      if (!response.ok) {
+        throw new Error(`API error: ${response.status}`);
+      }
+      const job = await response.json();
+      console.log('Download job started:', job.id);
+    } catch (error) {
+      console.error('Failed to start download:', error);
+    }
+  };
 
   const handleSearch = async (query: string) => {
     if (!query.trim()) return;
-    await fetchUserData(undefined, undefined, query);
+    await fetchUserData(query);
   };
 
-  const handleLogout = () => {
-    localStorage.removeItem('spotifyToken');
+  const handleLogout = async () => {
+    await endSession();
     setToken(null);
     navigate('/');
   };
@@ -248,7 +251,12 @@ const Dashboard: React.FC<DashboardProps> = ({ token, setToken }) => {
                         <div className="absolute inset-0 bg-gradient-to-t from-black/80 via-black/40 to-transparent 
                                       opacity-0 group-hover:opacity-100 transition-all duration-500
                                       flex items-center justify-center">
-                          <button className="px-6 py-3 rounded-full bg-white/20 backdrop-blur-md
+                          <button
+                                  onClick={(e) => {
+                                    e.stopPropagation();
+                                    handlePlaylistDownload(playlist.id);
+                                  }}
+                                  className="px-6 py-3 rounded-full bg-white/20 backdrop-blur-md
                                           border border-white/30 text-white duration-300
                                           transform translate-y-4 opacity-0
                                           group-hover:translate-y-0 group-hover:opacity-100
@@ -1,9 +1,22 @@
+import React, { useEffect, useState } from 'react';
 import { Navigate } from 'react-router-dom';
+import { endSession } from './Session';
 
+interface LogoutProps {
+  setToken: (token: string | null) => void;
+}
 
-const Logout = () => {
-    localStorage.removeItem('spotifyToken');
-    return <Navigate to="/" />;
+const Logout: React.FC<LogoutProps> = ({ setToken }) => {
+    const [done, setDone] = useState(false);
+
+    useEffect(() => {
+      endSession().then(() => {
+        setToken(null);
+        setDone(true);
+      });
+    }, [setToken]);
+
+    return done ? <Navigate to="/" /> : null;
   }
 
-export default Logout;
\ No newline at end of file
+export default Logout;
@@ -0,0 +1,19 @@
+// Revokes the server-side session before forgetting it locally; the session id
+// alone would otherwise keep working until it expires.
+export const endSession = async (): Promise<void> => {
+  const token = localStorage.getItem('spotifyToken');
+  try {
+    if (token) {
+      await fetch('http://localhost/api/logout', {
+        method: 'POST',
+        headers: {
+          'Authorization': `Bearer ${token}`
+        }
+      });
+    }
+  } catch (error) {
+    console.error('Failed to end session:', error);
+  } finally {
+    localStorage.removeItem('spotifyToken');
+  }
+};
@@ -26,7 +26,6 @@ export interface SpotifyAuthResponse {
     access_token: string;
     token_type: string;
     expires_in: number;
-    refresh_token: string;
     scope: string;
   }
 }
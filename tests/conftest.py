@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# The API modules import each other flat, as they do when the app runs from src/api
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "api"))
+
+# Module-level config reads these on import; keep databases and media out of the tree
+_scratch = tempfile.mkdtemp(prefix="spotify-sync-tests-")
+os.environ.setdefault("DATA_DIR", os.path.join(_scratch, "data"))
+os.environ.setdefault("MEDIA_DIR", os.path.join(_scratch, "media"))
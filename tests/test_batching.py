@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from batching import BatchLoader, chunked
+
+
+class Recorder:
+    def __init__(self, fail: bool = False):
+        self.calls = []
+        self.fail = fail
+
+    async def __call__(self, ids, token):
+        self.calls.append((list(ids), token))
+        if self.fail:
+            raise RuntimeError("upstream down")
+        return [{"id": item_id} for item_id in ids]
+
+
+def test_lookups_close_together_share_one_request():
+    fetch = Recorder()
+
+    async def run():
+        loader = BatchLoader(fetch, max_size=50)
+        return await asyncio.gather(*(loader.load(item_id, "t") for item_id in ("a", "b", "a", "c")))
+
+    results = asyncio.run(run())
+    assert [result["id"] for result in results] == ["a", "b", "a", "c"]
+    assert fetch.calls == [(["a", "b", "c"], "t")]
+
+
+def test_full_batch_is_sent_without_waiting():
+    fetch = Recorder()
+
+    async def run():
+        loader = BatchLoader(fetch, max_size=2)
+        await asyncio.gather(*(loader.load(item_id, "t") for item_id in ("a", "b", "c")))
+
+    asyncio.run(run())
+    assert fetch.calls == [(["a", "b"], "t"), (["c"], "t")]
+
+
+def test_batches_are_per_token():
+    fetch = Recorder()
+
+    async def run():
+        loader = BatchLoader(fetch, max_size=50)
+        await asyncio.gather(loader.load("a", "t1"), loader.load("b", "t2"), loader.load("c", "t1"))
+
+    asyncio.run(run())
+    assert sorted(fetch.calls) == [(["a", "c"], "t1"), (["b"], "t2")]
+
+
+def test_failure_reaches_every_caller():
+    async def run():
+        loader = BatchLoader(Recorder(fail=True), max_size=50)
+        return await asyncio.gather(loader.load("a", "t"), loader.load("b", "t"), return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(run()))
+
+
+def test_cancelled_caller_does_not_cancel_the_batch():
+    fetch = Recorder()
+
+    async def run():
+        loader = BatchLoader(fetch, max_size=50)
+        first = asyncio.create_task(loader.load("a", "t"))
+        second = asyncio.create_task(loader.load("a", "t"))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == {"id": "a"}
+
+
+def test_chunked():
+    assert chunked([1, 2, 3, 4, 5], 2) == [[1, 2], [3, 4], [5]]
+    assert chunked([], 3) == []
@@ -0,0 +1,126 @@
+import asyncio
+import json
+
+import cache
+from cache import CacheConfig, ResponseCache
+
+
+class Upstream:
+    """Fetch callable that counts calls and returns ``data`` (None means 304)."""
+
+    def __init__(self, data=None, etag='"up1"'):
+        self.data = data
+        self.etag = etag
+        self.calls = 0
+        self.seen = []
+
+    async def __call__(self, entry):
+        self.calls += 1
+        self.seen.append(entry.upstream_etag if entry else None)
+        await asyncio.sleep(0.01)
+        return None if self.data is None else (self.data, self.etag)
+
+
+def body(entry):
+    return json.loads(entry.body)
+
+
+def test_miss_then_hit():
+    responses, upstream = ResponseCache(), Upstream({"n": 1})
+
+    async def run():
+        first = await responses.get("alice", "me", "me", upstream)
+        second = await responses.get("alice", "me", "me", upstream)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert body(first) == body(second) == {"n": 1}
+    assert upstream.calls == 1
+    assert (responses.hits, responses.misses) == (1, 1)
+
+
+def test_concurrent_misses_share_one_fetch():
+    responses, upstream = ResponseCache(), Upstream({"n": 1})
+
+    async def run():
+        return await asyncio.gather(*(responses.get("alice", "me", "me", upstream) for _ in range(5)))
+
+    assert len({entry.etag for entry in asyncio.run(run())}) == 1
+    assert upstream.calls == 1
+
+
+def test_scopes_are_separate():
+    responses = ResponseCache()
+
+    async def run():
+        await responses.get("alice", "me", "me", Upstream({"user": "alice"}))
+        return await responses.get("bob", "me", "me", Upstream({"user": "bob"}))
+
+    assert body(asyncio.run(run())) == {"user": "bob"}
+
+
+def test_stale_entry_is_served_while_it_refreshes(monkeypatch):
+    monkeypatch.setitem(CacheConfig.TTLS, "me", 0)
+    responses, upstream = ResponseCache(), Upstream({"n": 1})
+
+    async def run():
+        await responses.get("alice", "me", "me", upstream)
+        upstream.data = {"n": 2}
+        stale = await responses.get("alice", "me", "me", upstream)
+        await asyncio.sleep(0.05)
+        return stale, responses._entries[("alice", "me")]
+
+    stale, refreshed = asyncio.run(run())
+    assert body(stale) == {"n": 1} and body(refreshed) == {"n": 2}
+    assert responses.stale_hits == 1
+    # The refresh revalidated with the upstream validator of the stale copy
+    assert upstream.seen == [None, '"up1"']
+
+
+def test_not_modified_keeps_the_body_and_renews_it(monkeypatch):
+    monkeypatch.setitem(CacheConfig.TTLS, "me", 0)
+    monkeypatch.setattr(CacheConfig, "STALE_SECONDS", 0)
+    responses, upstream = ResponseCache(), Upstream({"n": 1})
+
+    async def run():
+        first = await responses.get("alice", "me", "me", upstream)
+        upstream.data = None
+        return first, await responses.get("alice", "me", "me", upstream)
+
+    first, second = asyncio.run(run())
+    assert second.etag == first.etag and body(second) == {"n": 1}
+    assert second.stored_at > first.stored_at
+
+
+def test_not_modified_without_a_cached_copy_is_no_data():
+    responses = ResponseCache()
+    assert asyncio.run(responses.get("alice", "me", "me", Upstream(None))) is None
+    assert responses.stats()["entries"] == 0
+
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    monkeypatch.setattr(cache.CacheConfig, "MAX_ENTRIES", 2)
+    responses = ResponseCache()
+
+    async def run():
+        for key in ("a", "b"):
+            await responses.get("alice", key, "me", Upstream({"key": key}))
+        await responses.get("alice", "a", "me", Upstream({"key": "a"}))
+        await responses.get("alice", "c", "me", Upstream({"key": "c"}))
+
+    asyncio.run(run())
+    assert [key for _, key in responses._entries] == ["a", "c"]
+
+
+def test_invalidate_drops_a_users_entries():
+    responses = ResponseCache()
+
+    async def run():
+        await responses.get("alice", "me", "me", Upstream({}))
+        await responses.get("alice", "playlists", "playlists", Upstream({}))
+        await responses.get("bob", "me", "me", Upstream({}))
+
+    asyncio.run(run())
+    responses.invalidate("alice")
+    assert list(responses._entries) == [("bob", "me")]
+    assert responses.stats()["bytes"] == responses._entries[("bob", "me")].size()
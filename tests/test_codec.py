@@ -0,0 +1,63 @@
+import gzip
+
+import pytest
+
+import codec
+from cache import CacheEntry
+from codec import compress, compress_all, dumps, loads, negotiate
+
+
+@pytest.fixture
+def brotli_and_gzip(monkeypatch):
+    monkeypatch.setattr(codec, "ENCODINGS", ("br", "gzip"))
+    return ("br", "gzip")
+
+
+def test_negotiate_gzip():
+    assert negotiate("gzip", ("gzip",)) == "gzip"
+    assert negotiate("deflate, gzip;q=0.8", ("gzip",)) == "gzip"
+
+
+def test_negotiate_identity():
+    assert negotiate(None, ("gzip",)) is None
+    assert negotiate("", ("gzip",)) is None
+    assert negotiate("identity", ("gzip",)) is None
+    assert negotiate("gzip;q=0", ("gzip",)) is None
+    # Nothing stored for this entry, e.g. a body too small to compress
+    assert negotiate("gzip", {}) is None
+
+
+def test_negotiate_prefers_brotli(brotli_and_gzip):
+    assert negotiate("gzip, deflate, br", brotli_and_gzip) == "br"
+    assert negotiate("*", brotli_and_gzip) == "br"
+
+
+def test_negotiate_honours_q_values(brotli_and_gzip):
+    assert negotiate("br;q=0.5, gzip", brotli_and_gzip) == "gzip"
+    assert negotiate("br;q=bogus, gzip;q=0.1", brotli_and_gzip) == "gzip"
+    assert negotiate("br", ("gzip",)) is None
+
+
+def test_etag_has_encoding_suffix():
+    entry = CacheEntry(b"{}", '"abc"', None, 0.0, 60.0)
+    assert entry.etag_for(None) == '"abc"'
+    assert entry.etag_for("gzip") == '"abc-gzip"'
+    assert entry.etag_for("br") == '"abc-br"'
+
+
+def test_gzip_is_stable_and_round_trips():
+    body = dumps({"items": list(range(1000))})
+    assert compress(body, "gzip") == compress(body, "gzip")
+    assert loads(gzip.decompress(compress(body, "gzip"))) == {"items": list(range(1000))}
+
+
+def test_brotli_round_trips():
+    brotli = pytest.importorskip("brotli")
+    body = dumps({"items": list(range(1000))})
+    assert brotli.decompress(compress(body, "br")) == body
+
+
+def test_small_bodies_are_not_compressed(monkeypatch):
+    monkeypatch.setattr(codec.CodecConfig, "MIN_SIZE", 1024)
+    assert compress_all(b"{}") == {}
+    assert set(compress_all(b" " * 2048)) == set(codec.ENCODINGS)
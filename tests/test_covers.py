@@ -0,0 +1,100 @@
+import asyncio
+import os
+from io import BytesIO
+
+import pytest
+
+import covers
+from covers import CoverCache, nearest_size
+
+pytest.importorskip("PIL")
+from PIL import Image  # noqa: E402
+
+
+def jpeg(width: int) -> bytes:
+    out = BytesIO()
+    Image.new("RGB", (width, width), (200, 30, 30)).save(out, format="JPEG")
+    return out.getvalue()
+
+
+IMAGES = [{"url": "https://img/640", "width": 640}, {"url": "https://img/300", "width": 300}]
+
+
+class Fetcher:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.urls = []
+
+    async def __call__(self, url: str) -> bytes:
+        self.urls.append(url)
+        await asyncio.sleep(0.01)
+        return self.data
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / "covers")
+
+
+async def images():
+    return IMAGES
+
+
+def test_one_fetch_serves_every_size(cache_dir):
+    fetch = Fetcher(jpeg(640))
+    cache = CoverCache(fetch, cache_dir)
+
+    async def run():
+        return await asyncio.gather(*(cache.get("album", images, size) for size in (64, 300, 640, 640)))
+
+    small, medium, large, again = asyncio.run(run())
+    cache.close()
+    assert fetch.urls == ["https://img/640"]
+    assert len({small, medium, large}) == 3 and again == large
+    with Image.open(cache.path_for(small)) as image:
+        assert image.width == 64
+
+
+def test_identical_variants_are_stored_once(cache_dir):
+    cache = CoverCache(Fetcher(jpeg(48)), cache_dir)
+    digests = {asyncio.run(cache.get("album", images, size)) for size in (64, 300, 640)}
+    cache.close()
+    assert len(digests) == 1
+    assert len(os.listdir(os.path.dirname(cache.path_for(digests.pop())))) == 1
+
+
+def test_least_recently_used_albums_are_evicted(cache_dir, monkeypatch):
+    data = jpeg(48)
+    monkeypatch.setattr(covers.CoverConfig, "MAX_BYTES", len(data) * 2)
+    cache = CoverCache(Fetcher(data), cache_dir)
+
+    async def colour(album_id: str):
+        # Different pixels per album, so nothing is shared
+        cache.fetch.data = jpeg(40 + len(album_id))
+        return await cache.get(album_id, images)
+
+    first = asyncio.run(colour("a"))
+    asyncio.run(colour("bb"))
+    asyncio.run(colour("ccc"))
+    cache.close()
+    assert not os.path.exists(cache.path_for(first))
+
+
+def test_nearest_size():
+    assert nearest_size(None) == 300
+    assert nearest_size(100) == 64
+    assert nearest_size(1000) == 640
+
+
+def test_undecodable_art_is_kept_as_is_for_every_size(cache_dir):
+    data = b"\x89PNG\r\n\x1a\n" + b"not really a png"
+    fetch = Fetcher(data)
+    cache = CoverCache(fetch, cache_dir)
+
+    async def run():
+        return [await cache.get("album", images, size) for size in (64, 300, 640)]
+
+    digests = asyncio.run(run())
+    cache.close()
+    assert len(fetch.urls) == 1 and len(set(digests)) == 1
+    assert cache.media_type(digests[0]) == "image/png"
@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+import pytest
+
+from downloader import DownloadManager, TrackTask
+from jobs import DownloadQueue
+from matches import MatchCache
+from progress import ProgressBus
+from store import LibraryStore
+from sync import diff_items
+from tagging import Tagger
+
+
+def items(*ids):
+    return [{"track": {"id": track_id, "name": track_id, "artists": [{"name": "Artist"}]}} for track_id in ids]
+
+
+def task_of(job: dict, track: dict) -> TrackTask:
+    return TrackTask.from_claim({**track, "job_id": job["id"], "folder": job["folder"]})
+
+
+def touch(path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+
+
+@pytest.fixture
+def manager(tmp_path):
+    queue = DownloadQueue(str(tmp_path / "downloads.db"))
+    manager = DownloadManager(queue, MatchCache(str(tmp_path / "matches.db")), ProgressBus(),
+                              Tagger(LibraryStore(str(tmp_path / "library.db")), None),
+                              media_dir=str(tmp_path / "media"), store_dir=str(tmp_path / "store"))
+    yield manager
+    queue.close()
+
+
+def test_playlist_diff_follows_the_playlist(manager):
+    header = {"id": "p1", "name": "Mix"}
+
+    async def run():
+        job = await manager.submit("Mix", [item["track"] for item in items("a", "b", "c")], "p1")
+        for track in manager.queue.job_tracks(job["id"]):
+            manager.queue.update(job["id"], track["track_id"], manager.owner, "completed")
+            touch(manager.track_path(task_of(job, track)))
+        new = items("x", "c", "a")
+        await manager.on_playlist_diff(header, diff_items(["a", "b", "c"], new), new)
+        return job["id"]
+
+    job_id = asyncio.run(run())
+    assert [track["track_id"] for track in manager.queue.job_tracks(job_id)] == ["x", "c", "a"]
+    assert sorted(os.listdir(os.path.join(manager.media_dir, "Mix"))) == ["Artist - a.mp3", "Artist - c.mp3"]
+    assert job_id in manager._dirty_playlists
+
+
+def test_playlist_diff_ignores_playlists_never_downloaded(manager):
+    new = items("a")
+    asyncio.run(manager.on_playlist_diff({"id": "p1", "name": "Mix"}, diff_items([], new), new))
+    assert manager.queue.jobs() == []
+
+
+def test_tracks_with_the_same_name_get_their_own_links(manager):
+    same = [{"id": track_id, "name": "Intro", "artists": [{"name": "Artist"}]} for track_id in ("a", "b")]
+
+    async def run():
+        return await manager.submit("Mix", same, "p1")
+
+    job = asyncio.run(run())
+    tracks = manager.queue.job_tracks(job["id"])
+    paths = [manager.track_path(task_of(job, track)) for track in reversed(tracks)]
+    assert [os.path.basename(path) for path in paths] == ["Artist - Intro.mp3", "Artist - Intro [a].mp3"]
+    # Names stick once given
+    assert manager.track_path(task_of(job, tracks[1])) == paths[0]
@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+import pytest
+
+from jobs import DownloadQueue
+from progress import ProgressBus, Subscriber
+
+
+def tracks(*ids):
+    return [{"track_id": track_id, "name": track_id} for track_id in ids]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = DownloadQueue(str(tmp_path / "downloads.db"))
+    yield queue
+    queue.close()
+
+
+def test_jobs_are_only_visible_to_users_who_submitted_them(queue):
+    shared, _ = queue.enqueue("Mix", "Mix", tracks("a"), "p1", user_id="alice")
+    queue.enqueue("Mix", "Mix", tracks("a", "b"), "p1", user_id="bob")
+    own, _ = queue.enqueue("Singles", "Singles", tracks("c"), user_id="bob")
+
+    assert [job["id"] for job in queue.jobs("alice")] == [shared]
+    assert {job["id"] for job in queue.jobs("bob")} == {shared, own}
+    assert queue.job(own, "alice") is None and queue.job(own, "bob")["id"] == own
+    assert queue.visible_jobs("alice", [shared, own]) == {shared}
+    assert sorted(queue.user_track_ids("alice")) == ["a", "b"]
+
+
+def test_unscoped_subscriber_only_gets_visible_jobs():
+    received = []
+
+    async def send(seq, frame):
+        received.append(json.loads(frame))
+
+    async def close():
+        pass
+
+    async def visible(job_ids):
+        return job_ids & {"mine"}
+
+    async def run():
+        bus = ProgressBus()
+        await bus.subscribe(Subscriber(send, close, visible=visible))
+        bus.publish("mine", "t1", progress=10)
+        bus.publish("theirs", "t2", progress=20)
+        await bus._tick()
+        bus.publish("theirs", "t2", progress=30)
+        await bus._tick()
+
+    asyncio.run(run())
+    assert [frame["updates"] for frame in received] == [[{"job_id": "mine", "track_id": "t1", "progress": 10}]]
@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+import jobs
+from jobs import DownloadQueue
+
+
+def tracks(*ids):
+    return [{"track_id": track_id, "name": track_id} for track_id in ids]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = DownloadQueue(str(tmp_path / "downloads.db"))
+    yield queue
+    queue.close()
+
+
+def test_enqueue_is_idempotent_per_playlist(queue):
+    job_id, scheduled = queue.enqueue("Mix", "Mix", tracks("a", "b"), "p1")
+    assert scheduled == 2
+    again, scheduled = queue.enqueue("Mix", "Mix", tracks("a", "b", "c"), "p1")
+    assert again == job_id and scheduled == 1
+    assert [track["track_id"] for track in queue.job_tracks(job_id)] == ["a", "b", "c"]
+    assert len(queue.jobs()) == 1
+
+
+def test_enqueue_keeps_progress_but_retries_failures(queue):
+    job_id, _ = queue.enqueue("Mix", "Mix", tracks("a", "b"), "p1")
+    queue.update(job_id, "a", "worker", "completed")
+    queue.update(job_id, "b", "worker", "failed", attempts=3, error="no match")
+    queue.enqueue("Mix", "Mix", tracks("a", "b"), "p1")
+    states = {track["track_id"]: (track["status"], track["attempts"]) for track in queue.job_tracks(job_id)}
+    assert states == {"a": ("completed", 0), "b": ("pending", 0)}
+
+
+def test_jobs_without_playlist_are_separate(queue):
+    first, _ = queue.enqueue("Singles", "Singles", tracks("a"))
+    second, _ = queue.enqueue("Singles", "Singles", tracks("a"))
+    assert first != second
+
+
+def test_claim_order_follows_priority_then_age_then_position(queue):
+    bulk, _ = queue.enqueue("Bulk", "Bulk", tracks("a1", "a2"), "p1", priority=0)
+    time.sleep(0.01)
+    urgent, _ = queue.enqueue("Single", "Single", tracks("b1"), priority=10)
+    claimed = [queue.claim("worker") for _ in range(4)]
+    assert [(claim["job_id"], claim["track_id"]) for claim in claimed[:3]] == [
+        (urgent, "b1"), (bulk, "a1"), (bulk, "a2"),
+    ]
+    # Everything is leased
+    assert claimed[3] is None
+
+
+def test_lapsed_lease_is_claimed_again(queue, monkeypatch):
+    monkeypatch.setattr(jobs.QueueConfig, "LEASE_SECONDS", 0.05)
+    job_id, _ = queue.enqueue("Mix", "Mix", tracks("a"), "p1")
+    first = queue.claim("dead-worker")
+    queue.update(job_id, "a", "dead-worker", "downloading")
+    assert queue.claim("other") is None
+    time.sleep(0.1)
+    second = queue.claim("other")
+    assert (second["job_id"], second["track_id"]) == (first["job_id"], "a")
+    # The old owner no longer holds the lease, so its late update is ignored
+    queue.update(job_id, "a", "dead-worker", "failed", error="late")
+    assert queue.job_tracks(job_id)[0]["status"] == "downloading"
+
+
+def test_renew_keeps_the_lease(queue, monkeypatch):
+    monkeypatch.setattr(jobs.QueueConfig, "LEASE_SECONDS", 0.2)
+    job_id, _ = queue.enqueue("Mix", "Mix", tracks("a"), "p1")
+    queue.claim("worker")
+    time.sleep(0.1)
+    queue.renew(job_id, "a", "worker")
+    time.sleep(0.15)
+    assert queue.claim("other") is None
+
+
+def test_recover_requeues_tracks_with_lapsed_leases(queue, monkeypatch):
+    monkeypatch.setattr(jobs.QueueConfig, "LEASE_SECONDS", 0.05)
+    job_id, _ = queue.enqueue("Mix", "Mix", tracks("a", "b", "c"), "p1")
+    for _ in range(3):
+        queue.claim("old-process")
+    queue.update(job_id, "a", "old-process", "transcoding")
+    queue.update(job_id, "b", "old-process", "completed")
+    time.sleep(0.1)
+
+    assert queue.recover() == 1
+    states = {track["track_id"]: track["status"] for track in queue.job_tracks(job_id)}
+    assert states["a"] == "pending" and states["b"] == "completed"
+    assert queue.claim("new-process")["track_id"] == "a"
+
+
+def test_recover_leaves_live_leases_alone(queue):
+    job_id, _ = queue.enqueue("Mix", "Mix", tracks("a"), "p1")
+    queue.claim("other-process")
+    queue.update(job_id, "a", "other-process", "downloading")
+
+    assert queue.recover() == 0
+    assert queue.job_tracks(job_id)[0]["status"] == "downloading"
+    assert queue.claim("new-process") is None
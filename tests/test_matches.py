@@ -0,0 +1,44 @@
+from matches import best_match, score_candidate
+
+NAME, ARTISTS, DURATION_MS = "Heart Wild - Remastered 2011", ["The Band"], 200_000
+
+
+def entry(title, channel="The Band - Topic", duration=200, url="https://youtu.be/x"):
+    return {"id": title, "title": title, "channel": channel, "duration": duration, "url": url}
+
+
+def test_official_upload_scores_high():
+    score = score_candidate(NAME, ARTISTS, DURATION_MS, entry("Heart Wild"))
+    assert score is not None and score > 0.9
+
+
+def test_duration_far_off_is_rejected():
+    assert score_candidate(NAME, ARTISTS, DURATION_MS, entry("Heart Wild", duration=260)) is None
+
+
+def test_unrelated_title_is_rejected():
+    assert score_candidate(NAME, ARTISTS, DURATION_MS, entry("Something Else Entirely")) is None
+
+
+def test_unwanted_versions_are_penalised():
+    studio = score_candidate(NAME, ARTISTS, DURATION_MS, entry("The Band - Heart Wild", "Uploader"))
+    live = score_candidate(NAME, ARTISTS, DURATION_MS, entry("The Band - Heart Wild (Live)", "Uploader"))
+    assert live < studio
+    # Unless the Spotify track is that version itself
+    assert score_candidate("Heart Wild (Live)", ARTISTS, DURATION_MS,
+                           entry("The Band - Heart Wild (Live)", "Uploader")) == studio
+
+
+def test_missing_duration_is_neutral():
+    assert score_candidate(NAME, ARTISTS, None, entry("Heart Wild")) is not None
+
+
+def test_best_match_picks_highest_score():
+    entries = [
+        entry("Heart Wild (Karaoke)", "Karaoke Hits"),
+        entry("Heart Wild", url="https://youtu.be/best"),
+        entry("Heart Wild", url=None),
+    ]
+    match = best_match(NAME, ARTISTS, DURATION_MS, entries)
+    assert match.url == "https://youtu.be/best"
+    assert best_match(NAME, ARTISTS, DURATION_MS, [entry("Nothing Alike")]) is None
@@ -0,0 +1,111 @@
+import asyncio
+import json
+
+import progress
+from progress import ProgressBus, SSESubscriber, Subscriber
+
+
+def frames_of(subscriber: SSESubscriber) -> list[dict]:
+    frames = []
+    while not subscriber.queue.empty():
+        message = subscriber.queue.get_nowait()
+        frames.append(json.loads(message.split("data: ", 1)[1]))
+    return frames
+
+
+async def ticks(bus: ProgressBus, job_id: str, count: int):
+    for tick in range(count):
+        bus.publish(job_id, "t1", progress=tick)
+        await bus._tick()
+
+
+async def snapshot():
+    return {"id": "job"}
+
+
+def test_replay_resumes_from_since():
+    async def run():
+        bus = ProgressBus()
+        await ticks(bus, "job", 10)
+        subscriber = SSESubscriber()
+        assert await bus.subscribe(subscriber, "job", since=7, snapshot=snapshot)
+        await ticks(bus, "job", 1)
+        return frames_of(subscriber)
+
+    assert [(frame["type"], frame["seq"]) for frame in asyncio.run(run())] == [
+        ("progress", 8), ("progress", 9), ("progress", 10), ("progress", 11),
+    ]
+
+
+def test_replay_larger_than_the_sse_buffer_sends_a_snapshot(monkeypatch):
+    monkeypatch.setattr(progress.ProgressConfig, "SSE_BUFFER", 64)
+
+    async def run():
+        bus = ProgressBus()
+        await ticks(bus, "job", 100)
+        subscriber = SSESubscriber()
+        assert await bus.subscribe(subscriber, "job", since=0, snapshot=snapshot)
+        return frames_of(subscriber)
+
+    frames = asyncio.run(run())
+    assert [(frame["type"], frame["seq"]) for frame in frames] == [("snapshot", 100)]
+
+
+def test_replay_that_fell_out_of_the_window_sends_a_snapshot(monkeypatch):
+    monkeypatch.setattr(progress.ProgressConfig, "REPLAY_FRAMES", 5)
+
+    async def run():
+        bus = ProgressBus()
+        await ticks(bus, "job", 20)
+        subscriber = SSESubscriber()
+        assert await bus.subscribe(subscriber, "job", since=3, snapshot=snapshot)
+        return frames_of(subscriber)
+
+    assert [frame["type"] for frame in asyncio.run(run())] == ["snapshot"]
+
+
+def test_unbuffered_subscriber_gets_the_whole_replay():
+    sent = []
+
+    async def send(seq, frame):
+        sent.append(seq)
+
+    async def close():
+        pass
+
+    async def run():
+        bus = ProgressBus()
+        await ticks(bus, "job", 100)
+        assert await bus.subscribe(Subscriber(send, close), "job", since=0, snapshot=snapshot)
+
+    asyncio.run(run())
+    assert sent == list(range(1, 101))
+
+
+def test_unknown_job_is_refused():
+    async def missing():
+        return None
+
+    async def run():
+        return await ProgressBus().subscribe(SSESubscriber(), "nope", snapshot=missing)
+
+    assert asyncio.run(run()) is False
+
+
+def test_updates_within_a_tick_are_coalesced():
+    async def run():
+        bus = ProgressBus()
+        subscriber = SSESubscriber()
+        await bus.subscribe(subscriber, "job", snapshot=snapshot)
+        for value in range(50):
+            bus.publish("job", "t1", progress=value)
+        bus.publish("job", "t2", status="completed")
+        await bus._tick()
+        return frames_of(subscriber)
+
+    snapshot_frame, frame = asyncio.run(run())
+    assert snapshot_frame["type"] == "snapshot"
+    assert frame["updates"] == [
+        {"job_id": "job", "track_id": "t1", "progress": 49},
+        {"job_id": "job", "track_id": "t2", "status": "completed"},
+    ]
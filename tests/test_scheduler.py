@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import httpx
+
+import scheduler
+from scheduler import RequestScheduler, TokenBucket
+
+
+def test_bucket_allows_burst_then_paces():
+    async def run():
+        bucket = TokenBucket(rate=20, burst=2)
+        started = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # Two from the burst, then one every 50ms
+    assert 0.08 <= asyncio.run(run()) < 0.5
+
+
+def test_bucket_pause_holds_acquirers():
+    async def run():
+        bucket = TokenBucket(rate=100, burst=10)
+        bucket.pause(0.2)
+        started = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) >= 0.19
+
+
+def response(status, headers=None):
+    return httpx.Response(status, headers=headers, request=httpx.Request("GET", "https://api.spotify.com/v1/me"))
+
+
+def test_429_waits_for_retry_after_and_retries():
+    async def run():
+        requests = RequestScheduler("client")
+        replies = iter([response(429, {"Retry-After": "0.3"}), response(200)])
+        sent = []
+
+        async def send():
+            sent.append(time.monotonic())
+            return next(replies)
+
+        result = await requests.run(send, "Bearer a")
+        return requests, result, sent
+
+    requests, result, sent = asyncio.run(run())
+    assert result.status_code == 200
+    assert sent[1] - sent[0] >= 0.29
+    assert requests.rate_limited == 1 and requests.retries == 1
+    assert requests.retry_after_wait == 0.3
+
+
+def test_429_only_pauses_the_token_that_caused_it():
+    async def run():
+        requests = RequestScheduler("client")
+        limited = iter([response(429, {"Retry-After": "1"}), response(200)])
+
+        async def send_limited():
+            return next(limited)
+
+        async def send_other():
+            return response(200)
+
+        slow = asyncio.create_task(requests.run(send_limited, "Bearer a"))
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        await requests.run(send_other, "Bearer b")
+        other_wait = time.monotonic() - started
+        await slow
+        return other_wait
+
+    assert asyncio.run(run()) < 0.5
+
+
+def test_429_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(scheduler.SchedulerConfig, "MAX_RETRIES", 1)
+
+    async def run():
+        requests = RequestScheduler("client")
+
+        async def send():
+            return response(429, {"Retry-After": "0"})
+
+        return await requests.run(send, "Bearer a")
+
+    assert asyncio.run(run()).status_code == 429
+
+
+def test_missing_retry_after_uses_default(monkeypatch):
+    monkeypatch.setattr(scheduler.SchedulerConfig, "DEFAULT_RETRY_AFTER", 2.5)
+    assert RequestScheduler._retry_after(response(429)) == 2.5
+    assert RequestScheduler._retry_after(response(429, {"Retry-After": "junk"})) == 2.5
+    assert RequestScheduler._retry_after(response(429, {"Retry-After": "7"})) == 7.0
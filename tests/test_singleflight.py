@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+class Call:
+    def __init__(self, result="value", fail: bool = False):
+        self.result = result
+        self.fail = fail
+        self.count = 0
+
+    async def __call__(self):
+        self.count += 1
+        await asyncio.sleep(0.02)
+        if self.fail:
+            raise RuntimeError("upstream down")
+        return self.result
+
+
+def test_concurrent_calls_share_one_result():
+    flights, call = SingleFlight(), Call({"a": 1})
+
+    async def run():
+        return await asyncio.gather(*(flights.do("k", call) for _ in range(4)))
+
+    results = asyncio.run(run())
+    assert call.count == 1
+    assert all(result is results[0] for result in results)
+    assert (flights.calls, flights.shared, flights.in_flight()) == (1, 3, 0)
+
+
+def test_different_keys_do_not_share():
+    flights, call = SingleFlight(), Call()
+
+    async def run():
+        await asyncio.gather(flights.do("a", call), flights.do("b", call))
+
+    asyncio.run(run())
+    assert call.count == 2
+
+
+def test_finished_call_is_not_reused():
+    flights, call = SingleFlight(), Call()
+
+    async def run():
+        await flights.do("k", call)
+        await flights.do("k", call)
+
+    asyncio.run(run())
+    assert call.count == 2
+
+
+def test_failure_reaches_every_caller_and_is_not_cached():
+    flights, call = SingleFlight(), Call(fail=True)
+
+    async def run():
+        results = await asyncio.gather(flights.do("k", call), flights.do("k", call), return_exceptions=True)
+        call.fail = False
+        return results, await flights.do("k", call)
+
+    results, retry = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retry == "value" and call.count == 2
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    flights, call = SingleFlight(), Call()
+
+    async def run():
+        first = asyncio.create_task(flights.do("k", call))
+        second = asyncio.create_task(flights.do("k", call))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "value"
+    assert call.count == 1
@@ -0,0 +1,106 @@
+import asyncio
+
+import httpx
+import pytest
+
+from spotify import SpotifyClient
+
+API = "https://api.test/v1"
+
+
+def client_for(total: int, fail_at: int = -1):
+    """A client whose API host serves ``total`` numbered items, ``limit`` at a time."""
+    calls = {"offsets": [], "in_flight": 0, "peak": 0}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        offset = int(request.url.params["offset"])
+        limit = int(request.url.params["limit"])
+        calls["offsets"].append(offset)
+        calls["in_flight"] += 1
+        calls["peak"] = max(calls["peak"], calls["in_flight"])
+        await asyncio.sleep(0.01)
+        calls["in_flight"] -= 1
+        if offset == fail_at:
+            # Not retried, unlike 5xx and 429
+            return httpx.Response(403, json={"error": "forbidden"})
+        items = [{"n": n} for n in range(offset, min(offset + limit, total))]
+        return httpx.Response(200, json={"items": items, "total": total, "offset": offset, "limit": limit})
+
+    client = SpotifyClient("client", api_url=API)
+    client._clients["api.test"] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client, calls
+
+
+async def collect(client: SpotifyClient, **kwargs) -> list[int]:
+    try:
+        return [item["n"] async for item in client.paginate("/me/tracks", "Bearer t", 10, **kwargs)]
+    finally:
+        await client.aclose()
+
+
+def test_pages_are_fetched_concurrently_and_yielded_in_order():
+    client, calls = client_for(total=95)
+    items = asyncio.run(collect(client, concurrency=3))
+    assert items == list(range(95))
+    assert sorted(calls["offsets"]) == list(range(0, 95, 10))
+    assert calls["peak"] == 3
+
+
+def test_empty_collection_is_one_request():
+    client, calls = client_for(total=0)
+    assert asyncio.run(collect(client)) == []
+    assert calls["offsets"] == [0]
+
+
+def test_known_total_skips_the_first_request():
+    client, calls = client_for(total=30)
+    assert asyncio.run(collect(client, offset=10, total=30)) == list(range(10, 30))
+    assert sorted(calls["offsets"]) == [10, 20]
+
+
+def test_failed_page_ends_the_stream_after_earlier_items():
+    client, calls = client_for(total=60, fail_at=30)
+    received = []
+
+    async def run():
+        try:
+            async for item in client.paginate("/me/tracks", "Bearer t", 10, concurrency=2):
+                received.append(item["n"])
+        finally:
+            await client.aclose()
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run())
+    assert received == list(range(30))
+    # Pages past the failure are never requested
+    assert max(calls["offsets"]) <= 40
+
+
+def test_playlist_is_revalidated_by_its_etag():
+    requests = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append((request.url.path, request.headers.get("If-None-Match")))
+        if request.url.path.endswith("/tracks"):
+            offset = int(request.url.params["offset"])
+            return httpx.Response(200, json={"items": [{"n": n} for n in range(offset, 150)], "total": 150})
+        if request.headers.get("If-None-Match") == '"snap1"':
+            return httpx.Response(304, headers={"ETag": '"snap1"'})
+        page = {"items": [{"n": n} for n in range(100)], "total": 150}
+        return httpx.Response(200, json={"id": "p1", "tracks": page}, headers={"ETag": '"snap1"'})
+
+    client = SpotifyClient("client", api_url=API)
+    client._clients["api.test"] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def run():
+        try:
+            first = await client.full_playlist_conditional("p1", "Bearer t")
+            return first, await client.full_playlist_conditional("p1", "Bearer t", first[1])
+        finally:
+            await client.aclose()
+
+    (playlist, etag), again = asyncio.run(run())
+    assert etag == '"snap1"' and again is None
+    assert [item["n"] for item in playlist["tracks"]["items"]] == list(range(150))
+    assert requests == [("/v1/playlists/p1", None), ("/v1/playlists/p1/tracks", None),
+                        ("/v1/playlists/p1", '"snap1"')]
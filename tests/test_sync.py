@@ -0,0 +1,44 @@
+from sync import diff_items
+
+
+def items(*keys):
+    return [{"track": {"id": key, "name": key}} for key in keys]
+
+
+def ids(entries):
+    return [(entry["id"], entry["position"]) for entry in entries]
+
+
+def test_unchanged():
+    assert diff_items(["a", "b", "c"], items("a", "b", "c")) == {"added": [], "removed": [], "moved": []}
+
+
+def test_added():
+    diff = diff_items(["a", "b"], items("a", "x", "b", "y"))
+    assert ids(diff["added"]) == [("x", 1), ("y", 3)]
+    assert diff["added"][0]["item"]["track"]["id"] == "x"
+    assert diff["removed"] == [] and diff["moved"] == []
+
+
+def test_removed():
+    diff = diff_items(["a", "b", "c", "d"], items("a", "c"))
+    assert ids(diff["removed"]) == [("b", 1), ("d", 3)]
+    assert diff["added"] == [] and diff["moved"] == []
+
+
+def test_moved():
+    diff = diff_items(["a", "b", "c", "d"], items("b", "c", "d", "a"))
+    assert ids(diff["moved"]) == [("a", 3)]
+    assert diff["added"] == [] and diff["removed"] == []
+
+
+def test_duplicates_are_counted():
+    diff = diff_items(["a", "a", "b"], items("a", "b", "b"))
+    assert ids(diff["removed"]) == [("a", 0)]
+    assert ids(diff["added"]) == [("b", 1)]
+
+
+def test_local_files_match_by_uri_and_empty_items_are_skipped():
+    new = [{"track": {"id": None, "uri": "spotify:local:x"}}, {"track": None}, None]
+    diff = diff_items(["spotify:local:x"], new)
+    assert diff == {"added": [], "removed": [], "moved": []}
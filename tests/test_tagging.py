@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+from mutagen.id3 import ID3
+
+import tagging
+from store import LibraryStore
+from tagging import Tagger, build_tags, write_tags
+
+TRACK = {
+    "id": "t1",
+    "name": "Song",
+    "artists": [{"name": "Singer"}, {"name": "Guest"}],
+    "album": {"name": "Record", "artists": [{"name": "Singer"}], "release_date": "2021-05-07", "total_tracks": 12},
+    "track_number": 3,
+    "disc_number": 1,
+    "external_ids": {"isrc": "USABC2100001"},
+}
+
+
+@pytest.fixture
+def mp3(tmp_path):
+    path = tmp_path / "t1.mp3"
+    # Tagging never touches the audio, so any payload will do
+    path.write_bytes(b"\xff\xfb\x90\x00" * 64)
+    return str(path)
+
+
+def test_build_tags():
+    tags = build_tags(TRACK, cover=b"jpeg")
+    assert tags["TIT2"].text == ["Song"]
+    assert tags["TPE1"].text == ["Singer", "Guest"]
+    assert tags["TPE2"].text == ["Singer"]
+    assert tags["TRCK"].text == ["3/12"]
+    assert tags["TSRC"].text == ["USABC2100001"]
+    assert tags["TXXX:SPOTIFY_TRACK_ID"].text == ["t1"]
+    assert tags["APIC:Cover"].data == b"jpeg"
+
+
+def test_v23_tags_carry_the_release_year(mp3, monkeypatch):
+    monkeypatch.setattr(tagging.TagConfig, "ID3_VERSION", 3)
+    write_tags(mp3, build_tags(TRACK))
+    # Read the frames as stored; mutagen upgrades them to v2.4 by default
+    tags = ID3(mp3, translate=False)
+    assert tags.version[:2] == (2, 3)
+    assert tags["TYER"].text == ["2021"]
+    assert "TDRC" not in tags
+
+
+def test_v24_tags_keep_the_full_date(mp3, monkeypatch):
+    monkeypatch.setattr(tagging.TagConfig, "ID3_VERSION", 4)
+    write_tags(mp3, build_tags(TRACK))
+    assert str(ID3(mp3)["TDRC"].text[0]) == "2021-05-07"
+
+
+def test_unsynced_track_is_looked_up_for_its_user(mp3, tmp_path):
+    store = LibraryStore(str(tmp_path / "library.db"))
+    lookups = []
+
+    async def lookup(track_id, user_id):
+        lookups.append((track_id, user_id))
+        return {**TRACK, "album": {**TRACK["album"], "id": None}}
+
+    tagger = Tagger(store, None, lookup)
+
+    async def run():
+        await tagger.tag_track(mp3, "t1", {"name": "fallback"}, user_id="alice")
+        # Remembered after the first lookup
+        await tagger.tag_track(mp3, "t1", {"name": "fallback"}, user_id="alice")
+        await tagger.tag_track(mp3, "spotify:local:x", {"name": "Local"}, user_id="alice")
+
+    asyncio.run(run())
+    store.close()
+    assert lookups == [("t1", "alice")]
+    assert ID3(mp3)["TIT2"].text == ["Local"]
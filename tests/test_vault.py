@@ -0,0 +1,128 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+pytest.importorskip("cryptography")
+from cryptography.fernet import Fernet  # noqa: E402
+
+from vault import TokenVault, VaultConfig  # noqa: E402
+
+
+def grant(access: str = "access-1", refresh: str = "refresh-1", expires_in: int = 3600) -> dict:
+    return {"access_token": access, "refresh_token": refresh, "expires_in": expires_in, "scope": "user-read"}
+
+
+class Refresher:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = []
+
+    async def __call__(self, refresh_token: str):
+        self.calls.append(refresh_token)
+        await asyncio.sleep(0.01)
+        if self.fail:
+            return None
+        return {"access_token": f"access-{len(self.calls) + 1}", "expires_in": 3600}
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(VaultConfig, "KEY", Fernet.generate_key().decode())
+    return str(tmp_path / "vault.db")
+
+
+def test_sessions_are_opaque_and_encrypted_at_rest(db):
+    tokens = TokenVault(Refresher(), db)
+
+    async def run():
+        session_id = await tokens.create(grant(), "alice")
+        return session_id, await tokens.access_token(session_id), await tokens.user_id(session_id)
+
+    session_id, access, user_id = asyncio.run(run())
+    tokens.close()
+    assert TokenVault.is_session_id(session_id)
+    assert (access, user_id) == ("Bearer access-1", "alice")
+    with sqlite3.connect(db) as conn:
+        stored = conn.execute("SELECT id_hash, access_token, refresh_token FROM sessions").fetchone()
+    assert session_id not in stored[0]
+    assert b"access-1" not in stored[1] and b"refresh-1" not in stored[2]
+
+
+def test_expiring_token_is_refreshed_once_per_user(db):
+    refresher = Refresher()
+    tokens = TokenVault(refresher, db)
+
+    async def run():
+        first = await tokens.create(grant(expires_in=10), "alice")
+        second = await tokens.create(grant(expires_in=10), "alice")
+        return await asyncio.gather(tokens.access_token(first), tokens.access_token(second),
+                                    tokens.token_for_user("alice"))
+
+    results = asyncio.run(run())
+    tokens.close()
+    assert refresher.calls == ["refresh-1"]
+    assert set(results) == {"Bearer access-2"}
+
+
+def test_failed_refresh_gives_no_token(db):
+    tokens = TokenVault(Refresher(fail=True), db)
+
+    async def run():
+        return await tokens.access_token(await tokens.create(grant(expires_in=10), "alice"))
+
+    assert asyncio.run(run()) is None
+    tokens.close()
+
+
+def test_idle_sessions_expire(db, monkeypatch):
+    monkeypatch.setattr(VaultConfig, "SESSION_TTL", 60)
+    tokens = TokenVault(Refresher(), db)
+
+    async def run():
+        session_id = await tokens.create(grant(), "alice")
+        tokens._sessions.clear()
+        with tokens._lock:
+            tokens._conn.execute("UPDATE sessions SET last_used = ?", (time.time() - 120,))
+        return await tokens.access_token(session_id), await tokens.token_for_user("alice")
+
+    assert asyncio.run(run()) == (None, None)
+    tokens.close()
+
+
+def test_revoked_session_is_gone(db):
+    tokens = TokenVault(Refresher(), db)
+
+    async def run():
+        session_id = await tokens.create(grant(), "alice")
+        await tokens.revoke(session_id)
+        return await tokens.access_token(session_id)
+
+    assert asyncio.run(run()) is None
+    tokens.close()
+
+
+def test_session_cache_is_bounded(db, monkeypatch):
+    monkeypatch.setattr(VaultConfig, "CACHE_SIZE", 2)
+    tokens = TokenVault(Refresher(), db)
+
+    async def run():
+        session_ids = [await tokens.create(grant(), f"user{n}") for n in range(3)]
+        return await tokens.user_id(session_ids[0])
+
+    # Evicted from memory, still loaded from disk
+    assert asyncio.run(run()) == "user0"
+    assert len(tokens._sessions) == 2
+    tokens.close()
+
+
+def test_sessions_from_another_key_are_discarded(db, monkeypatch):
+    tokens = TokenVault(Refresher(), db)
+    session_id = asyncio.run(tokens.create(grant(), "alice"))
+    tokens.close()
+
+    monkeypatch.setattr(VaultConfig, "KEY", Fernet.generate_key().decode())
+    tokens = TokenVault(Refresher(), db)
+    assert asyncio.run(tokens.access_token(session_id)) is None
+    tokens.close()
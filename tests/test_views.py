@@ -0,0 +1,59 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import views
+from views import parse, select, shaper, small_image
+
+
+def test_parse_nested_and_dotted():
+    assert parse("id,tracks(total,items(track(name)))") == {
+        "id": None, "tracks": {"total": None, "items": {"track": {"name": None}}},
+    }
+    assert parse("tracks.total, name") == {"tracks": {"total": None}, "name": None}
+
+
+def test_parse_merges_repeated_keys():
+    assert parse("album(id),album(name)") == {"album": {"id": None, "name": None}}
+    # A bare key selects the whole value
+    assert parse("album(id),album") == {"album": None}
+
+
+@pytest.mark.parametrize("fields", ["", "a,", "a(b", "a)", "a(b))", "a,,b", "()", "a.(b)"])
+def test_parse_rejects_malformed(fields):
+    with pytest.raises(ValueError):
+        parse(fields)
+
+
+def test_select_traverses_lists():
+    data = {"id": 1, "extra": True, "items": [{"track": {"name": "A", "uri": "x"}}, {"track": {"name": "B"}}]}
+    assert select(data, parse("id,items(track(name)),missing")) == {
+        "id": 1, "items": [{"track": {"name": "A"}}, {"track": {"name": "B"}}],
+    }
+
+
+def test_small_image(monkeypatch):
+    monkeypatch.setattr(views.ViewConfig, "IMAGE_SIZE", 300)
+    images = [{"url": "l", "width": 640}, {"url": "m", "width": 300}, {"url": "s", "width": 64}]
+    assert small_image(images) == [{"url": "m", "width": 300}]
+    assert small_image(images[2:]) == [{"url": "s", "width": 64}]
+    assert small_image([{"url": "u", "width": None}]) == [{"url": "u", "width": None}]
+    assert small_image(None) == []
+
+
+def test_shaper():
+    playlist = {"id": "p", "name": "P", "followers": {"total": 3},
+                "images": [{"url": "l", "width": 640}, {"url": "m", "width": 300}]}
+    compact = shaper("id,name,images")(playlist)
+    assert compact == {"id": "p", "name": "P", "images": [{"url": "m", "width": 300}]}
+    # Explicit fields keep every image
+    assert shaper("id", "images")(playlist) == {"images": playlist["images"]}
+    assert shaper("id", "*") is None
+
+
+def test_bad_fields_answer_400():
+    import main
+
+    client = TestClient(main.app)
+    response = client.get("/playlists", params={"fields": "tracks(items"}, headers={"Authorization": "Bearer x"})
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Invalid fields")